@@ -0,0 +1,308 @@
+import argparse
+import asyncio
+import logging
+import os
+import threading
+import psycopg2
+from psycopg2 import pool
+from cachetools import TTLCache
+from database.connection import mimic_connection
+from database.migrations import ColumnCheck, run_migration, columns_present
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_CACHE_TTL = float(os.getenv('ANALYSIS_CACHE_TTL', '3600'))
+ANALYSIS_CACHE_MAXSIZE = int(os.getenv('ANALYSIS_CACHE_MAXSIZE', '1000'))
+
+# Stored analyses are found by the hash of the exact prompt input. Applied
+# from the command line before deploying, like the prediction cache's:
+#   python analysis_cache.py migrate
+ANALYSIS_TABLE = ('patient_analysis', 'llm_analysis')
+ANALYSIS_CACHE_COLUMNS = ['content_hash']
+ANALYSIS_CACHE_MIGRATION = [
+    "SET lock_timeout = '5s'",
+    "ALTER TABLE patient_analysis.llm_analysis ADD COLUMN IF NOT EXISTS content_hash TEXT",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS llm_analysis_subject_content_hash_idx ON patient_analysis.llm_analysis (subject_id, content_hash, timestamp DESC)",
+]
+MIGRATION_HINT = "llm_analysis lacks the content_hash column, run `python analysis_cache.py migrate`"
+
+
+class AbandonedFlight(Exception):
+    # The leader went away without a result, e.g. a streaming client that
+    # disconnected; its followers start over
+    pass
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share one execution of fn
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0
+
+    def do(self, key, fn):
+        while True:
+            leader, call = self.join(key)
+            if leader:
+                break
+            try:
+                return self.wait(call)
+            except AbandonedFlight:
+                continue
+
+        result = error = None
+        try:
+            result = fn()
+            return result
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.finish(key, call, result, error)
+
+    # join/wait/finish are do() in pieces, for a leader that can't run as
+    # one function call, like the streaming route's generator
+    def join(self, key):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.shared += 1
+                return False, call
+            call = {'event': threading.Event(), 'result': None, 'error': None}
+            self._calls[key] = call
+            return True, call
+
+    def wait(self, call):
+        call['event'].wait()
+        if call['error'] is not None:
+            raise call['error']
+        return call['result']
+
+    def finish(self, key, call, result, error=None):
+        call['result'] = result
+        call['error'] = error
+        with self._lock:
+            del self._calls[key]
+        call['event'].set()
+
+
+class AsyncSingleFlight:
+    # SingleFlight for coroutines on one event loop
+    def __init__(self):
+        self._calls = {}
+        self.shared = 0
+
+    async def do(self, key, fn):
+        future = self._calls.get(key)
+        if future is not None:
+            self.shared += 1
+            # shield: a cancelled follower must not cancel the leader's call
+            return await asyncio.shield(future)
+        future = asyncio.ensure_future(fn())
+        self._calls[key] = future
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if future.done():
+                self._calls.pop(key, None)
+            else:
+                future.add_done_callback(lambda _: self._calls.pop(key, None))
+
+
+def lookup_stored_analysis(subject_id, content_hash):
+    with mimic_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT llm_response
+                FROM patient_analysis.llm_analysis
+                WHERE subject_id = %s AND content_hash = %s
+                ORDER BY timestamp DESC
+                LIMIT 1
+                """,
+                (str(subject_id), content_hash)
+            )
+            row = cursor.fetchone()
+    return row[0] if row else None
+
+
+STORED_ANALYSIS_QUERY_ASYNC = """
+    SELECT llm_response
+    FROM patient_analysis.llm_analysis
+    WHERE subject_id = $1 AND content_hash = $2
+    ORDER BY timestamp DESC
+    LIMIT 1
+"""
+
+async def lookup_stored_analysis_async(subject_id, content_hash):
+    from database.async_connection import async_pool
+    return await async_pool().fetchval(STORED_ANALYSIS_QUERY_ASYNC, str(subject_id), content_hash)
+
+
+class AnalysisCache:
+    # In-process TTL layer in front of patient_analysis.llm_analysis, which
+    # every worker writes to anyway. The LLM only runs when neither has a
+    # result for the current content hash, and only once per hash at a time.
+    def __init__(self, ttl=ANALYSIS_CACHE_TTL, maxsize=ANALYSIS_CACHE_MAXSIZE):
+        self._local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self._async_flight = AsyncSingleFlight()
+        self._schema = ColumnCheck(ANALYSIS_TABLE, ANALYSIS_CACHE_COLUMNS, MIGRATION_HINT)
+        self._counters = {'local_hits': 0, 'stored_hits': 0, 'misses': 0, 'lookup_errors': 0}
+
+    def get_or_generate(self, subject_id, content_hash, generate):
+        key = (str(subject_id), content_hash)
+        cached = self._get_local(key)
+        if cached is not None:
+            return cached
+        return self._flight.do(key, lambda: self._load_or_generate(subject_id, content_hash, generate))
+
+    def get_cached(self, subject_id, content_hash):
+        # Like get_or_generate, but returns None instead of calling the LLM
+        cached = self._get_local((str(subject_id), content_hash))
+        if cached is not None:
+            return cached
+        stored = self._lookup(subject_id, content_hash)
+        if stored is not None:
+            self.put(subject_id, content_hash, stored)
+        return stored
+
+    def stream_or_get(self, subject_id, content_hash, stream):
+        # For the streaming route, on the same key and flight as
+        # get_or_generate. Yields ('result', analysis) when the analysis is
+        # cached, stored or being generated by another request; otherwise
+        # passes on stream()'s events, whose ('done', analysis) is cached
+        # and handed to every request that waited for it.
+        key = (str(subject_id), content_hash)
+        cached = self._get_local(key)
+        if cached is not None:
+            yield 'result', cached
+            return
+        while True:
+            leader, call = self._flight.join(key)
+            if leader:
+                break
+            try:
+                result = self._flight.wait(call)
+            except AbandonedFlight:
+                continue
+            yield 'result', result
+            return
+
+        result = error = None
+        try:
+            result = self._lookup(subject_id, content_hash)
+            if result is not None:
+                yield 'result', result
+            else:
+                for event, payload in stream():
+                    if event == 'done':
+                        result = payload
+                    yield event, payload
+            if result is None:
+                error = RuntimeError("The LLM stream ended without an analysis")
+            else:
+                self.put(subject_id, content_hash, result)
+        except GeneratorExit:
+            # The client went away; a result it already had is still good
+            if result is not None:
+                self.put(subject_id, content_hash, result)
+            else:
+                error = AbandonedFlight()
+            raise
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._flight.finish(key, call, result, error)
+
+    async def aget_or_generate(self, subject_id, content_hash, generate):
+        # The ASGI app's variant: generate is a coroutine function and the
+        # stored lookup goes through asyncpg
+        key = (str(subject_id), content_hash)
+        cached = self._get_local(key)
+        if cached is not None:
+            return cached
+        return await self._async_flight.do(key, lambda: self._aload_or_generate(subject_id, content_hash, generate))
+
+    def put(self, subject_id, content_hash, result):
+        with self._lock:
+            self._local[(str(subject_id), content_hash)] = result
+
+    def metrics(self):
+        with self._lock:
+            counters = dict(self._counters)
+            counters['local_entries'] = len(self._local)
+        counters['single_flight_shared'] = self._flight.shared + self._async_flight.shared
+        return counters
+
+    def _get_local(self, key):
+        with self._lock:
+            cached = self._local.get(key)
+        if cached is not None:
+            self._count('local_hits')
+        return cached
+
+    def require_schema(self):
+        # Every lookup and stored analysis needs content_hash; without it
+        # requests fail fast instead of spilling rows that can't be inserted
+        self._schema.require()
+
+    async def arequire_schema(self):
+        await self._schema.arequire()
+
+    def _lookup(self, subject_id, content_hash):
+        self.require_schema()
+        try:
+            stored = lookup_stored_analysis(subject_id, content_hash)
+        except (psycopg2.Error, pool.PoolError) as error:
+            # Falling through to the LLM is slower but still correct
+            logger.warning("Stored LLM analysis lookup for subject %s failed: %s", subject_id, error)
+            self._count('lookup_errors')
+            stored = None
+        self._count('stored_hits' if stored is not None else 'misses')
+        return stored
+
+    def _load_or_generate(self, subject_id, content_hash, generate):
+        result = self._lookup(subject_id, content_hash)
+        if result is None:
+            result = generate()
+        self.put(subject_id, content_hash, result)
+        return result
+
+    async def _alookup(self, subject_id, content_hash):
+        await self.arequire_schema()
+        try:
+            stored = await lookup_stored_analysis_async(subject_id, content_hash)
+        except Exception as error:
+            # asyncpg raises its own exception types; any lookup failure just
+            # means calling the LLM
+            logger.warning("Stored LLM analysis lookup for subject %s failed: %s", subject_id, error)
+            self._count('lookup_errors')
+            stored = None
+        self._count('stored_hits' if stored is not None else 'misses')
+        return stored
+
+    async def _aload_or_generate(self, subject_id, content_hash, generate):
+        result = await self._alookup(subject_id, content_hash)
+        if result is None:
+            result = await generate()
+        self.put(subject_id, content_hash, result)
+        return result
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+
+if __name__ == "__main__":
+    # Run from backend/flask:
+    #   python analysis_cache.py migrate
+    parser = argparse.ArgumentParser(description="Schema behind the stored LLM analysis lookup")
+    parser.add_argument('command', choices=['migrate', 'check'])
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        run_migration(ANALYSIS_CACHE_MIGRATION)
+    present = columns_present(ANALYSIS_TABLE, ANALYSIS_CACHE_COLUMNS)
+    print("llm_analysis content_hash column is", "in place" if present else "missing")
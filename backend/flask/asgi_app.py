@@ -0,0 +1,228 @@
+# Async serving mode: /predict and /llm_analysis on an ASGI server, with
+# asyncpg for the database and the LLM calls awaited rather than blocking a
+# thread. Responses are built by the same functions as backend.py, so their
+# shapes match. Run from backend/flask:
+#   uvicorn asgi_app:app --workers 4 --port 8000
+import asyncio
+import logging
+import time
+import pandas as pd
+from contextlib import asynccontextmanager
+from pydantic import ValidationError
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+import metrics
+from metrics import STAGE_SECONDS, HTTP_REQUEST_SECONDS
+from backend import (
+    feature_store, unmaterialized_ids, merge_view_rows, parse_subject_id, parse_top_k, align_features, feature_hashes, score_and_store,
+    latest_prediction_result, model_bundle, parse_and_store_analysis, analysis_cache, prediction_cache,
+)
+from database.async_connection import open_async_pool, close_async_pool, async_pool, async_pool_metrics
+from database.patient_context import aload_patient_context
+from prediction_cache import lookup_latest_prediction_async
+from database.migrations import MissingColumnsError
+from database.write_behind import flush_all_buffers
+from lazy_init import warmup, startup_report
+from llm_analysis import (
+    patient_context_cache, format_patient_context, has_patient_data, analysis_content_hash, build_prompts, run_prompts,
+    background_loop, LLM_ANALYSIS_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+VIEW_QUERY = "SELECT * FROM mimiciv_derived.patient_prediction_data WHERE subject_id = ANY($1::integer[])"
+
+
+async def fetch_view_rows(subject_ids):
+    rows = await async_pool().fetch(VIEW_QUERY, list(subject_ids))
+    if not rows:
+        return pd.DataFrame()
+    return pd.DataFrame.from_records([tuple(row) for row in rows], columns=list(rows[0].keys()), coerce_float=True)
+
+async def get_patient_data_batch(subject_ids):
+    # Feature store first, the view for anything it doesn't have, as in backend.py
+    with STAGE_SECONDS.time('fetch_features'):
+        subject_ids = [parse_subject_id(subject_id) for subject_id in subject_ids]
+        # The first get() builds the store, which may load the model
+        store = feature_store.get() if feature_store.loaded else await asyncio.to_thread(feature_store.get)
+        df = await store.alookup(subject_ids) if store is not None else None
+        if df is None:
+            return await fetch_view_rows(subject_ids)
+        unmaterialized = unmaterialized_ids(df, subject_ids)
+        if unmaterialized:
+            df = merge_view_rows(df, await fetch_view_rows(unmaterialized))
+        return df
+
+async def prepare_patient_analysis(subject_id):
+    with STAGE_SECONDS.time('patient_context'):
+        patient_data = await patient_context_cache.aget_or_load(subject_id, timed_load_patient_context)
+    if not has_patient_data(patient_data):
+        return None, None
+    # Retrieval mode embeds text and similar notes use psycopg2, so keep
+    # formatting off the event loop
+    formatted_patient_data = await asyncio.to_thread(format_patient_context, subject_id, patient_data)
+    return formatted_patient_data, analysis_content_hash(formatted_patient_data)
+
+async def timed_load_patient_context(subject_id):
+    with STAGE_SECONDS.time('patient_context_query'):
+        return await aload_patient_context(subject_id)
+
+async def generate_parsed_analysis(subject_id, formatted_patient_data, content_hash):
+    # The prompts run on the shared LLM loop, where the rate limiter and the
+    # Gemini client live; this loop only awaits the result
+    prompts = build_prompts(formatted_patient_data)
+    future = asyncio.wrap_future(background_loop.submit(run_prompts(prompts, subject_id)))
+    results = await asyncio.wait_for(future, timeout=LLM_ANALYSIS_TIMEOUT)
+    # Parsing and the write-behind enqueue, which can spill to disk, stay
+    # off the event loop like /predict's scoring and storage
+    return await asyncio.to_thread(
+        parse_and_store_analysis,
+        subject_id, results["summary"], results["care_plan"], results["additional_fields"], content_hash
+    )
+
+
+async def predict(request):
+    data = await request.json()
+    subject_id = data.get('subject_id')
+    if not subject_id:
+        return JSONResponse({'error': 'No subject_id provided'}, status_code=400)
+    try:
+        subject_id = parse_subject_id(subject_id)
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    try:
+        top_k = parse_top_k(data.get('top_k'))
+    except (TypeError, ValueError):
+        return JSONResponse({'error': 'top_k must be zero or a positive integer'}, status_code=400)
+
+    df = await get_patient_data_batch([subject_id])
+    if df.empty:
+        return JSONResponse({'error': 'No data found for the provided subject_id'}, status_code=404)
+
+    # Alignment, scoring and the enqueue run in the thread pool, so a cold
+    # model load or a full write-behind queue spilling to disk never blocks
+    # the loop. Memoized as in backend.predict_and_store.
+    values, features_hash, model_version = await asyncio.to_thread(align_and_hash, df)
+    try:
+        result = await prediction_cache.aget(subject_id, features_hash, model_version, top_k)
+        if result is None:
+            result = await asyncio.to_thread(score_and_store, subject_id, values, features_hash, top_k)
+    except ValidationError as e:
+        return JSONResponse(e.errors(), status_code=400)
+    except MissingColumnsError as e:
+        return JSONResponse({'error': str(e)}, status_code=503)
+    return JSONResponse(result)
+
+def align_and_hash(df):
+    values = align_features(df)[:1]
+    return values, feature_hashes(values)[0], model_bundle.get().version
+
+async def latest_prediction(request):
+    subject_id = request.path_params['subject_id']
+    try:
+        await prediction_cache.arequire_schema()
+        stored = await lookup_latest_prediction_async(subject_id)
+    except MissingColumnsError as e:
+        return JSONResponse({'error': str(e)}, status_code=503)
+    except Exception as e:
+        logger.error("Reading the latest prediction for subject %s failed: %s", subject_id, e)
+        return JSONResponse({'error': 'Could not read stored predictions'}, status_code=503)
+    if stored is None:
+        return JSONResponse({'error': 'No prediction stored for the provided subject_id'}, status_code=404)
+    return JSONResponse(latest_prediction_result(subject_id, stored))
+
+async def llm_analysis(request):
+    data = await request.json()
+    logger.debug("Received data for LLM analysis: %s", data)
+
+    if not data:
+        return JSONResponse({'error': 'No data provided in the request'}, status_code=400)
+
+    subject_id = data.get('subjectId')
+    prediction_data = data.get('predictionData')
+
+    if not subject_id:
+        return JSONResponse({'error': 'No subjectId provided in the request data'}, status_code=400)
+    if not prediction_data:
+        return JSONResponse({'error': 'No predictionData provided in the request data'}, status_code=400)
+
+    try:
+        formatted_patient_data, content_hash = await prepare_patient_analysis(subject_id)
+        if formatted_patient_data is None:
+            return JSONResponse({'error': 'No data found for the provided subjectId'}, status_code=404)
+
+        response = await analysis_cache.aget_or_generate(
+            subject_id, content_hash,
+            lambda: generate_parsed_analysis(subject_id, formatted_patient_data, content_hash)
+        )
+        return JSONResponse(response)
+    except MissingColumnsError as e:
+        return JSONResponse({'error': str(e)}, status_code=503)
+    except Exception:
+        logger.exception("LLM analysis for subject %s failed", subject_id)
+        return JSONResponse({'error': 'An unexpected error occurred during analysis'}, status_code=500)
+
+async def metrics_route(request):
+    if not metrics.METRICS_ENABLED:
+        return JSONResponse({'error': 'Metrics are disabled'}, status_code=404)
+    return Response(metrics.render(), headers={'Content-Type': metrics.METRICS_CONTENT_TYPE})
+
+async def startup_health(request):
+    report = startup_report()
+    report['async_pool'] = async_pool_metrics()
+    return JSONResponse(report)
+
+
+class RequestTimer:
+    # Pure ASGI middleware, so streaming and the event loop are untouched
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not metrics.METRICS_ENABLED:
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = {}
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status['code'] = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # Every Starlette router fills in the endpoint on the shared scope;
+            # the route template, never the raw path, keeps the label bounded
+            route = ROUTE_PATHS.get(scope.get('endpoint'), 'unmatched')
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, route, scope['method'], status.get('code', 500))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await open_async_pool()
+    # The model and compiled pipeline load in a thread so the loop stays free
+    await asyncio.to_thread(warmup)
+    try:
+        yield
+    finally:
+        await close_async_pool()
+        await asyncio.to_thread(flush_all_buffers)
+
+ROUTES = [
+    Route('/predict', predict, methods=['POST']),
+    Route('/predict/{subject_id:int}/latest', latest_prediction, methods=['GET']),
+    Route('/llm_analysis', llm_analysis, methods=['POST']),
+    Route('/metrics', metrics_route, methods=['GET']),
+    Route('/health/startup', startup_health, methods=['GET']),
+]
+ROUTE_PATHS = {route.endpoint: route.path for route in ROUTES}
+
+app = Starlette(
+    routes=ROUTES,
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']), Middleware(RequestTimer)],
+    lifespan=lifespan,
+)
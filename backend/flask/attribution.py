@@ -0,0 +1,72 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from tree_ensemble import FlatTreeEnsemble
+
+ATTRIBUTION_CACHE_SIZE = int(os.getenv('ATTRIBUTION_CACHE_SIZE', '10000'))
+ATTRIBUTION_TOP_K = int(os.getenv('ATTRIBUTION_TOP_K', '5'))
+
+
+class FeatureAttributor:
+    # Per-patient feature attributions for the readmission classifier.
+    # Works on the preprocessed feature matrix, so callers that already ran
+    # the preprocessor for prediction don't pay for it twice.
+    def __init__(self, bundle, cache_size=ATTRIBUTION_CACHE_SIZE, top_k=ATTRIBUTION_TOP_K):
+        # Models loaded from an artifact are already flattened
+        ensemble = getattr(bundle.classifier, 'ensemble', None)
+        self.ensemble = ensemble if ensemble is not None else FlatTreeEnsemble.from_gradient_boosting(bundle.classifier)
+        self.feature_names = bundle.feature_names
+        self.top_k = top_k
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def explain(self, X, top_k=None):
+        # Returns one list of {'Feature', 'Importance'} records per row, ranked
+        # by absolute contribution to the row's log-odds of readmission
+        top_k = self.top_k if top_k is None else top_k
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        keys = [row.tobytes() for row in X]
+        contributions = [None] * len(keys)
+        pending = []
+
+        with self._lock:
+            for i, key in enumerate(keys):
+                cached = self._cache.get(key)
+                if cached is None:
+                    pending.append(i)
+                else:
+                    self._cache.move_to_end(key)
+                    contributions[i] = cached
+            self.hits += len(keys) - len(pending)
+            self.misses += len(pending)
+
+        if pending:
+            computed, _ = self.ensemble.contributions(X[pending])
+            with self._lock:
+                for i, row in zip(pending, computed):
+                    contributions[i] = row
+                    if self.cache_size > 0:
+                        self._cache[keys[i]] = row
+                        if len(self._cache) > self.cache_size:
+                            self._cache.popitem(last=False)
+
+        return [self._top_records(row, top_k) for row in contributions]
+
+    def _top_records(self, contributions, top_k):
+        if top_k >= len(contributions):
+            order = np.argsort(-np.abs(contributions))
+        else:
+            order = np.argpartition(-np.abs(contributions), top_k)[:top_k]
+            order = order[np.argsort(-np.abs(contributions[order]))]
+        return [
+            {'Feature': self.feature_names[i], 'Importance': float(contributions[i])}
+            for i in order[:top_k]
+        ]
+
+    def cache_info(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cache), 'max_size': self.cache_size}
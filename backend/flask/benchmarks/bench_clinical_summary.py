@@ -0,0 +1,151 @@
+import argparse
+import json
+import random
+import statistics
+import time
+import numpy as np
+import psycopg2
+from benchmarks.mimic_fixture import DEFAULT_SCALE, add_scale_arguments, ensure_scratch_database, seed_fixture
+from clinical_summary import VITAL_ITEMS, summarize_array_rows
+from database.patient_context import CONTEXT_QUERIES, context_from_row, create_patient_context_indexes
+from llm_analysis import estimate_tokens, format_patient_data
+
+# Raw rows against the SQL and numpy summaries of labs and ICU vitals: query
+# time, bytes of JSON returned by the context query, and prompt tokens. The
+# fixture's --vitals sets the ICU stay length (one reading every 15 minutes),
+# so the defaults below are stays of about 83 days.
+#
+#   python -m benchmarks.bench_clinical_summary --dsn dbname=bench_mimic
+#   python -m benchmarks.bench_clinical_summary --offline
+
+LONG_STAY_SCALE = {'subjects': 200, 'labs': 3000, 'vitals': 8000}
+MODES = ('raw', 'sql', 'numpy')
+
+
+def time_mode(conn, mode, subject_ids):
+    query = CONTEXT_QUERIES[mode][0]
+    timings, transfer, tokens = [], [], []
+    for subject_id in subject_ids:
+        start = time.perf_counter()
+        with conn.cursor() as cur:
+            cur.execute(query, {'subject_id': subject_id})
+            row = cur.fetchone()
+        context = context_from_row(row, mode)
+        timings.append((time.perf_counter() - start) * 1000)
+        conn.rollback()
+        # The lab and vital columns as they came over the wire
+        transfer.append(len(json.dumps(row[2])) + len(json.dumps(row[5])))
+        tokens.append(estimate_tokens(format_patient_data(context, mode)))
+    return timings, transfer, tokens
+
+def print_row(label, timings, transfer, tokens):
+    percentiles = statistics.quantiles(timings, n=100)
+    print(f"{label:<7} p50 {percentiles[49]:8.2f} ms   p95 {percentiles[94]:8.2f} ms   "
+          f"labs+vitals {statistics.mean(transfer) / 1024:8.1f} KiB   prompt {statistics.mean(tokens):6.0f} tokens")
+
+def run(conn, samples, seed=0):
+    with conn.cursor() as cur:
+        cur.execute("SELECT max(subject_id) FROM mimiciv_icu.icustays")
+        max_subject = cur.fetchone()[0]
+    conn.commit()
+    rng = random.Random(seed)
+    subject_ids = [rng.randint(1, max_subject) for _ in range(samples)]
+    print(f"\n{samples} patients:")
+    for mode in MODES:
+        # One warm-up pass so every mode sees the same buffer cache state
+        time_mode(conn, mode, subject_ids[:10])
+        print_row(mode, *time_mode(conn, mode, subject_ids))
+    mismatches = check_parity(conn, subject_ids)
+    print(f"sql and numpy summaries {'differ for ' + str(mismatches) if mismatches else 'agree'}")
+
+def _close(a, b):
+    if isinstance(a, float) and isinstance(b, float):
+        return np.isclose(a, b, rtol=1e-6, atol=1e-9)
+    return a == b
+
+def check_parity(conn, subject_ids):
+    # Both summary modes have to show the LLM the same numbers
+    mismatches = []
+    for subject_id in subject_ids:
+        contexts = {}
+        for mode in ('sql', 'numpy'):
+            with conn.cursor() as cur:
+                cur.execute(CONTEXT_QUERIES[mode][0], {'subject_id': subject_id})
+                contexts[mode] = context_from_row(cur.fetchone(), mode)
+            conn.rollback()
+        for key in ('lab_summary', 'vital_summary'):
+            pairs = list(zip(contexts['sql'][key], contexts['numpy'][key]))
+            if len(contexts['sql'][key]) != len(contexts['numpy'][key]) or not all(
+                    _close(a, b) for sql_row, numpy_row in pairs for a, b in zip(sql_row, numpy_row)):
+                mismatches.append(subject_id)
+                break
+    return mismatches
+
+
+def synthetic_array_rows(rng, hours, interval_minutes=15):
+    # One vital per item at the fixture's cadence, as the 'numpy' query returns them
+    count = int(hours * 60 / interval_minutes)
+    times = 1.6e6 + np.arange(count) * interval_minutes / 60
+    rows = []
+    for itemid, (label, low, high) in VITAL_ITEMS.items():
+        values = (low + high) / 2 + (high - low) * (0.4 * np.sin(times / 24) + rng.normal(0, 0.2, count))
+        rows.append([label, 'bpm', times.tolist(), values.tolist(), None, None, low, high, '2150-03-01 00:00:00'])
+    return rows
+
+def summarize_python(rows):
+    # The same statistics row by row, for scale
+    summaries = []
+    for label, valueuom, hours, values, _, _, low, high, last_time in rows:
+        n = len(values)
+        mean_x, mean_y = sum(hours) / n, sum(values) / n
+        spread = sum((x - mean_x) ** 2 for x in hours)
+        slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(hours, values)) / spread
+        abnormal = sum(1 for y in values if y < low or y > high)
+        summaries.append((label, valueuom, n, min(values), max(values), mean_y, values[-1], slope, abnormal, last_time))
+    return summaries
+
+def run_offline(repeats, seed=0):
+    # No database: numpy summaries of increasingly long windows, against a
+    # plain Python loop and the JSON size of the arrays they replace
+    rng = np.random.default_rng(seed)
+    print(f"{'window':>8} {'points':>8}   {'numpy':>9}   {'python':>9}   {'arrays':>10}   {'summary':>9}")
+    for hours in (72, 24 * 14, 24 * 30, 24 * 90):
+        rows = synthetic_array_rows(rng, hours)
+        timings = {}
+        for label, summarize in (('numpy', summarize_array_rows), ('python', summarize_python)):
+            start = time.perf_counter()
+            for _ in range(repeats):
+                summaries = summarize(rows)
+            timings[label] = (time.perf_counter() - start) / repeats * 1000
+        points = sum(len(row[3]) for row in rows)
+        print(f"{hours:>7}h {points:>8}   {timings['numpy']:7.2f}ms   {timings['python']:7.2f}ms   "
+              f"{len(json.dumps(rows)) / 1024:8.1f}KiB   {len(json.dumps(summaries)):7d} B")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare raw and summarized labs and vitals in the patient context")
+    parser.add_argument('--dsn', help="libpq connection string of a scratch database")
+    parser.add_argument('--offline', action='store_true', help="only the numpy summarizer, no database")
+    parser.add_argument('--samples', type=int, default=100)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--skip-seed', action='store_true', help="reuse an already seeded fixture")
+    parser.add_argument('--allow-any-database', action='store_true')
+    add_scale_arguments(parser)
+    parser.set_defaults(**LONG_STAY_SCALE)
+    args = parser.parse_args()
+
+    run_offline(args.repeats)
+    if args.offline:
+        raise SystemExit(0)
+    if not args.dsn:
+        parser.error("--dsn is required unless --offline is given")
+    conn = psycopg2.connect(args.dsn)
+    try:
+        ensure_scratch_database(conn, args.allow_any_database)
+        if not args.skip_seed:
+            params = seed_fixture(conn, **{name: getattr(args, name) for name in DEFAULT_SCALE})
+            print(f"Seeded fixture: {params}")
+            create_patient_context_indexes(conn)
+            conn.autocommit = False
+        run(conn, args.samples)
+    finally:
+        conn.close()
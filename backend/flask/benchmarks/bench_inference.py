@@ -0,0 +1,56 @@
+import argparse
+import statistics
+import time
+import numpy as np
+from model_bundle import load_model, load_pipeline
+from model_artifact import sample_inputs
+from inference import CompiledPipeline, verify_parity
+from schema_alignment import SchemaAligner
+
+def time_call(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def summarize(label, batch_size, timings):
+    median = statistics.median(timings)
+    print(f"{label:<28} batch {batch_size:>6}   p50 {median:9.3f} ms   min {min(timings):9.3f} ms   "
+          f"{median * 1000 / batch_size:9.2f} us/row")
+
+def run(batch_sizes, repeat, min_repeat_rows=20000):
+    bundle = load_model()
+    # The baseline is sklearn itself, even when the bundle came from the artifact
+    pipeline = load_pipeline()
+    preprocessor, classifier = pipeline.named_steps['preprocessor'], pipeline.named_steps['classifier']
+    compiled = CompiledPipeline.from_bundle(bundle)
+    aligner = SchemaAligner.from_preprocessor(bundle.preprocessor)
+    if not verify_parity(bundle, 2000, pipeline=pipeline):
+        raise SystemExit("compiled path is not bit-identical to sklearn; not benchmarking it")
+
+    frames = sample_inputs(bundle.preprocessor, max(batch_sizes), seed=1)
+    frames['subject_id'] = np.arange(len(frames))
+    print()
+    for batch_size in batch_sizes:
+        frame = frames.iloc[:batch_size]
+        values = frame[compiled.input_columns].to_numpy(dtype=np.float64)
+        # Small batches are too quick to time once, so repeat them more
+        runs = max(repeat, min_repeat_rows // batch_size)
+        summarize("sklearn pipeline", batch_size, time_call(
+            lambda: classifier.predict_proba(preprocessor.transform(frame)), runs))
+        summarize("compiled, DataFrame input", batch_size, time_call(
+            lambda: compiled.predict_proba(compiled.transform(frame)), runs))
+        summarize("aligned + compiled", batch_size, time_call(
+            lambda: compiled.predict_proba(compiled.transform_array(aligner.align(frame)[0])), runs))
+        summarize("compiled, array input", batch_size, time_call(
+            lambda: compiled.predict_proba(compiled.transform_array(values)), runs))
+        print()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency of the sklearn pipeline vs the compiled inference path")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 10, 100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    run(args.batch_sizes, args.repeat)
@@ -0,0 +1,78 @@
+import argparse
+import random
+import re
+import statistics
+import time
+import psycopg2
+from benchmarks.mimic_fixture import DEFAULT_SCALE, add_scale_arguments, ensure_scratch_database, seed_fixture
+from database.patient_context import (
+    PATIENT_CONTEXT_INDEXES, create_patient_context_indexes,
+    fetch_patient_context, fetch_patient_context_sequential,
+)
+
+def index_names():
+    return [re.search(r"IF NOT EXISTS (\w+) ON (\w+)\.", statement).group(2, 1) for statement in PATIENT_CONTEXT_INDEXES]
+
+def drop_patient_context_indexes(conn):
+    with conn.cursor() as cur:
+        for schema, name in index_names():
+            cur.execute(f"DROP INDEX IF EXISTS {schema}.{name}")
+    conn.commit()
+
+def time_loader(conn, loader, subject_ids):
+    timings = []
+    for subject_id in subject_ids:
+        start = time.perf_counter()
+        loader(conn, subject_id)
+        conn.rollback()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def summarize(label, timings):
+    percentiles = statistics.quantiles(timings, n=100)
+    print(f"{label:<34} mean {statistics.mean(timings):8.2f} ms   p50 {percentiles[49]:8.2f} ms   p95 {percentiles[94]:8.2f} ms")
+
+def run(conn, samples, seed=0):
+    with conn.cursor() as cur:
+        cur.execute("SELECT set_config('search_path', 'mimiciv_hosp, mimiciv_icu', false)")
+        cur.execute("SELECT max(subject_id) FROM mimiciv_hosp.admissions")
+        max_subject = cur.fetchone()[0]
+    conn.commit()
+
+    rng = random.Random(seed)
+    subject_ids = [rng.randint(1, max_subject) for _ in range(samples)]
+    loaders = [
+        ('six sequential queries', fetch_patient_context_sequential),
+        ('single CTE round trip', fetch_patient_context),
+    ]
+
+    for phase in ('without indexes', 'with indexes'):
+        if phase == 'without indexes':
+            drop_patient_context_indexes(conn)
+        else:
+            create_patient_context_indexes(conn)
+            conn.autocommit = False
+        print(f"\n{phase}:")
+        for label, loader in loaders:
+            # One warm-up pass so both loaders see the same buffer cache state
+            time_loader(conn, loader, subject_ids[:10])
+            summarize(label, time_loader(conn, loader, subject_ids))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the sequential and single round-trip patient context loaders")
+    parser.add_argument('--dsn', required=True, help="libpq connection string of a scratch database")
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--skip-seed', action='store_true', help="reuse an already seeded fixture")
+    parser.add_argument('--allow-any-database', action='store_true')
+    add_scale_arguments(parser)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    try:
+        ensure_scratch_database(conn, args.allow_any_database)
+        if not args.skip_seed:
+            params = seed_fixture(conn, **{name: getattr(args, name) for name in DEFAULT_SCALE})
+            print(f"Seeded fixture: {params}")
+        run(conn, args.samples)
+    finally:
+        conn.close()
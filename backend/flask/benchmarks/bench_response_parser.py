@@ -0,0 +1,150 @@
+import argparse
+import os
+import random
+import statistics
+import time
+from contextlib import redirect_stdout
+from response_parser import ResponseParser, parse_llm_response
+
+# The parser as it was before the single-pass rewrite, debug prints included,
+# kept verbatim as the baseline for timings and output parity
+
+def legacy_parse_llm_response(llm_result):
+    parsed_response = {}
+    current_section = None
+    current_content = []
+
+    print(f"Starting to parse LLM result:\n{llm_result}")  # Debug log
+
+    lines = llm_result.split('\n')
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        # Check for main section headers (starts with '**' and ends with '**')
+        if line.startswith('**') and line.endswith('**'):
+            if current_section:
+                parsed_response[current_section] = legacy_parse_section_content(current_content)
+                print(f"Parsed section '{current_section}': {parsed_response[current_section]}")  # Debug log
+            current_section = line.strip('*').strip()
+            current_content = []
+        else:
+            current_content.append(line)
+
+    # Parse the last section
+    if current_section:
+        parsed_response[current_section] = legacy_parse_section_content(current_content)
+        print(f"Parsed section '{current_section}': {parsed_response[current_section]}")  # Debug log
+
+    print(f"Final parsed response: {parsed_response}")  # Debug log
+    return parsed_response
+
+def legacy_parse_section_content(content):
+    if not content:
+        return ""
+
+    # Check if the section has bullet points
+    if any(line.strip().startswith('*') for line in content):
+        return legacy_parse_bulleted_list(content)
+    else:
+        return ' '.join(content)
+
+def legacy_parse_bulleted_list(lines):
+    result = {}
+    current_item = None
+    current_content = []
+
+    for line in lines:
+        line = line.strip()
+        if line.startswith('*'):
+            if current_item:
+                result[current_item] = ' '.join(current_content)
+            current_item = line[1:].strip()
+            current_content = []
+        elif current_item:
+            current_content.append(line)
+
+    # Add the last item
+    if current_item:
+        result[current_item] = ' '.join(current_content)
+
+    return result
+
+
+WORDS = ("patient", "risk", "readmission", "discharge", "follow-up", "medication", "creatinine",
+         "monitor", "heart", "rate", "elevated", "within", "normal", "limits", "review", "dose")
+
+def sentence(rng, words=12):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+def synthetic_response(rng, sections, items, nested=False):
+    # Shaped like the Gemini output: bold headers, '*' bullets with
+    # continuation lines, plus some prose-only sections. With nested=True
+    # it also uses numbered lists and indented sub-bullets.
+    lines = [sentence(rng)]
+    for s in range(sections):
+        lines.append(f"**Section {s}**")
+        if s % 4 == 3:
+            lines.extend(sentence(rng, 20) for _ in range(items))
+            continue
+        for i in range(items):
+            marker = f"{i + 1}." if nested and s % 2 else "*"
+            lines.append(f"{marker} Item {i}: {sentence(rng, 6)}")
+            lines.append(f"  {sentence(rng)}")
+            if nested:
+                lines.append(f"    - {sentence(rng, 5)}")
+        lines.append("")
+    return '\n'.join(lines)
+
+def parse_in_chunks(text, chunk_size):
+    parser = ResponseParser()
+    for start in range(0, len(text), chunk_size):
+        parser.feed(text[start:start + chunk_size])
+    parser.close()
+    return parser.result
+
+def time_parser(parse, texts, repeat):
+    timings = []
+    for _ in range(repeat):
+        for text in texts:
+            start = time.perf_counter()
+            parse(text)
+            timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def summarize(label, timings):
+    print(f"{label:<40} mean {statistics.mean(timings):8.3f} ms   p50 {statistics.median(timings):8.3f} ms   max {max(timings):8.3f} ms")
+
+def run(sections, items, samples, repeat, chunk_size, seed=0):
+    rng = random.Random(seed)
+    flat = [synthetic_response(rng, sections, items) for _ in range(samples)]
+    nested = [synthetic_response(rng, sections, items, nested=True) for _ in range(samples)]
+    print(f"{samples} responses of ~{statistics.mean(len(t) for t in flat) / 1024:.1f} KB, {sections} sections x {items} items\n")
+
+    # Without numbered or nested lists both parsers must agree exactly
+    for text in flat:
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            expected = legacy_parse_llm_response(text)
+        if parse_llm_response(text) != expected or parse_in_chunks(text, chunk_size) != expected:
+            raise AssertionError("single-pass parser output differs from the legacy parser")
+    print("output parity with the legacy parser: ok")
+
+    # The legacy debug prints go to /dev/null: the formatting and write
+    # syscalls are still paid, the terminal isn't
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        legacy = time_parser(legacy_parse_llm_response, flat, repeat)
+    summarize("legacy (prints to /dev/null)", legacy)
+    summarize("single pass, whole string", time_parser(parse_llm_response, flat, repeat))
+    summarize(f"single pass, {chunk_size}-char chunks", time_parser(lambda t: parse_in_chunks(t, chunk_size), flat, repeat))
+    summarize("single pass, nested/numbered lists", time_parser(parse_llm_response, nested, repeat))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmark the LLM response parser on large synthetic responses")
+    parser.add_argument('--sections', type=int, default=40)
+    parser.add_argument('--items', type=int, default=25)
+    parser.add_argument('--samples', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--chunk-size', type=int, default=64, help="size of the streamed chunks")
+    args = parser.parse_args()
+    run(args.sections, args.items, args.samples, args.repeat, args.chunk_size)
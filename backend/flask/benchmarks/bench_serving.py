@@ -0,0 +1,125 @@
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import time
+from benchmarks.load_test import (
+    SUBJECT_MODES, fixture_subject_ids, print_summary, reset_stored_results, run_level, subject_pools,
+)
+
+# Sync (gunicorn, worker threads) against async (uvicorn, asyncpg) serving of
+# the same routes, each as a real server with the fake LLM, at increasing
+# concurrency. The Gemini rate limit is lifted so the serving mode, not the
+# quota, sets the ceiling. Needs a seeded bench database behind config.py.
+#
+#   python -m benchmarks.bench_serving --workers 2 --concurrency 1 16 64 256 1024
+#
+# Subjects are handled as in load_test: by default every mode, endpoint and
+# level gets its own, so neither mode is measured on the other's cache hits.
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def server_command(mode, port, workers, threads):
+    if mode == 'sync':
+        return [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f"127.0.0.1:{port}",
+                '--workers', str(workers), '--threads', str(threads), 'benchmarks.fake_serving:wsgi_app']
+    return [sys.executable, '-m', 'uvicorn', 'benchmarks.fake_serving:asgi_app', '--host', '127.0.0.1',
+            '--port', str(port), '--workers', str(workers), '--no-access-log']
+
+def server_environment(args):
+    env = dict(os.environ)
+    env.update({
+        'FAKE_LLM_LATENCY': str(args.llm_latency),
+        'FAKE_LLM_JITTER': str(args.llm_jitter),
+        'LLM_RATE_PER_SECOND': '1000000',
+        'LLM_RATE_BURST': '1000000',
+        'LLM_MAX_CONCURRENCY': '1000000',
+        'ASYNC_DB_POOL_MAX_SIZE': str(args.async_pool_size),
+    })
+    return env
+
+def wait_until_ready(port, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/health/startup')
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"Server on port {port} did not become ready in {timeout}s")
+
+def run_mode(mode, args, pools):
+    port = args.port + (0 if mode == 'sync' else 1)
+    server = subprocess.Popen(server_command(mode, port, args.workers, args.threads), cwd=BACKEND_DIR,
+                              env=server_environment(args), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results = []
+    try:
+        wait_until_ready(port)
+        levels = [(endpoint, concurrency) for endpoint in args.endpoints for concurrency in args.concurrency]
+        for (endpoint, concurrency), level_subjects in zip(levels, pools):
+            summary = run_level(f"http://127.0.0.1:{port}", endpoint, concurrency, args.duration,
+                                level_subjects, args.timeout, args.seed)
+            summary['mode'] = mode
+            print(f"{mode:<5} ", end='')
+            print_summary(summary)
+            results.append(summary)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    return results
+
+def print_comparison(results):
+    rows = {}
+    for item in results:
+        rows.setdefault((item['endpoint'], item['concurrency']), {})[item['mode']] = item
+    print(f"\n{'endpoint':<13} {'conc':>5}   {'sync req/s':>10} {'sync p95':>10}   {'async req/s':>11} {'async p95':>10}")
+    for (endpoint, concurrency), modes in sorted(rows.items()):
+        cells = []
+        for mode in ('sync', 'async'):
+            item = modes.get(mode)
+            p95 = f"{item['p95']:8.0f}ms" if item and item['p95'] is not None else f"{'-':>10}"
+            cells.append((f"{item['throughput']:.1f}" if item else '-', p95))
+        print(f"{endpoint:<13} {concurrency:>5}   {cells[0][0]:>10} {cells[0][1]:>10}   {cells[1][0]:>11} {cells[1][1]:>10}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrency scaling of the sync and async serving modes")
+    parser.add_argument('--modes', nargs='+', choices=['sync', 'async'], default=['sync', 'async'])
+    parser.add_argument('--endpoints', nargs='+', choices=['predict', 'llm_analysis'], default=['llm_analysis', 'predict'])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16, 64, 256])
+    parser.add_argument('--workers', type=int, default=2, help="processes per server, the same for both modes")
+    parser.add_argument('--threads', type=int, default=8, help="gunicorn threads per sync worker")
+    parser.add_argument('--async-pool-size', type=int, default=20, help="asyncpg connections per async worker")
+    parser.add_argument('--duration', type=float, default=15.0)
+    parser.add_argument('--timeout', type=float, default=300.0)
+    parser.add_argument('--llm-latency', type=float, default=1.0)
+    parser.add_argument('--llm-jitter', type=float, default=0.2)
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--subjects', type=int, default=1000, help="distinct subjects per level")
+    parser.add_argument('--subject-mode', choices=SUBJECT_MODES, default='disjoint')
+    parser.add_argument('--keep-stored', action='store_true')
+    parser.add_argument('--subject-ids', type=int, nargs='+')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help="write all results as JSON here")
+    args = parser.parse_args()
+
+    levels = len(args.modes) * len(args.endpoints) * len(args.concurrency)
+    wanted = args.subjects if args.subject_mode == 'shared' else args.subjects * levels
+    subject_ids = args.subject_ids or fixture_subject_ids(wanted, args.seed)
+    pools = subject_pools(subject_ids, levels, args.subject_mode)
+    reset = args.subject_mode == 'disjoint' and not args.keep_stored
+    if reset:
+        reset_stored_results(subject_ids)
+    results = []
+    per_mode = levels // len(args.modes)
+    for i, mode in enumerate(args.modes):
+        results.extend(run_mode(mode, args, pools[i * per_mode:(i + 1) * per_mode]))
+    print_comparison(results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'subject_mode': args.subject_mode, 'stored_results_reset': reset, 'results': results}, f, indent=2)
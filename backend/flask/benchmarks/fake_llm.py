@@ -0,0 +1,61 @@
+import asyncio
+import os
+import random
+from benchmarks.bench_response_parser import synthetic_response
+
+# Stand-in for ChatGoogleGenerativeAI so load tests exercise the whole
+# /llm_analysis path without an API key, quota or network variance
+FAKE_LLM_LATENCY = float(os.getenv('FAKE_LLM_LATENCY', '1.5'))
+FAKE_LLM_JITTER = float(os.getenv('FAKE_LLM_JITTER', '0.3'))
+FAKE_LLM_FAILURE_RATE = float(os.getenv('FAKE_LLM_FAILURE_RATE', '0'))
+FAKE_LLM_CHUNKS = int(os.getenv('FAKE_LLM_CHUNKS', '20'))
+
+
+class FakeMessage:
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeChatModel:
+    # Implements the two methods llm_analysis calls, ainvoke and astream.
+    # Latency is uniform in latency * (1 +/- jitter); a failure raises after
+    # the same wait, like a timed-out or rejected Gemini call.
+    def __init__(self, latency=FAKE_LLM_LATENCY, jitter=FAKE_LLM_JITTER, failure_rate=FAKE_LLM_FAILURE_RATE,
+                 chunks=FAKE_LLM_CHUNKS, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.chunks = chunks
+        self._rng = random.Random(seed)
+        self.calls = 0
+
+    def _delay(self):
+        return max(self.latency * (1 + self._rng.uniform(-self.jitter, self.jitter)), 0)
+
+    def _response(self):
+        self.calls += 1
+        if self._rng.random() < self.failure_rate:
+            raise RuntimeError("Fake LLM failure")
+        return synthetic_response(self._rng, sections=6, items=5)
+
+    async def ainvoke(self, prompt_input):
+        await asyncio.sleep(self._delay())
+        return FakeMessage(self._response())
+
+    async def astream(self, prompt_input):
+        # The whole latency is spread over the chunks, first token included
+        text = self._response()
+        step = max(len(text) // self.chunks, 1)
+        pause = self._delay() / self.chunks
+        for start in range(0, len(text), step):
+            await asyncio.sleep(pause)
+            yield FakeMessage(text[start:start + step])
+
+
+def install_fake_llm(**kwargs):
+    # Swaps the app's lazy Gemini client for the fake, in this process only
+    import llm_analysis
+    from lazy_init import LazyComponent
+    fake = FakeChatModel(**kwargs)
+    llm_analysis.llm = LazyComponent('llm', lambda: fake)
+    return fake
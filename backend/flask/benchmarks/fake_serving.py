@@ -0,0 +1,17 @@
+# Serving targets with the fake LLM installed, for bench_serving:
+#   gunicorn -c gunicorn.conf.py benchmarks.fake_serving:wsgi_app
+#   uvicorn benchmarks.fake_serving:asgi_app --workers 2
+# Latency and failure rate come from the FAKE_LLM_* environment variables.
+from benchmarks.fake_llm import install_fake_llm
+
+install_fake_llm()
+
+def __getattr__(name):
+    # Imported on demand so the sync target doesn't need Starlette installed
+    if name == 'wsgi_app':
+        from backend import app
+        return app
+    if name == 'asgi_app':
+        from asgi_app import app
+        return app
+    raise AttributeError(name)
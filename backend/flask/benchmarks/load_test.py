@@ -0,0 +1,281 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+# Closed-loop load test of /predict and /llm_analysis: at each concurrency
+# level N workers send requests back to back for a fixed duration. By default
+# the Flask app is served in this process with the fake LLM installed, so
+# the database (config.py, pointed at a seeded bench database) is the only
+# external dependency. --url targets an already running server instead.
+# The app's Gemini rate limit still applies to the fake; raise
+# LLM_RATE_PER_SECOND to measure the app rather than the quota.
+#
+#   python -m benchmarks.mimic_fixture --dsn dbname=bench_mimic --prediction-data
+#   python -m benchmarks.load_test --save-baseline benchmarks/baseline.json
+#   python -m benchmarks.load_test --baseline benchmarks/baseline.json
+#
+# Every layer of the app caches by patient (context, stored analysis by
+# content hash, memoized predictions), so by default each endpoint and
+# concurrency level gets its own subjects, each sent once before any is
+# repeated, and the stored results of those subjects are reset first.
+# --subject-mode shared reuses one pool everywhere, to measure a warm cache.
+
+DEFAULT_CONCURRENCY = [1, 4, 16, 32]
+DEFAULT_ENDPOINTS = ['predict', 'llm_analysis']
+# A run regresses when p95 grows or throughput drops by more than this
+DEFAULT_TOLERANCE = 0.15
+SUBJECT_MODES = ['disjoint', 'shared']
+
+# Forget stored analyses and predictions, so they can't answer as cache hits
+STORED_RESULT_RESETS = [
+    "UPDATE patient_analysis.llm_analysis SET content_hash = NULL WHERE subject_id = ANY(%s) AND content_hash IS NOT NULL",
+    "UPDATE patient_analysis.risk_prediction SET feature_hash = NULL WHERE subject_id = ANY(%s) AND feature_hash IS NOT NULL",
+]
+
+
+def request_body(endpoint, subject_id):
+    if endpoint == 'predict':
+        return '/predict', {'subject_id': subject_id}
+    # predictionData is only checked for presence by the route
+    return '/llm_analysis', {'subjectId': subject_id, 'predictionData': {'subject_id': subject_id}}
+
+
+class SubjectSequence:
+    # Shared by a level's workers: the pool in shuffled order, each subject
+    # once before any comes round again. Counts the requests that repeat one.
+    def __init__(self, subject_ids, seed):
+        self._subject_ids = list(subject_ids)
+        random.Random(seed).shuffle(self._subject_ids)
+        self._lock = threading.Lock()
+        self.sent = 0
+
+    def next(self):
+        with self._lock:
+            subject_id = self._subject_ids[self.sent % len(self._subject_ids)]
+            self.sent += 1
+        return subject_id
+
+    @property
+    def repeats(self):
+        return max(self.sent - len(self._subject_ids), 0)
+
+
+class Worker:
+    # One keep-alive connection per worker, like a browser or a proxy pool
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self._factory = lambda: http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+        self._prefix = parts.path.rstrip('/')
+        self._conn = self._factory()
+
+    def post(self, path, payload):
+        body = json.dumps(payload)
+        try:
+            self._conn.request('POST', self._prefix + path, body, {'Content-Type': 'application/json'})
+            response = self._conn.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            self._conn.close()
+            self._conn = self._factory()
+            return None
+
+
+def run_level(url, endpoint, concurrency, duration, subject_ids, timeout, seed):
+    deadline = time.monotonic() + duration
+    results = []
+    lock = threading.Lock()
+    subjects = SubjectSequence(subject_ids, seed * 1000 + concurrency)
+
+    def loop(worker_index):
+        worker = Worker(url, timeout)
+        local = []
+        while time.monotonic() < deadline:
+            path, payload = request_body(endpoint, subjects.next())
+            start = time.perf_counter()
+            status = worker.post(path, payload)
+            local.append(((time.perf_counter() - start) * 1000, status))
+        with lock:
+            results.extend(local)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(loop, range(concurrency)))
+    elapsed = time.monotonic() - started
+    summary = summarize(endpoint, concurrency, results, elapsed)
+    summary.update(subjects=len(subject_ids), repeated_subject_requests=subjects.repeats)
+    return summary
+
+def summarize(endpoint, concurrency, results, elapsed):
+    latencies = sorted(latency for latency, status in results if status == 200)
+    errors = sum(1 for _, status in results if status != 200)
+    summary = {
+        'endpoint': endpoint,
+        'concurrency': concurrency,
+        'requests': len(results),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+    }
+    if len(latencies) >= 2:
+        percentiles = statistics.quantiles(latencies, n=100, method='inclusive')
+        summary.update(p50=percentiles[49], p95=percentiles[94], p99=percentiles[98], mean=statistics.mean(latencies))
+    else:
+        summary.update(p50=None, p95=None, p99=None, mean=None)
+    return summary
+
+def print_summary(summary):
+    def ms(value):
+        return f"{value:9.1f}" if value is not None else "        -"
+    print(f"{summary['endpoint']:<13} c={summary['concurrency']:<4} {summary['throughput']:8.1f} req/s   "
+          f"p50 {ms(summary['p50'])} ms   p95 {ms(summary['p95'])} ms   p99 {ms(summary['p99'])} ms   "
+          f"{summary['requests']} requests, {summary['errors']} errors")
+    if summary.get('repeated_subject_requests'):
+        print(f"{'':<20}{summary['repeated_subject_requests']} requests repeated one of {summary['subjects']} subjects")
+
+def compare(results, baseline, tolerance, subject_mode):
+    # Returns the regressions of results against a saved run, as text
+    if baseline.get('subject_mode', 'shared') != subject_mode:
+        return [f"baseline used --subject-mode {baseline.get('subject_mode', 'shared')}, this run {subject_mode}; "
+                f"cache hits make them incomparable"]
+    previous = {(item['endpoint'], item['concurrency']): item for item in baseline['results']}
+    regressions = []
+    for item in results:
+        before = previous.get((item['endpoint'], item['concurrency']))
+        if before is None:
+            continue
+        label = f"{item['endpoint']} c={item['concurrency']}"
+        if before['p95'] and item['p95'] and item['p95'] > before['p95'] * (1 + tolerance):
+            regressions.append(f"{label}: p95 {before['p95']:.1f} -> {item['p95']:.1f} ms")
+        if before['throughput'] and item['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append(f"{label}: throughput {before['throughput']:.1f} -> {item['throughput']:.1f} req/s")
+        if item['errors'] > before['errors']:
+            regressions.append(f"{label}: errors {before['errors']} -> {item['errors']}")
+    return regressions
+
+
+def serve_in_process(port, fake_llm_options):
+    # The app with the fake LLM, on a threaded WSGI server in this process
+    from werkzeug.serving import make_server
+    from benchmarks.fake_llm import install_fake_llm
+    install_fake_llm(**fake_llm_options)
+    from backend import app
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='load-test-server', daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+def fixture_subject_ids(count, seed):
+    # Subjects that have prediction data, a random sample of them
+    from database.connection import mimic_connection
+    with mimic_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT DISTINCT subject_id FROM mimiciv_derived.patient_prediction_data")
+            subject_ids = [row[0] for row in cursor.fetchall()]
+    if not subject_ids:
+        raise SystemExit("patient_prediction_data is empty: seed it with mimic_fixture --prediction-data")
+    rng = random.Random(seed)
+    return rng.sample(subject_ids, min(count, len(subject_ids)))
+
+def subject_pools(subject_ids, levels, mode):
+    # One pool per level: slices with no subject in common, or the same pool
+    if mode == 'shared':
+        return [subject_ids] * levels
+    size = len(subject_ids) // levels
+    if size == 0:
+        raise SystemExit(f"{len(subject_ids)} subjects can't give {levels} levels disjoint pools")
+    return [subject_ids[i * size:(i + 1) * size] for i in range(levels)]
+
+def reset_stored_results(subject_ids):
+    # The patient context cache is per process unless it is shared through
+    # sqlite or redis, and then this clears it for every worker
+    from database.connection import mimic_connection
+    from database.patient_context import context_from_json
+    from patient_cache import create_patient_cache
+    with mimic_connection() as conn:
+        with conn.cursor() as cursor:
+            for statement in STORED_RESULT_RESETS:
+                cursor.execute(statement, ([str(subject_id) for subject_id in subject_ids],))
+    context_cache = create_patient_cache(decoder=context_from_json)
+    for subject_id in subject_ids:
+        context_cache.invalidate(subject_id)
+
+def run(args):
+    server = None
+    url = args.url
+    if url is None:
+        server, url = serve_in_process(args.port, {
+            'latency': args.llm_latency, 'jitter': args.llm_jitter, 'failure_rate': args.llm_failure_rate,
+        })
+    levels = [(endpoint, concurrency) for endpoint in args.endpoints for concurrency in args.concurrency]
+    wanted = args.subjects if args.subject_mode == 'shared' else args.subjects * len(levels)
+    subject_ids = args.subject_ids or fixture_subject_ids(wanted, args.seed)
+    pools = subject_pools(subject_ids, len(levels), args.subject_mode)
+    if args.subject_mode == 'disjoint' and not args.keep_stored:
+        reset_stored_results(subject_ids)
+    print(f"Load testing {url} with {len(pools[0])} {args.subject_mode} subjects per level, {args.duration:.0f}s per level")
+
+    results = []
+    try:
+        for (endpoint, concurrency), level_subjects in zip(levels, pools):
+            summary = run_level(url, endpoint, concurrency, args.duration, level_subjects, args.timeout, args.seed)
+            print_summary(summary)
+            results.append(summary)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'url': args.url or 'in-process',
+        'duration': args.duration,
+        'llm_latency': args.llm_latency if args.url is None else None,
+        'subject_mode': args.subject_mode,
+        'stored_results_reset': args.subject_mode == 'disjoint' and not args.keep_stored,
+        'results': results,
+    }
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.subject_mode)
+        if regressions:
+            print(f"\nRegressions against {args.baseline} (tolerance {args.tolerance:.0%}):")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"\nNo regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test /predict and /llm_analysis at increasing concurrency")
+    parser.add_argument('--url', help="running server to test; default serves the app in process with the fake LLM")
+    parser.add_argument('--port', type=int, default=0, help="port of the in-process server, default any free port")
+    parser.add_argument('--endpoints', nargs='+', choices=DEFAULT_ENDPOINTS, default=DEFAULT_ENDPOINTS)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--duration', type=float, default=20.0, help="seconds per endpoint and concurrency level")
+    parser.add_argument('--timeout', type=float, default=120.0, help="per request, in seconds")
+    parser.add_argument('--subjects', type=int, default=500, help="distinct subjects per level sampled from the fixture")
+    parser.add_argument('--subject-mode', choices=SUBJECT_MODES, default='disjoint',
+                        help="disjoint: new subjects for every level; shared: one pool, so later levels hit the caches")
+    parser.add_argument('--keep-stored', action='store_true',
+                        help="don't reset the stored analyses and predictions of the sampled subjects")
+    parser.add_argument('--subject-ids', type=int, nargs='+', help="use these subjects instead of sampling the database")
+    parser.add_argument('--llm-latency', type=float, default=1.5, help="fake LLM seconds per call")
+    parser.add_argument('--llm-jitter', type=float, default=0.3)
+    parser.add_argument('--llm-failure-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', help="JSON report of an earlier run to compare against")
+    parser.add_argument('--save-baseline', help="write this run's JSON report here")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    sys.exit(run(parser.parse_args()))
@@ -0,0 +1,237 @@
+import argparse
+import psycopg2
+from psycopg2 import sql
+
+# Only the MIMIC-IV columns the backend actually reads, with the same names
+# and types, so queries written against the real database run unchanged.
+FIXTURE_DDL = [
+    "CREATE SCHEMA IF NOT EXISTS mimiciv_hosp",
+    "CREATE SCHEMA IF NOT EXISTS mimiciv_icu",
+    "DROP TABLE IF EXISTS mimiciv_hosp.admissions, mimiciv_hosp.d_icd_diagnoses, mimiciv_hosp.diagnoses_icd, "
+    "mimiciv_hosp.d_labitems, mimiciv_hosp.labevents, mimiciv_hosp.prescriptions, "
+    "mimiciv_icu.icustays, mimiciv_icu.chartevents",
+    """
+    CREATE TABLE mimiciv_hosp.admissions (
+        subject_id INTEGER, hadm_id INTEGER, admittime TIMESTAMP, dischtime TIMESTAMP,
+        admission_type VARCHAR(40), admission_location VARCHAR(60), discharge_location VARCHAR(60),
+        insurance VARCHAR(255), language VARCHAR(10), marital_status VARCHAR(30), race VARCHAR(80)
+    )
+    """,
+    "CREATE TABLE mimiciv_hosp.d_icd_diagnoses (icd_code CHAR(7), icd_version SMALLINT, long_title VARCHAR(255))",
+    "CREATE TABLE mimiciv_hosp.diagnoses_icd (subject_id INTEGER, hadm_id INTEGER, seq_num INTEGER, icd_code CHAR(7), icd_version SMALLINT)",
+    "CREATE TABLE mimiciv_hosp.d_labitems (itemid INTEGER, label VARCHAR(50), fluid VARCHAR(50), category VARCHAR(50))",
+    """
+    CREATE TABLE mimiciv_hosp.labevents (
+        labevent_id INTEGER, subject_id INTEGER, hadm_id INTEGER, itemid INTEGER, charttime TIMESTAMP,
+        value VARCHAR(200), valuenum DOUBLE PRECISION, valueuom VARCHAR(20),
+        ref_range_lower DOUBLE PRECISION, ref_range_upper DOUBLE PRECISION, flag VARCHAR(10)
+    )
+    """,
+    """
+    CREATE TABLE mimiciv_hosp.prescriptions (
+        subject_id INTEGER, hadm_id INTEGER, starttime TIMESTAMP, stoptime TIMESTAMP, drug VARCHAR(255),
+        dose_val_rx VARCHAR(100), dose_unit_rx VARCHAR(50), route VARCHAR(50)
+    )
+    """,
+    "CREATE TABLE mimiciv_icu.icustays (subject_id INTEGER, hadm_id INTEGER, stay_id INTEGER, intime TIMESTAMP, outtime TIMESTAMP, los DOUBLE PRECISION)",
+    """
+    CREATE TABLE mimiciv_icu.chartevents (
+        subject_id INTEGER, hadm_id INTEGER, stay_id INTEGER, charttime TIMESTAMP, itemid INTEGER,
+        value VARCHAR(200), valuenum DOUBLE PRECISION, valueuom VARCHAR(20), warning SMALLINT
+    )
+    """,
+]
+
+# Rows are generated server side with generate_series, so seeding a few
+# million rows doesn't push them through the client one by one
+FIXTURE_INSERTS = [
+    """
+    INSERT INTO mimiciv_hosp.admissions
+    SELECT s, s * 10 + a,
+           t.admittime, t.admittime + (1 + random() * 14) * interval '1 day',
+           (ARRAY['EW EMER.', 'ELECTIVE', 'URGENT', 'OBSERVATION ADMIT'])[1 + (s + a) %% 4],
+           'EMERGENCY ROOM', 'HOME',
+           (ARRAY['Medicare', 'Medicaid', 'Private', 'Other'])[1 + s %% 4],
+           'ENGLISH',
+           (ARRAY['MARRIED', 'SINGLE', 'WIDOWED', 'DIVORCED'])[1 + s %% 4],
+           'WHITE'
+    FROM generate_series(1, %(subjects)s) s,
+         generate_series(1, %(admissions)s) a,
+         LATERAL (SELECT timestamp '2150-01-01' + (a * 365 + s %% 300) * interval '1 day' AS admittime) t
+    """,
+    """
+    INSERT INTO mimiciv_hosp.d_icd_diagnoses
+    SELECT lpad(i::text, 5, '0'), 10, 'Synthetic diagnosis ' || i
+    FROM generate_series(1, 500) i
+    """,
+    """
+    INSERT INTO mimiciv_hosp.diagnoses_icd
+    SELECT s, s * 10 + 1, n, lpad((1 + (s * 7 + n * 13) %% 500)::text, 5, '0'), 10
+    FROM generate_series(1, %(subjects)s) s, generate_series(1, %(diagnoses)s) n
+    """,
+    """
+    INSERT INTO mimiciv_hosp.d_labitems
+    SELECT 50800 + i, 'Lab ' || i, 'Blood', 'Chemistry'
+    FROM generate_series(0, 49) i
+    """,
+    """
+    INSERT INTO mimiciv_hosp.labevents
+    SELECT row_number() OVER (), s, s * 10 + 1, 50800 + n %% 50,
+           timestamp '2150-01-01' + (s %% 300) * interval '1 day' + n * interval '20 minutes',
+           round(v.valuenum::numeric, 2)::text, v.valuenum, 'mg/dL', 20, 80,
+           CASE WHEN v.valuenum > 80 OR v.valuenum < 20 THEN 'abnormal' END
+    FROM generate_series(1, %(subjects)s) s,
+         generate_series(1, %(labs)s) n,
+         LATERAL (SELECT 50 + 25 * sin(n / 10.0) + random() * 20 AS valuenum) v
+    """,
+    """
+    INSERT INTO mimiciv_hosp.prescriptions
+    SELECT s, s * 10 + 1,
+           timestamp '2150-01-01' + (s %% 300) * interval '1 day' + n * interval '6 hours',
+           timestamp '2150-01-01' + (s %% 300) * interval '1 day' + (n + 8) * interval '6 hours',
+           (ARRAY['Heparin', 'Furosemide', 'Metoprolol', 'Insulin', 'Acetaminophen'])[1 + n %% 5],
+           (1 + n %% 4)::text, 'mg',
+           (ARRAY['IV', 'PO', 'SC'])[1 + n %% 3]
+    FROM generate_series(1, %(subjects)s) s, generate_series(1, %(medications)s) n
+    """,
+    """
+    INSERT INTO mimiciv_icu.icustays
+    SELECT s, s * 10 + 1, s * 100 + 1,
+           timestamp '2150-01-01' + (s %% 300) * interval '1 day',
+           timestamp '2150-01-01' + (s %% 300) * interval '1 day' + %(vitals)s * interval '15 minutes',
+           %(vitals)s / 96.0
+    FROM generate_series(1, %(subjects)s) s
+    """,
+    """
+    INSERT INTO mimiciv_icu.chartevents
+    SELECT s, s * 10 + 1, s * 100 + 1,
+           timestamp '2150-01-01' + (s %% 300) * interval '1 day' + n * interval '15 minutes',
+           v.itemid, round(v.valuenum::numeric, 1)::text, v.valuenum,
+           CASE v.itemid WHEN 220179 THEN '°F' WHEN 220045 THEN 'bpm' WHEN 220210 THEN 'insp/min' ELSE 'mmHg' END,
+           (random() < 0.05)::int
+    FROM generate_series(1, %(subjects)s) s,
+         generate_series(1, %(vitals)s) n,
+         LATERAL (
+             SELECT (ARRAY[220045, 220050, 220051, 220052, 220179, 220210, 220277, 223761])[1 + n %% 8] AS itemid,
+                    80 + 20 * sin(n / 50.0) + random() * 10 AS valuenum
+         ) v
+    """,
+]
+
+# The tables the app writes to. Only created in a scratch database, where
+# dropping them on every seed is harmless.
+PATIENT_ANALYSIS_DDL = [
+    "CREATE SCHEMA IF NOT EXISTS patient_analysis",
+    "DROP TABLE IF EXISTS patient_analysis.risk_prediction, patient_analysis.risk_prediction_daily, patient_analysis.llm_analysis",
+    """
+    CREATE TABLE patient_analysis.risk_prediction (
+        id SERIAL PRIMARY KEY, subject_id VARCHAR(20), probability DOUBLE PRECISION, prediction INTEGER,
+        risk_level VARCHAR(10), recommendation TEXT, top_features JSONB, feature_hash TEXT, model_version TEXT,
+        timestamp TIMESTAMP
+    )
+    """,
+    "CREATE INDEX risk_prediction_subject_timestamp_idx ON patient_analysis.risk_prediction (subject_id, timestamp DESC)",
+    """
+    CREATE TABLE patient_analysis.llm_analysis (
+        id SERIAL PRIMARY KEY, subject_id VARCHAR(20), llm_response JSONB, content_hash TEXT, timestamp TIMESTAMP
+    )
+    """,
+]
+
+# Continuous model inputs; every other feature column is a 0/1 indicator
+CONTINUOUS_FEATURES = {
+    'age': (18, 90), 'los': (0, 30), 'charlson_score': (0, 15), 'num_diagnoses': (1, 40),
+    'num_procedures': (0, 15), 'prev_admissions': (0, 10), 'days_since_last_discharge': (0, 365),
+}
+
+def prediction_data_statements(feature_columns):
+    # mimiciv_derived.patient_prediction_data with one row per subject and
+    # one DOUBLE PRECISION column per model feature. A table rather than the
+    # real view, since the view's sources aren't part of the fixture.
+    columns = sql.SQL(', ').join(sql.SQL("{} DOUBLE PRECISION").format(sql.Identifier(name)) for name in feature_columns)
+    values = []
+    for i, name in enumerate(feature_columns):
+        if name in CONTINUOUS_FEATURES:
+            low, high = CONTINUOUS_FEATURES[name]
+            values.append(sql.SQL("round(({} + random() * {})::numeric, 1)::double precision").format(
+                sql.Literal(low), sql.Literal(high - low)))
+        else:
+            # Deterministic per subject and column, about one in five set
+            values.append(sql.SQL("((s * 31 + {}) %% 5 = 0)::int::double precision").format(sql.Literal(i * 7)))
+    return [
+        sql.SQL("CREATE SCHEMA IF NOT EXISTS mimiciv_derived"),
+        sql.SQL("DROP TABLE IF EXISTS mimiciv_derived.patient_prediction_data"),
+        sql.SQL("CREATE TABLE mimiciv_derived.patient_prediction_data (subject_id INTEGER, {})").format(columns),
+        sql.SQL("INSERT INTO mimiciv_derived.patient_prediction_data SELECT s, {} FROM generate_series(1, %(subjects)s) s").format(
+            sql.SQL(', ').join(values)),
+        sql.SQL("CREATE INDEX ON mimiciv_derived.patient_prediction_data (subject_id)"),
+    ]
+
+DEFAULT_SCALE = {
+    'subjects': 1000,
+    'admissions': 2,
+    'diagnoses': 15,
+    'labs': 500,
+    'medications': 40,
+    'vitals': 2000,
+}
+
+def ensure_scratch_database(conn, allow_any_database=False):
+    # The fixture drops and recreates MIMIC tables, so never point it at a
+    # real MIMIC database by accident
+    with conn.cursor() as cur:
+        cur.execute("SELECT current_database()")
+        name = cur.fetchone()[0]
+    if not allow_any_database and not name.startswith('bench'):
+        raise RuntimeError(f"Refusing to seed fixture tables into '{name}': use a database whose name starts with 'bench'")
+    return name
+
+def seed_fixture(conn, feature_columns=None, **scale):
+    # feature_columns adds patient_prediction_data and the patient_analysis
+    # tables, which the /predict and /llm_analysis load tests need
+    params = {**DEFAULT_SCALE, **{k: v for k, v in scale.items() if v is not None}}
+    with conn.cursor() as cur:
+        for statement in FIXTURE_DDL:
+            cur.execute(statement)
+        for statement in FIXTURE_INSERTS:
+            cur.execute(statement, params)
+        if feature_columns:
+            for statement in prediction_data_statements(feature_columns):
+                cur.execute(statement, params)
+            for statement in PATIENT_ANALYSIS_DDL:
+                cur.execute(statement)
+    conn.commit()
+    # Fresh planner statistics, otherwise the first benchmark run is skewed
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("ANALYZE")
+    finally:
+        conn.autocommit = autocommit
+    return params
+
+def add_scale_arguments(parser):
+    for name, default in DEFAULT_SCALE.items():
+        parser.add_argument(f"--{name}", type=int, default=default, help=f"default: {default}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seed a synthetic MIMIC-IV-shaped scratch database")
+    parser.add_argument('--dsn', required=True, help="libpq connection string of a scratch database")
+    parser.add_argument('--allow-any-database', action='store_true')
+    parser.add_argument('--prediction-data', action='store_true',
+                        help="also create patient_prediction_data for the deployed model and the patient_analysis tables")
+    add_scale_arguments(parser)
+    args = parser.parse_args()
+
+    feature_columns = None
+    if args.prediction_data:
+        from model_bundle import load_model
+        feature_columns = load_model().expected_features
+    conn = psycopg2.connect(args.dsn)
+    try:
+        ensure_scratch_database(conn, args.allow_any_database)
+        params = seed_fixture(conn, feature_columns, **{name: getattr(args, name) for name in DEFAULT_SCALE})
+        print(f"Seeded fixture: {params}")
+    finally:
+        conn.close()
@@ -0,0 +1,90 @@
+import os
+import numpy as np
+
+# How labs and ICU vitals reach the prompts:
+#   'sql'    per-item aggregates computed by the patient context query
+#   'numpy'  the query returns each item's values as compact arrays and the
+#            aggregates are computed here, vectorized
+#   'raw'    the latest 50 lab and 100 vital rows, as before
+CLINICAL_SUMMARY_MODE = os.getenv('CLINICAL_SUMMARY_MODE', 'sql')
+# Trailing window, ending at the patient's latest lab or vital
+CLINICAL_SUMMARY_WINDOW_HOURS = int(os.getenv('CLINICAL_SUMMARY_WINDOW_HOURS', '72'))
+# Labs are ordered by abnormal count, so the cut drops unremarkable items first
+LAB_SUMMARY_MAX_ITEMS = int(os.getenv('LAB_SUMMARY_MAX_ITEMS', '25'))
+
+# chartevents has no abnormal flag, so vitals are checked against adult
+# reference ranges: itemid -> (label, low, high)
+VITAL_ITEMS = {
+    220045: ('Heart Rate', 60, 100),
+    220050: ('Arterial BP systolic', 90, 140),
+    220051: ('Arterial BP diastolic', 60, 90),
+    220052: ('Arterial BP mean', 65, 110),
+    220179: ('Non-invasive BP systolic', 90, 140),
+    220210: ('Respiratory Rate', 12, 20),
+}
+
+# One summary row per item, the same from SQL and from numpy
+SUMMARY_FIELDS = ('label', 'valueuom', 'count', 'min', 'max', 'mean', 'last', 'slope_per_hour', 'abnormal', 'last_time')
+
+
+def summarize_series(hours, values, low=None, high=None):
+    # hours and values in chart order. Returns (count, min, max, mean, last,
+    # slope per hour, abnormal count) over the numeric values, None where a
+    # statistic is undefined, like the SQL aggregates return NULL.
+    hours = np.asarray(hours, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    numeric = ~np.isnan(values)
+    count = int(numeric.sum())
+    if count == 0:
+        return count, None, None, None, None, None, 0
+    hours, values = hours[numeric], values[numeric]
+    slope = None
+    if count > 1:
+        # Least squares, as regr_slope computes it
+        x = hours - hours.mean()
+        spread = np.dot(x, x)
+        if spread > 0:
+            slope = float(np.dot(x, values - values.mean()) / spread)
+    abnormal = 0
+    if low is not None and high is not None:
+        abnormal = int(np.count_nonzero((values < low) | (values > high)))
+    return count, float(values.min()), float(values.max()), float(values.mean()), float(values[-1]), slope, abnormal
+
+def summarize_array_rows(rows):
+    # Rows of [label, valueuom, hours[], values[], last_text, abnormal, low,
+    # high, last_time] from the 'numpy' query into summary rows. abnormal is
+    # set for labs, which carry their own flag; vitals use low and high.
+    summaries = []
+    for label, valueuom, hours, values, last_text, abnormal, low, high, last_time in rows:
+        values = np.array(values, dtype=np.float64)  # JSON nulls become NaN
+        count, minimum, maximum, mean, last, slope, range_abnormal = summarize_series(hours, values, low, high)
+        summaries.append((
+            label, valueuom, count if abnormal is None else len(values), minimum, maximum, mean,
+            last_text if last_text is not None else last, slope,
+            range_abnormal if abnormal is None else abnormal, last_time
+        ))
+    return summaries
+
+def _number(value):
+    if value is None:
+        return '-'
+    if isinstance(value, str):
+        return value
+    return f"{value:.2f}".rstrip('0').rstrip('.')
+
+def format_summary_row(row):
+    label, valueuom, count, minimum, maximum, mean, last, slope, abnormal, _ = row
+    unit = f" {valueuom}" if valueuom else ""
+    text = f"{label}: last {_number(last)}{unit}"
+    if minimum is not None:
+        text += f", mean {_number(mean)}, range {_number(minimum)}-{_number(maximum)}"
+    if slope is not None:
+        # Two significant digits, so slow lab trends don't round to zero
+        text += f", trend {slope:+.2g}/h"
+    text += f", n={count}"
+    if abnormal:
+        text += f", {abnormal} abnormal"
+    return text
+
+def format_summary(title, rows):
+    return f"{title} (last {CLINICAL_SUMMARY_WINDOW_HOURS}h): " + "; ".join(format_summary_row(row) for row in rows)
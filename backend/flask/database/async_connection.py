@@ -0,0 +1,52 @@
+import json
+import os
+from config import DB_CONFIG_mimic
+
+# One asyncpg pool per process for the ASGI app (asgi_app.py). A waiting
+# query holds a pool connection but no thread, so this can be much larger
+# than the psycopg2 pool without costing more workers.
+ASYNC_POOL_MIN_SIZE = int(os.getenv('ASYNC_DB_POOL_MIN_SIZE', '2'))
+ASYNC_POOL_MAX_SIZE = int(os.getenv('ASYNC_DB_POOL_MAX_SIZE', '20'))
+ASYNC_POOL_COMMAND_TIMEOUT = float(os.getenv('ASYNC_DB_COMMAND_TIMEOUT', '30'))
+
+_pool = None
+
+def asyncpg_options(db_config):
+    # psycopg2 takes libpq keyword names, asyncpg calls the database "database"
+    options = {key: value for key, value in db_config.items() if key in ('host', 'port', 'user', 'password')}
+    options['database'] = db_config.get('dbname') or db_config.get('database')
+    return options
+
+async def _init_connection(conn):
+    # Decode json/jsonb like psycopg2 does, so rows match the sync path
+    for type_name in ('json', 'jsonb'):
+        await conn.set_type_codec(type_name, encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+async def open_async_pool(db_config=DB_CONFIG_mimic):
+    global _pool
+    import asyncpg
+    if _pool is None:
+        _pool = await asyncpg.create_pool(
+            min_size=ASYNC_POOL_MIN_SIZE,
+            max_size=ASYNC_POOL_MAX_SIZE,
+            command_timeout=ASYNC_POOL_COMMAND_TIMEOUT,
+            init=_init_connection,
+            **asyncpg_options(db_config)
+        )
+    return _pool
+
+def async_pool():
+    if _pool is None:
+        raise RuntimeError("The async database pool is not open; it is opened by asgi_app's lifespan")
+    return _pool
+
+async def close_async_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+def async_pool_metrics():
+    if _pool is None:
+        return None
+    return {'size': _pool.get_size(), 'idle': _pool.get_idle_size(), 'max_size': _pool.get_max_size()}
@@ -1,6 +1,254 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
 import psycopg2
+from psycopg2 import extensions, pool
 from config import DB_CONFIG, DB_CONFIG_mimic
 
+logger = logging.getLogger(__name__)
+
+# Pool sizing and health-check settings, overridable per deployment
+POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '1'))
+POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+POOL_CHECKOUT_TIMEOUT = float(os.getenv('DB_POOL_CHECKOUT_TIMEOUT', '30'))
+POOL_HEALTH_CHECK_INTERVAL = float(os.getenv('DB_POOL_HEALTH_CHECK_INTERVAL', '30'))
+
+POOL_CONFIGS = {
+    'mimic': DB_CONFIG_mimic,
+    'embed': DB_CONFIG,
+}
+
+
+class PoolTimeoutError(pool.PoolError):
+    pass
+
+
+class _CountingPool(pool.ThreadedConnectionPool):
+    def __init__(self, *args, **kwargs):
+        self.created = 0
+        super().__init__(*args, **kwargs)
+
+    def _connect(self, key=None):
+        conn = super()._connect(key)
+        self.created += 1
+        return conn
+
+
+class ConnectionPool:
+    def __init__(self, name, db_config, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+                 checkout_timeout=POOL_CHECKOUT_TIMEOUT, health_check_interval=POOL_HEALTH_CHECK_INTERVAL):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"Invalid pool size for '{name}': min={min_size}, max={max_size}")
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self._pool = _CountingPool(min_size, max_size, **db_config)
+        # ThreadedConnectionPool raises instead of waiting when exhausted, so
+        # bound checkouts with a semaphore and let callers queue up to a timeout
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._search_paths = {}
+        self._last_checked = {}
+        self._checkouts = 0
+        self._timeouts = 0
+        self._discarded = 0
+        self._health_check_failures = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def getconn(self, schema=None):
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            with self._lock:
+                self._timeouts += 1
+            raise PoolTimeoutError(f"Timed out waiting for a '{self.name}' connection")
+        try:
+            conn = self._checkout_healthy()
+            self._set_search_path(conn, schema)
+        except Exception:
+            self._slots.release()
+            raise
+
+        waited = time.monotonic() - start
+        with self._lock:
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def putconn(self, conn, discard=False):
+        try:
+            if not discard and not conn.closed:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+        except psycopg2.Error:
+            discard = True
+        try:
+            self._release(conn, discard or bool(conn.closed))
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self, schema=None):
+        conn = self.getconn(schema)
+        discard = False
+        try:
+            yield conn
+            conn.commit()
+        except Exception as e:
+            discard = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def check(self):
+        try:
+            with self.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                    cur.fetchone()
+            return True
+        except (Exception, psycopg2.Error) as error:
+            logger.warning("Health check failed for %r pool: %s", self.name, error)
+            return False
+
+    def metrics(self):
+        with self._lock:
+            checkouts = self._checkouts
+            return {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'in_use': len(self._pool._used),
+                'idle': len(self._pool._pool),
+                'created': self._pool.created,
+                'discarded': self._discarded,
+                'checkouts': checkouts,
+                'checkout_timeouts': self._timeouts,
+                'health_check_failures': self._health_check_failures,
+                'wait_seconds_total': self._wait_total,
+                'wait_seconds_avg': self._wait_total / checkouts if checkouts else 0.0,
+                'wait_seconds_max': self._wait_max,
+            }
+
+    def close(self):
+        self._pool.closeall()
+        with self._lock:
+            self._search_paths.clear()
+            self._last_checked.clear()
+
+    def _checkout_healthy(self):
+        # Retry once per slot so a pool full of dead connections can recover
+        for _ in range(self.max_size + 1):
+            conn = self._pool.getconn()
+            if self._is_healthy(conn):
+                return conn
+            with self._lock:
+                self._health_check_failures += 1
+            self._release(conn, discard=True)
+        raise pool.PoolError(f"Could not obtain a healthy '{self.name}' connection")
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            last_checked = self._last_checked.get(id(conn))
+        if last_checked is not None and now - last_checked < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        with self._lock:
+            self._last_checked[id(conn)] = now
+        return True
+
+    def _set_search_path(self, conn, schema):
+        # search_path is session state, so it only needs setting when this
+        # physical connection was last used with a different schema
+        if schema is None:
+            return
+        with self._lock:
+            current = self._search_paths.get(id(conn))
+        if current == schema:
+            return
+        with conn.cursor() as cur:
+            cur.execute("SELECT set_config('search_path', %s, false)", (schema,))
+        conn.commit()
+        with self._lock:
+            self._search_paths[id(conn)] = schema
+
+    def _release(self, conn, discard):
+        if discard:
+            with self._lock:
+                self._discarded += 1
+                self._search_paths.pop(id(conn), None)
+                self._last_checked.pop(id(conn), None)
+        else:
+            with self._lock:
+                self._last_checked[id(conn)] = time.monotonic()
+        self._pool.putconn(conn, close=discard)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(name='mimic'):
+    connection_pool = _pools.get(name)
+    if connection_pool is None:
+        with _pools_lock:
+            connection_pool = _pools.get(name)
+            if connection_pool is None:
+                connection_pool = ConnectionPool(name, POOL_CONFIGS[name])
+                _pools[name] = connection_pool
+    return connection_pool
+
+def mimic_connection(schema=None):
+    return get_pool('mimic').connection(schema)
+
+def mimic_hosp_connection():
+    return get_pool('mimic').connection('mimiciv_hosp')
+
+def mimic_icu_connection():
+    return get_pool('mimic').connection('mimiciv_icu')
+
+def mimic_clinical_connection():
+    # hosp and icu table names don't overlap, so one connection serves both
+    return get_pool('mimic').connection('mimiciv_hosp, mimiciv_icu')
+
+def embed_connection():
+    return get_pool('embed').connection()
+
+def check_pools(names=None):
+    results = {}
+    for name in names or list(_pools):
+        try:
+            results[name] = get_pool(name).check()
+        except (Exception, psycopg2.Error) as error:
+            logger.error("Could not create %r connection pool: %s", name, error)
+            results[name] = False
+    return results
+
+def pool_metrics():
+    return {name: connection_pool.metrics() for name, connection_pool in list(_pools.items())}
+
+def close_pools():
+    with _pools_lock:
+        for connection_pool in _pools.values():
+            connection_pool.close()
+        _pools.clear()
+
 def get_embed_connection():
     try:
         conn = psycopg2.connect(**DB_CONFIG)
@@ -42,4 +290,4 @@ def get_mimic_icu_connection():
         return conn
     except (Exception, psycopg2.Error) as error:
         print("Error while connecting to mimiciv_icu schema", error)
-        return None
\ No newline at end of file
+        return None
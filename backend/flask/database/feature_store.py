@@ -0,0 +1,310 @@
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+import pandas as pd
+import psycopg2
+from psycopg2 import pool, sql
+from database.connection import mimic_connection
+
+logger = logging.getLogger(__name__)
+
+FEATURE_STORE_ENABLED = os.getenv('FEATURE_STORE_ENABLED', '1') == '1'
+# How long a worker trusts its last "is the store built for this model" check
+FEATURE_STORE_STATE_TTL = float(os.getenv('FEATURE_STORE_STATE_TTL', '60'))
+
+SOURCE_VIEW = ('mimiciv_derived', 'patient_prediction_data')
+FEATURE_TABLE = ('patient_analysis', 'patient_features')
+STATE_TABLE = ('patient_analysis', 'feature_store_state')
+
+# Incremental refreshes look for admissions that started or ended after the
+# watermark, so both timestamps need an index
+FEATURE_STORE_INDEXES = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS admissions_admittime_idx ON mimiciv_hosp.admissions (admittime)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS admissions_dischtime_idx ON mimiciv_hosp.admissions (dischtime)",
+]
+
+def feature_set_hash(expected_features):
+    return hashlib.sha256('\n'.join(expected_features).encode('utf-8')).hexdigest()[:16]
+
+def _table(name):
+    return sql.Identifier(*name)
+
+def quote_ident(name):
+    # For SQL text handed to asyncpg, which has no psycopg2.sql composition
+    return '"' + name.replace('"', '""') + '"'
+
+
+class FeatureStore:
+    # One typed row per subject holding exactly the model's input columns, in
+    # training order, materialized from mimiciv_derived.patient_prediction_data.
+    # The table is tied to the feature list it was built for: a model with a
+    # different feature list sees the store as not ready and falls back.
+    def __init__(self, expected_features, state_ttl=FEATURE_STORE_STATE_TTL):
+        self.expected_features = list(expected_features)
+        self.feature_hash = feature_set_hash(self.expected_features)
+        self.state_ttl = state_ttl
+        self._lock = threading.Lock()
+        self._ready = None
+        self._checked_at = 0.0
+        self._counters = {'hits': 0, 'misses': 0, 'errors': 0}
+        columns = sql.SQL(', ').join(sql.Identifier(name) for name in self.expected_features)
+        self._lookup_sql = sql.SQL("SELECT subject_id, {} FROM {} WHERE subject_id = ANY(%s)").format(columns, _table(FEATURE_TABLE))
+        self._async_lookup_sql = "SELECT subject_id, {} FROM {} WHERE subject_id = ANY($1::bigint[])".format(
+            ', '.join(quote_ident(name) for name in self.expected_features),
+            '.'.join(quote_ident(part) for part in FEATURE_TABLE)
+        )
+
+    # Reads
+
+    def lookup(self, subject_ids):
+        # DataFrame with subject_id plus the expected feature columns for the
+        # ids that are materialized, or None when the store can't be used
+        if not self.ready():
+            return None
+        try:
+            with mimic_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(self._lookup_sql, ([int(subject_id) for subject_id in subject_ids],))
+                    rows = cursor.fetchall()
+        except (psycopg2.Error, pool.PoolError) as error:
+            logger.warning("Feature store lookup failed: %s", error)
+            self._count('errors')
+            self._invalidate_state()
+            return None
+        self._count('hits', len(rows))
+        self._count('misses', len(subject_ids) - len(rows))
+        return pd.DataFrame.from_records(rows, columns=['subject_id'] + self.expected_features, coerce_float=True)
+
+    async def alookup(self, subject_ids):
+        # lookup() for the ASGI app, over the asyncpg pool. The readiness
+        # check is rare (once per state_ttl) and stays on psycopg2 in a thread.
+        from database.async_connection import async_pool
+        if self._state_stale():
+            await asyncio.to_thread(self.ready)
+        if not self._ready:
+            return None
+        try:
+            rows = await async_pool().fetch(self._async_lookup_sql, [int(subject_id) for subject_id in subject_ids])
+        except Exception as error:
+            logger.warning("Feature store lookup failed: %s", error)
+            self._count('errors')
+            self._invalidate_state()
+            return None
+        self._count('hits', len(rows))
+        self._count('misses', len(subject_ids) - len(rows))
+        return pd.DataFrame.from_records([tuple(row) for row in rows], columns=['subject_id'] + self.expected_features,
+                                         coerce_float=True)
+
+    def ready(self):
+        now = time.monotonic()
+        if self._state_stale(now):
+            try:
+                state = self.state()
+                ready = state is not None and state['watermark'] is not None
+            except (psycopg2.Error, pool.PoolError) as error:
+                logger.warning("Feature store state check failed: %s", error)
+                ready = False
+            with self._lock:
+                self._ready = ready
+                self._checked_at = now
+        return self._ready
+
+    def state(self):
+        with mimic_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT to_regclass('patient_analysis.feature_store_state')")
+                if cursor.fetchone()[0] is None:
+                    return None
+                cursor.execute(
+                    sql.SQL("SELECT watermark, subjects, refreshed_at FROM {} WHERE feature_hash = %s").format(_table(STATE_TABLE)),
+                    (self.feature_hash,)
+                )
+                row = cursor.fetchone()
+        if row is None:
+            return None
+        return {'feature_hash': self.feature_hash, 'watermark': row[0], 'subjects': row[1], 'refreshed_at': row[2]}
+
+    def metrics(self):
+        with self._lock:
+            counters = dict(self._counters)
+        counters['ready'] = self._ready
+        counters['feature_hash'] = self.feature_hash
+        return counters
+
+    # Writes
+
+    def refresh(self, full=False):
+        # Upserts every subject with an admission that started or ended after
+        # the stored watermark (all subjects when full or never built), then
+        # moves the watermark, all in one REPEATABLE READ transaction so the
+        # watermark matches the rows that were read
+        with mimic_connection() as conn:
+            with conn.cursor() as cursor:
+                # Only applies to this transaction, the pooled session keeps its default
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                rebuilt = self._ensure_table(cursor, full)
+                watermark = None if rebuilt else self._watermark(cursor)
+                cursor.execute("SELECT max(greatest(admittime, dischtime)) FROM mimiciv_hosp.admissions")
+                new_watermark = cursor.fetchone()[0]
+                if watermark is None:
+                    cursor.execute(self._upsert_sql(cursor, changed_only=False))
+                else:
+                    cursor.execute(self._upsert_sql(cursor, changed_only=True), {'watermark': watermark})
+                refreshed = cursor.rowcount
+                cursor.execute(sql.SQL("SELECT count(*) FROM {}").format(_table(FEATURE_TABLE)))
+                subjects = cursor.fetchone()[0]
+                cursor.execute(sql.SQL("""
+                    INSERT INTO {} (feature_hash, watermark, subjects, refreshed_at)
+                    VALUES (%s, %s, %s, now())
+                    ON CONFLICT (feature_hash) DO UPDATE
+                    SET watermark = EXCLUDED.watermark, subjects = EXCLUDED.subjects, refreshed_at = EXCLUDED.refreshed_at
+                """).format(_table(STATE_TABLE)), (self.feature_hash, new_watermark, subjects))
+        self._invalidate_state()
+        return {'refreshed': refreshed, 'subjects': subjects, 'watermark': str(new_watermark), 'full': watermark is None}
+
+    def refresh_subjects(self, subject_ids):
+        # Re-materialize specific patients now, e.g. when told their data changed
+        if not self.ready():
+            return 0
+        with mimic_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(self._upsert_sql(cursor, subjects=True), {'subject_ids': [int(s) for s in subject_ids]})
+                return cursor.rowcount
+
+    def _ensure_table(self, cursor, rebuild):
+        # Returns True when the feature table was (re)created and is empty
+        cursor.execute("CREATE SCHEMA IF NOT EXISTS patient_analysis")
+        cursor.execute(sql.SQL("""
+            CREATE TABLE IF NOT EXISTS {} (
+                feature_hash TEXT PRIMARY KEY,
+                watermark TIMESTAMP,
+                subjects INTEGER,
+                refreshed_at TIMESTAMP
+            )
+        """).format(_table(STATE_TABLE)))
+        cursor.execute(sql.SQL("SELECT 1 FROM {} WHERE feature_hash = %s").format(_table(STATE_TABLE)), (self.feature_hash,))
+        built_for_this_model = cursor.fetchone() is not None
+        cursor.execute("SELECT to_regclass('patient_analysis.patient_features')")
+        exists = cursor.fetchone()[0] is not None
+        if exists and built_for_this_model and not rebuild:
+            return False
+
+        columns = sql.SQL(',\n').join(
+            sql.SQL("{} DOUBLE PRECISION").format(sql.Identifier(name)) for name in self.expected_features
+        )
+        cursor.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(_table(FEATURE_TABLE)))
+        cursor.execute(sql.SQL("""
+            CREATE TABLE {} (
+                subject_id BIGINT PRIMARY KEY,
+                {},
+                refreshed_at TIMESTAMP NOT NULL DEFAULT now()
+            )
+        """).format(_table(FEATURE_TABLE), columns))
+        # States for other feature lists no longer describe the table
+        cursor.execute(sql.SQL("DELETE FROM {}").format(_table(STATE_TABLE)))
+        return True
+
+    def _watermark(self, cursor):
+        cursor.execute(sql.SQL("SELECT watermark FROM {} WHERE feature_hash = %s").format(_table(STATE_TABLE)), (self.feature_hash,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def _source_types(self, cursor):
+        cursor.execute("""
+            SELECT column_name, data_type
+            FROM information_schema.columns
+            WHERE table_schema = %s AND table_name = %s
+        """, SOURCE_VIEW)
+        return dict(cursor.fetchall())
+
+    def _upsert_sql(self, cursor, changed_only=False, subjects=False):
+        # Features the view doesn't have are stored as NULL, which the
+        # model's imputer handles like any other missing value
+        types = self._source_types(cursor)
+        missing = [name for name in self.expected_features if name not in types]
+        if missing:
+            logger.warning("Feature store: %d expected features are not in the source view: %s", len(missing), missing[:10])
+        expressions = []
+        for name in self.expected_features:
+            data_type = types.get(name)
+            if data_type is None:
+                expressions.append(sql.SQL("NULL::double precision"))
+            elif data_type == 'boolean':
+                expressions.append(sql.SQL("p.{}::int::double precision").format(sql.Identifier(name)))
+            else:
+                expressions.append(sql.SQL("p.{}::double precision").format(sql.Identifier(name)))
+
+        if subjects:
+            source_filter = sql.SQL("WHERE p.subject_id = ANY(%(subject_ids)s)")
+        elif changed_only:
+            source_filter = sql.SQL("""
+                WHERE p.subject_id IN (
+                    SELECT subject_id FROM mimiciv_hosp.admissions WHERE admittime > %(watermark)s
+                    UNION
+                    SELECT subject_id FROM mimiciv_hosp.admissions WHERE dischtime > %(watermark)s
+                )
+            """)
+        else:
+            source_filter = sql.SQL("")
+
+        columns = sql.SQL(', ').join(sql.Identifier(name) for name in self.expected_features)
+        updates = sql.SQL(', ').join(
+            sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(name)) for name in self.expected_features
+        )
+        # DISTINCT ON keeps one row per subject if the view has several
+        return sql.SQL("""
+            INSERT INTO {table} (subject_id, {columns})
+            SELECT DISTINCT ON (p.subject_id) p.subject_id, {expressions}
+            FROM {view} p
+            {source_filter}
+            ORDER BY p.subject_id
+            ON CONFLICT (subject_id) DO UPDATE SET {updates}, refreshed_at = now()
+        """).format(
+            table=_table(FEATURE_TABLE), columns=columns, expressions=sql.SQL(', ').join(expressions),
+            view=_table(SOURCE_VIEW), source_filter=source_filter, updates=updates
+        )
+
+    def _state_stale(self, now=None):
+        now = time.monotonic() if now is None else now
+        return self._ready is None or now - self._checked_at > self.state_ttl
+
+    def _invalidate_state(self):
+        with self._lock:
+            self._ready = None
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+
+def create_feature_store_indexes():
+    with mimic_connection() as conn:
+        # CREATE INDEX CONCURRENTLY can't run inside a transaction block
+        conn.commit()
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                for statement in FEATURE_STORE_INDEXES:
+                    print(statement)
+                    cursor.execute(statement)
+        finally:
+            conn.autocommit = False
+
+if __name__ == "__main__":
+    # Run from backend/flask, e.g. every few minutes from cron:
+    #   python -m database.feature_store refresh
+    from model_bundle import load_model
+    parser = argparse.ArgumentParser(description="Materialize the model's feature vectors per subject")
+    parser.add_argument('command', choices=['refresh', 'indexes', 'state'])
+    parser.add_argument('--full', action='store_true', help="rebuild the table instead of refreshing since the watermark")
+    args = parser.parse_args()
+
+    if args.command == 'indexes':
+        create_feature_store_indexes()
+    else:
+        store = FeatureStore(load_model().expected_features)
+        print(store.refresh(full=args.full) if args.command == 'refresh' else store.state())
@@ -0,0 +1,84 @@
+import logging
+import os
+import threading
+import time
+from database.connection import mimic_connection
+
+logger = logging.getLogger(__name__)
+
+# How often a worker looks again for columns a migration hasn't added yet
+SCHEMA_RECHECK = float(os.getenv('SCHEMA_RECHECK', '60'))
+
+COLUMNS_QUERY = """
+    SELECT count(*)
+    FROM information_schema.columns
+    WHERE table_schema = %s AND table_name = %s AND column_name = ANY(%s)
+"""
+COLUMNS_QUERY_ASYNC = COLUMNS_QUERY.replace('%s', '$1', 1).replace('%s', '$2', 1).replace('%s', '$3::text[]', 1)
+
+
+class MissingColumnsError(RuntimeError):
+    pass
+
+
+def run_migration(statements):
+    # Schema changes are applied from the command line, never from a request
+    with mimic_connection() as conn:
+        # CREATE INDEX CONCURRENTLY can't run inside a transaction block
+        conn.commit()
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                for statement in statements:
+                    print(statement)
+                    cursor.execute(statement)
+        finally:
+            conn.autocommit = False
+
+def columns_present(table, columns):
+    with mimic_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(COLUMNS_QUERY, (*table, list(columns)))
+            return cursor.fetchone()[0] == len(columns)
+
+async def columns_present_async(table, columns):
+    from database.async_connection import async_pool
+    return await async_pool().fetchval(COLUMNS_QUERY_ASYNC, *table, list(columns)) == len(columns)
+
+
+class ColumnCheck:
+    # Read-only check that a migration's columns exist. Once present they
+    # stay, so only a missing result is looked at again, every `recheck`
+    # seconds.
+    def __init__(self, table, columns, hint, recheck=SCHEMA_RECHECK):
+        self.table = table
+        self.columns = list(columns)
+        self.hint = hint
+        self.recheck = recheck
+        self._lock = threading.Lock()
+        self._present = False
+        self._checked_at = None
+
+    def require(self):
+        if self._stale():
+            self._set_present(columns_present(self.table, self.columns))
+        if not self._present:
+            raise MissingColumnsError(self.hint)
+
+    async def arequire(self):
+        if self._stale():
+            self._set_present(await columns_present_async(self.table, self.columns))
+        if not self._present:
+            raise MissingColumnsError(self.hint)
+
+    def _stale(self):
+        if self._present:
+            return False
+        return self._checked_at is None or time.monotonic() - self._checked_at >= self.recheck
+
+    def _set_present(self, present):
+        with self._lock:
+            self._present = present
+            self._checked_at = time.monotonic()
+        if not present:
+            logger.error(self.hint)
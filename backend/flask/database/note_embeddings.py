@@ -0,0 +1,209 @@
+import argparse
+import io
+import json
+import os
+import re
+import time
+from database.connection import embed_connection
+
+# Must produce the 384 dimensions of the embedding vector(384) columns
+NOTE_EMBEDDING_MODEL = os.getenv('NOTE_EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+NOTE_EMBEDDING_DIMENSIONS = 384
+NOTE_EMBEDDING_BATCH_SIZE = int(os.getenv('NOTE_EMBEDDING_BATCH_SIZE', '256'))
+NOTE_EMBEDDING_ENCODE_BATCH_SIZE = int(os.getenv('NOTE_EMBEDDING_ENCODE_BATCH_SIZE', '32'))
+NOTE_EMBEDDING_CHECKPOINT = os.getenv(
+    'NOTE_EMBEDDING_CHECKPOINT',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'spill', 'note_embeddings_checkpoint.json')
+)
+NOTE_EXCERPT_CHARS = int(os.getenv('NOTE_EXCERPT_CHARS', '300'))
+NOTE_TABLES = ('discharge', 'radiology')
+
+# cosine distance (<=>) matches the normalized vectors written below
+NOTE_INDEX_DDL = {
+    'hnsw': "CREATE INDEX CONCURRENTLY IF NOT EXISTS {table}_embedding_hnsw_idx ON {table} "
+            "USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64)",
+    'ivfflat': "CREATE INDEX CONCURRENTLY IF NOT EXISTS {table}_embedding_ivfflat_idx ON {table} "
+               "USING ivfflat (embedding vector_cosine_ops) WITH (lists = {lists})",
+}
+NOTE_SUBJECT_INDEX_DDL = "CREATE INDEX CONCURRENTLY IF NOT EXISTS {table}_subject_id_idx ON {table} (subject_id)"
+
+
+def load_encoder(model_name=NOTE_EMBEDDING_MODEL):
+    # Imported here so the API side never loads torch just to run a query
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name, device='cpu')
+
+def read_checkpoint(path=NOTE_EMBEDDING_CHECKPOINT):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def write_checkpoint(checkpoint, path=NOTE_EMBEDDING_CHECKPOINT):
+    # Written to a temporary file first so a crash never leaves half a file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(temp_path, path)
+
+def vector_literal(values):
+    return '[' + ','.join(map(str, values)) + ']'
+
+def write_embeddings(conn, table, note_ids, vectors):
+    # COPY the batch into a session temp table, then one set-based UPDATE
+    buffer = io.StringIO()
+    for note_id, vector in zip(note_ids, vectors.tolist()):
+        buffer.write(f"{note_id}\t{vector_literal(vector)}\n")
+    buffer.seek(0)
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            CREATE TEMP TABLE IF NOT EXISTS note_embedding_batch (
+                note_id VARCHAR PRIMARY KEY,
+                embedding vector({NOTE_EMBEDDING_DIMENSIONS})
+            ) ON COMMIT DELETE ROWS
+        """)
+        cur.copy_expert("COPY note_embedding_batch (note_id, embedding) FROM STDIN", buffer)
+        cur.execute(f"""
+            UPDATE {table} n
+            SET embedding = b.embedding
+            FROM note_embedding_batch b
+            WHERE n.note_id = b.note_id
+        """)
+        return cur.rowcount
+
+def embed_table(table, encoder, batch_size=NOTE_EMBEDDING_BATCH_SIZE,
+                encode_batch_size=NOTE_EMBEDDING_ENCODE_BATCH_SIZE, checkpoint_path=NOTE_EMBEDDING_CHECKPOINT):
+    # Resumes after the last note_id recorded in the checkpoint file, which
+    # is only advanced once the batch before it is committed
+    checkpoint = read_checkpoint(checkpoint_path)
+    last_note_id = checkpoint.get(table, '')
+    total = 0
+    started = time.perf_counter()
+
+    with embed_connection() as read_conn:
+        # A named cursor keeps the result set on the server; rows arrive
+        # batch_size at a time instead of all at once
+        with read_conn.cursor(name=f"{table}_embedding_stream") as cur:
+            cur.itersize = batch_size
+            cur.execute(f"""
+                SELECT note_id, text
+                FROM {table}
+                WHERE note_id > %s AND embedding IS NULL AND text IS NOT NULL
+                ORDER BY note_id
+            """, (last_note_id,))
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                note_ids = [note_id for note_id, _ in rows]
+                vectors = encoder.encode(
+                    [text for _, text in rows],
+                    batch_size=encode_batch_size,
+                    convert_to_numpy=True,
+                    normalize_embeddings=True,
+                    show_progress_bar=False
+                )
+                with embed_connection() as write_conn:
+                    write_embeddings(write_conn, table, note_ids, vectors)
+                checkpoint[table] = note_ids[-1]
+                write_checkpoint(checkpoint, checkpoint_path)
+                total += len(rows)
+                elapsed = time.perf_counter() - started
+                print(f"{table}: {total} notes embedded ({total / elapsed:.1f} notes/s), last note_id {note_ids[-1]}")
+    return total
+
+def embed_notes(tables=NOTE_TABLES, reset=False, **options):
+    checkpoint_path = options.get('checkpoint_path', NOTE_EMBEDDING_CHECKPOINT)
+    if reset:
+        write_checkpoint({}, checkpoint_path)
+    encoder = load_encoder()
+    return {table: embed_table(table, encoder, **options) for table in tables}
+
+def create_note_indexes(method='hnsw', tables=NOTE_TABLES):
+    # Build after the bulk load: HNSW builds much faster in one pass, and
+    # IVFFlat needs the data to place its list centroids
+    with embed_connection() as conn:
+        # CREATE INDEX CONCURRENTLY can't run inside a transaction block
+        conn.commit()
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                for table in tables:
+                    statements = [NOTE_SUBJECT_INDEX_DDL.format(table=table)]
+                    if method == 'ivfflat':
+                        cur.execute(f"SELECT count(*) FROM {table} WHERE embedding IS NOT NULL")
+                        rows = cur.fetchone()[0]
+                        # pgvector's guidance: rows / 1000 lists up to 1M rows, sqrt(rows) beyond
+                        lists = max(1, rows // 1000 if rows <= 1000000 else int(rows ** 0.5))
+                        statements.append(NOTE_INDEX_DDL['ivfflat'].format(table=table, lists=lists))
+                    else:
+                        statements.append(NOTE_INDEX_DDL['hnsw'].format(table=table))
+                    for statement in statements:
+                        print(statement)
+                        cur.execute(statement)
+        finally:
+            conn.autocommit = False
+
+def similar_notes(subject_id, k=5, tables=NOTE_TABLES, excerpt_chars=NOTE_EXCERPT_CHARS):
+    # Notes of other patients closest to the centroid of this patient's own
+    # note embeddings. Returns [] when the patient has no embedded notes.
+    own_notes = " UNION ALL ".join(
+        f"SELECT embedding FROM {table} WHERE subject_id = %(subject_id)s AND embedding IS NOT NULL"
+        for table in tables
+    )
+    with embed_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT avg(embedding)::text FROM ({own_notes}) own", {'subject_id': subject_id})
+            query_vector = cur.fetchone()[0]
+            if query_vector is None:
+                return []
+            # Each table is ordered by distance to a constant vector on its
+            # own, so each branch can use that table's ANN index
+            nearest = " UNION ALL ".join(f"""
+                (SELECT '{table}' AS source, note_id, subject_id, note_type, charttime,
+                        left(text, %(excerpt_chars)s) AS excerpt, embedding <=> %(query)s::vector AS distance
+                 FROM {table}
+                 WHERE subject_id <> %(subject_id)s AND embedding IS NOT NULL
+                 ORDER BY embedding <=> %(query)s::vector
+                 LIMIT %(k)s)""" for table in tables)
+            cur.execute(f"SELECT * FROM ({nearest}) nearest ORDER BY distance LIMIT %(k)s", {
+                'subject_id': subject_id, 'query': query_vector, 'k': k, 'excerpt_chars': excerpt_chars
+            })
+            rows = cur.fetchall()
+    return [
+        {
+            'source': source,
+            'note_id': note_id,
+            'subject_id': note_subject_id,
+            'note_type': note_type,
+            'charttime': str(charttime),
+            'excerpt': re.sub(r'\s+', ' ', excerpt or '').strip(),
+            'distance': float(distance),
+        }
+        for source, note_id, note_subject_id, note_type, charttime, excerpt, distance in rows
+    ]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed discharge and radiology notes and query them")
+    commands = parser.add_subparsers(dest='command', required=True)
+    embed = commands.add_parser('embed', help="embed notes that have no embedding yet")
+    embed.add_argument('--tables', nargs='+', default=list(NOTE_TABLES), choices=NOTE_TABLES)
+    embed.add_argument('--batch-size', type=int, default=NOTE_EMBEDDING_BATCH_SIZE)
+    embed.add_argument('--reset', action='store_true', help="ignore the checkpoint and start from the first note_id")
+    index = commands.add_parser('index', help="build the ANN indexes")
+    index.add_argument('--method', choices=sorted(NOTE_INDEX_DDL), default='hnsw')
+    index.add_argument('--tables', nargs='+', default=list(NOTE_TABLES), choices=NOTE_TABLES)
+    similar = commands.add_parser('similar', help="print the notes most similar to a patient's")
+    similar.add_argument('subject_id', type=int)
+    similar.add_argument('-k', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.command == 'embed':
+        print(embed_notes(args.tables, reset=args.reset, batch_size=args.batch_size))
+    elif args.command == 'index':
+        create_note_indexes(args.method, args.tables)
+    else:
+        for note in similar_notes(args.subject_id, args.k):
+            print(f"{note['distance']:.4f} {note['source']} {note['note_id']} (subject {note['subject_id']}): {note['excerpt'][:120]}")
@@ -0,0 +1,323 @@
+from clinical_summary import (
+    CLINICAL_SUMMARY_MODE, CLINICAL_SUMMARY_WINDOW_HOURS, LAB_SUMMARY_MAX_ITEMS, VITAL_ITEMS, summarize_array_rows,
+)
+from database.connection import mimic_clinical_connection, get_mimic_connection, close_connection
+
+# All six slices of a patient's context in one statement. Each CTE folds its
+# rows into a JSON array, so the whole context comes back as a single row.
+# Timestamps are cast to text so they print exactly like datetime.__str__.
+# Labs and vitals come back in the shape CLINICAL_SUMMARY_MODE asks for.
+CONTEXT_QUERY_TEMPLATE = """
+    WITH admission AS (
+        SELECT json_build_array(admittime::text, dischtime::text, admission_type, admission_location,
+                                discharge_location, insurance, language, marital_status, race) AS row
+        FROM mimiciv_hosp.admissions
+        WHERE subject_id = %(subject_id)s
+        ORDER BY admittime DESC
+        LIMIT 1
+    ),
+    diagnoses AS (
+        SELECT json_agg(json_build_array(d.icd_code, di.long_title)) AS rows
+        FROM mimiciv_hosp.diagnoses_icd d
+        JOIN mimiciv_hosp.d_icd_diagnoses di ON d.icd_code = di.icd_code
+        WHERE d.subject_id = %(subject_id)s
+    ),
+    {labs},
+    medications AS (
+        SELECT json_agg(json_build_array(starttime::text, stoptime::text, drug, dose_val_rx, dose_unit_rx, route) ORDER BY starttime DESC) AS rows
+        FROM (
+            SELECT starttime, stoptime, drug, dose_val_rx, dose_unit_rx, route
+            FROM mimiciv_hosp.prescriptions
+            WHERE subject_id = %(subject_id)s
+            ORDER BY starttime DESC
+            LIMIT 20
+        ) latest
+    ),
+    icu_stay AS (
+        SELECT json_build_array(intime::text, outtime::text, los) AS row
+        FROM mimiciv_icu.icustays
+        WHERE subject_id = %(subject_id)s
+        ORDER BY intime DESC
+        LIMIT 1
+    ),
+    {vitals}
+    SELECT
+        (SELECT row FROM admission),
+        (SELECT rows FROM diagnoses),
+        (SELECT rows FROM labs),
+        (SELECT rows FROM medications),
+        (SELECT row FROM icu_stay),
+        (SELECT rows FROM vitals)
+"""
+
+VITAL_ITEM_IDS = ', '.join(str(itemid) for itemid in VITAL_ITEMS)
+
+RAW_LABS = """
+    labs AS (
+        SELECT json_agg(json_build_array(charttime::text, label, value, valuenum, valueuom, flag) ORDER BY charttime DESC) AS rows
+        FROM (
+            SELECT l.charttime, di.label, l.value, l.valuenum, l.valueuom, l.flag
+            FROM mimiciv_hosp.labevents l
+            JOIN mimiciv_hosp.d_labitems di ON l.itemid = di.itemid
+            WHERE l.subject_id = %(subject_id)s
+            ORDER BY l.charttime DESC
+            LIMIT 50
+        ) latest
+    )"""
+
+RAW_VITALS = f"""
+    vitals AS (
+        SELECT json_agg(json_build_array(charttime::text, valuenum, valueuom) ORDER BY charttime DESC) AS rows
+        FROM (
+            SELECT charttime, valuenum, valueuom
+            FROM mimiciv_icu.chartevents
+            WHERE subject_id = %(subject_id)s
+            AND itemid IN ({VITAL_ITEM_IDS})
+            ORDER BY charttime DESC
+            LIMIT 100
+        ) latest
+    )"""
+
+# The summary window ends at the patient's latest row, found through the
+# (subject_id, charttime DESC) indexes below
+LAB_WINDOW = f"""
+            WHERE l.subject_id = %(subject_id)s
+            AND l.charttime > (
+                SELECT max(charttime) FROM mimiciv_hosp.labevents WHERE subject_id = %(subject_id)s
+            ) - interval '{CLINICAL_SUMMARY_WINDOW_HOURS} hours'"""
+
+VITAL_RANGES = "vital_ranges (itemid, label, low, high) AS (VALUES {}),".format(
+    ', '.join(f"({itemid}, '{label}', {low}::double precision, {high}::double precision)"
+              for itemid, (label, low, high) in VITAL_ITEMS.items()))
+
+VITAL_WINDOW = f"""
+            FROM mimiciv_icu.chartevents c
+            JOIN vital_ranges r ON r.itemid = c.itemid
+            WHERE c.subject_id = %(subject_id)s
+            AND c.itemid IN ({VITAL_ITEM_IDS})
+            AND c.valuenum IS NOT NULL
+            AND c.charttime > (
+                SELECT max(charttime) FROM mimiciv_icu.chartevents
+                WHERE subject_id = %(subject_id)s AND itemid IN ({VITAL_ITEM_IDS})
+            ) - interval '{CLINICAL_SUMMARY_WINDOW_HOURS} hours'"""
+
+# One row per item in SUMMARY_FIELDS order; the slope is per hour
+SQL_LABS = f"""
+    labs AS (
+        SELECT json_agg(json_build_array(label, valueuom, n, min, max, mean, last, slope, abnormal, last_time::text)
+                        ORDER BY abnormal DESC, label) AS rows
+        FROM (
+            SELECT di.label, max(l.valueuom) AS valueuom, count(*) AS n,
+                   min(l.valuenum) AS min, max(l.valuenum) AS max, avg(l.valuenum) AS mean,
+                   (array_agg(l.value ORDER BY l.charttime DESC))[1] AS last,
+                   regr_slope(l.valuenum, extract(epoch FROM l.charttime)::double precision / 3600) AS slope,
+                   count(*) FILTER (WHERE l.flag = 'abnormal') AS abnormal,
+                   max(l.charttime) AS last_time
+            FROM mimiciv_hosp.labevents l
+            JOIN mimiciv_hosp.d_labitems di ON l.itemid = di.itemid{LAB_WINDOW}
+            GROUP BY l.itemid, di.label
+            ORDER BY abnormal DESC, di.label
+            LIMIT {LAB_SUMMARY_MAX_ITEMS}
+        ) items
+    )"""
+
+SQL_VITALS = f"""
+    {VITAL_RANGES}
+    vitals AS (
+        SELECT json_agg(json_build_array(label, valueuom, n, min, max, mean, last, slope, abnormal, last_time::text)
+                        ORDER BY label) AS rows
+        FROM (
+            SELECT r.label, max(c.valueuom) AS valueuom, count(*) AS n,
+                   min(c.valuenum) AS min, max(c.valuenum) AS max, avg(c.valuenum) AS mean,
+                   (array_agg(c.valuenum ORDER BY c.charttime DESC))[1] AS last,
+                   regr_slope(c.valuenum, extract(epoch FROM c.charttime)::double precision / 3600) AS slope,
+                   count(*) FILTER (WHERE c.valuenum < r.low OR c.valuenum > r.high) AS abnormal,
+                   max(c.charttime) AS last_time{VITAL_WINDOW}
+            GROUP BY r.itemid, r.label
+        ) items
+    )"""
+
+# Each item's values as arrays in chart order, for summarize_array_rows
+NUMPY_LABS = f"""
+    labs AS (
+        SELECT json_agg(json_build_array(label, valueuom, hours, vals, last, abnormal, NULL::double precision, NULL::double precision, last_time::text)
+                        ORDER BY abnormal DESC, label) AS rows
+        FROM (
+            SELECT di.label, max(l.valueuom) AS valueuom,
+                   array_agg(extract(epoch FROM l.charttime)::double precision / 3600 ORDER BY l.charttime) AS hours,
+                   array_agg(l.valuenum ORDER BY l.charttime) AS vals,
+                   (array_agg(l.value ORDER BY l.charttime DESC))[1] AS last,
+                   count(*) FILTER (WHERE l.flag = 'abnormal') AS abnormal,
+                   max(l.charttime) AS last_time
+            FROM mimiciv_hosp.labevents l
+            JOIN mimiciv_hosp.d_labitems di ON l.itemid = di.itemid{LAB_WINDOW}
+            GROUP BY l.itemid, di.label
+            ORDER BY abnormal DESC, di.label
+            LIMIT {LAB_SUMMARY_MAX_ITEMS}
+        ) items
+    )"""
+
+NUMPY_VITALS = f"""
+    {VITAL_RANGES}
+    vitals AS (
+        SELECT json_agg(json_build_array(label, valueuom, hours, vals, NULL::text, NULL::bigint, low, high, last_time::text)
+                        ORDER BY label) AS rows
+        FROM (
+            SELECT r.label, r.low, r.high, max(c.valueuom) AS valueuom,
+                   array_agg(extract(epoch FROM c.charttime)::double precision / 3600 ORDER BY c.charttime) AS hours,
+                   array_agg(c.valuenum ORDER BY c.charttime) AS vals,
+                   max(c.charttime) AS last_time{VITAL_WINDOW}
+            GROUP BY r.itemid, r.label, r.low, r.high
+        ) items
+    )"""
+
+# mode -> (query, context keys of the lab and vital slices)
+CONTEXT_QUERIES = {
+    'raw': (CONTEXT_QUERY_TEMPLATE.format(labs=RAW_LABS, vitals=RAW_VITALS), ('lab_events', 'icu_vitals')),
+    'sql': (CONTEXT_QUERY_TEMPLATE.format(labs=SQL_LABS, vitals=SQL_VITALS), ('lab_summary', 'vital_summary')),
+    'numpy': (CONTEXT_QUERY_TEMPLATE.format(labs=NUMPY_LABS, vitals=NUMPY_VITALS), ('lab_summary', 'vital_summary')),
+}
+if CLINICAL_SUMMARY_MODE not in CONTEXT_QUERIES:
+    raise ValueError(f"CLINICAL_SUMMARY_MODE must be one of {', '.join(CONTEXT_QUERIES)}")
+PATIENT_CONTEXT_QUERY = CONTEXT_QUERIES[CLINICAL_SUMMARY_MODE][0]
+
+# Supporting indexes for the per-subject "latest N rows" lookups above. They
+# are built CONCURRENTLY so they can be added to a live MIMIC database.
+PATIENT_CONTEXT_INDEXES = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS admissions_subject_admittime_idx ON mimiciv_hosp.admissions (subject_id, admittime DESC)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS diagnoses_icd_subject_idx ON mimiciv_hosp.diagnoses_icd (subject_id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS labevents_subject_charttime_idx ON mimiciv_hosp.labevents (subject_id, charttime DESC)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS prescriptions_subject_starttime_idx ON mimiciv_hosp.prescriptions (subject_id, starttime DESC)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS icustays_subject_intime_idx ON mimiciv_icu.icustays (subject_id, intime DESC)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS chartevents_subject_charttime_idx ON mimiciv_icu.chartevents (subject_id, charttime DESC)",
+]
+
+def _rows(value):
+    return [tuple(row) for row in value] if value else []
+
+SINGLE_ROW_SLICES = ('admission', 'icu_stay')
+
+def context_from_json(context):
+    # JSON has no tuples; restore the row shapes the prompt formatters unpack
+    return {
+        key: (tuple(value) if value else None) if key in SINGLE_ROW_SLICES else _rows(value)
+        for key, value in context.items()
+    }
+
+def context_from_row(row, mode=CLINICAL_SUMMARY_MODE):
+    admission, diagnoses, labs, medications, icu_stay, vitals = row
+    if mode == 'numpy':
+        labs, vitals = summarize_array_rows(labs or []), summarize_array_rows(vitals or [])
+    lab_key, vital_key = CONTEXT_QUERIES[mode][1]
+    return context_from_json({
+        'admission': admission,
+        'diagnoses': diagnoses,
+        lab_key: labs,
+        'medications': medications,
+        'icu_stay': icu_stay,
+        vital_key: vitals
+    })
+
+def fetch_patient_context(conn, subject_id, mode=CLINICAL_SUMMARY_MODE):
+    with conn.cursor() as cur:
+        cur.execute(CONTEXT_QUERIES[mode][0], {'subject_id': subject_id})
+        return context_from_row(cur.fetchone(), mode)
+
+def load_patient_context(subject_id):
+    with mimic_clinical_connection() as conn:
+        return fetch_patient_context(conn, subject_id)
+
+# The same statement for asyncpg, which numbers its parameters
+ASYNC_PATIENT_CONTEXT_QUERY = PATIENT_CONTEXT_QUERY.replace('%(subject_id)s', '$1::integer')
+
+async def aload_patient_context(subject_id):
+    from database.async_connection import async_pool
+    row = await async_pool().fetchrow(ASYNC_PATIENT_CONTEXT_QUERY, int(subject_id))
+    return context_from_row(tuple(row))
+
+def fetch_patient_context_sequential(conn, subject_id):
+    # The original six-query loader, kept as the baseline for benchmarks.
+    # Expects mimiciv_hosp and mimiciv_icu on the connection's search_path.
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT admittime, dischtime, admission_type, admission_location, discharge_location, insurance, language, marital_status, race
+            FROM admissions
+            WHERE subject_id = %s
+            ORDER BY admittime DESC
+            LIMIT 1
+        """, (subject_id,))
+        admission_data = cur.fetchone()
+
+        cur.execute("""
+            SELECT d.icd_code, di.long_title
+            FROM diagnoses_icd d
+            JOIN d_icd_diagnoses di ON d.icd_code = di.icd_code
+            WHERE d.subject_id = %s
+        """, (subject_id,))
+        diagnoses = cur.fetchall()
+
+        cur.execute("""
+            SELECT l.charttime, di.label, l.value, l.valuenum, l.valueuom, l.flag
+            FROM labevents l
+            JOIN d_labitems di ON l.itemid = di.itemid
+            WHERE l.subject_id = %s
+            ORDER BY l.charttime DESC
+            LIMIT 50
+        """, (subject_id,))
+        lab_events = cur.fetchall()
+
+        cur.execute("""
+            SELECT starttime, stoptime, drug, dose_val_rx, dose_unit_rx, route
+            FROM prescriptions
+            WHERE subject_id = %s
+            ORDER BY starttime DESC
+            LIMIT 20
+        """, (subject_id,))
+        medications = cur.fetchall()
+
+        cur.execute("""
+            SELECT intime, outtime, los
+            FROM icustays
+            WHERE subject_id = %s
+            ORDER BY intime DESC
+            LIMIT 1
+        """, (subject_id,))
+        icu_stay = cur.fetchone()
+
+        cur.execute("""
+            SELECT charttime, valuenum, valueuom
+            FROM chartevents
+            WHERE subject_id = %s
+            AND itemid IN (220045, 220050, 220051, 220052, 220179, 220210)
+            ORDER BY charttime DESC
+            LIMIT 100
+        """, (subject_id,))
+        icu_vitals = cur.fetchall()
+
+    return {
+        'admission': admission_data,
+        'diagnoses': diagnoses,
+        'lab_events': lab_events,
+        'medications': medications,
+        'icu_stay': icu_stay,
+        'icu_vitals': icu_vitals
+    }
+
+def create_patient_context_indexes(conn=None):
+    own_conn = conn is None
+    conn = conn or get_mimic_connection()
+    if not conn:
+        return
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction block
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            for statement in PATIENT_CONTEXT_INDEXES:
+                print(statement)
+                cur.execute(statement)
+    finally:
+        if own_conn:
+            close_connection(conn)
+
+if __name__ == "__main__":
+    create_patient_context_indexes()
@@ -0,0 +1,220 @@
+import argparse
+import json
+import logging
+import os
+import threading
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+import psycopg2
+from psycopg2 import pool, sql
+from psycopg2.extras import execute_values
+from database.connection import mimic_connection
+from database.migrations import ColumnCheck, MissingColumnsError, run_migration, columns_present
+
+logger = logging.getLogger(__name__)
+
+# Probability histogram resolution. Changing it needs a backfill, since
+# stored rows keep the bucket index they were counted under.
+ROLLUP_BUCKETS = int(os.getenv('ROLLUP_BUCKETS', '10'))
+ROLLUP_DEFAULT_DAYS = int(os.getenv('ROLLUP_DEFAULT_DAYS', '30'))
+
+SOURCE_TABLE = ('patient_analysis', 'risk_prediction')
+ROLLUP_TABLE = ('patient_analysis', 'risk_prediction_daily')
+
+# One row per day, risk level and probability bucket, so reads cost the
+# same however many predictions have been stored. Created from the command
+# line, never from a flush or a request:
+#   python -m database.rollups migrate
+ROLLUP_COLUMNS = ['day', 'risk_level', 'bucket', 'predictions', 'probability_sum']
+ROLLUP_MIGRATION = [
+    "SET lock_timeout = '5s'",
+    """CREATE TABLE IF NOT EXISTS patient_analysis.risk_prediction_daily (
+        day DATE NOT NULL,
+        risk_level VARCHAR(10) NOT NULL,
+        bucket SMALLINT NOT NULL,
+        predictions BIGINT NOT NULL,
+        probability_sum DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (day, risk_level, bucket)
+    )""",
+]
+MIGRATION_HINT = "risk_prediction_daily is missing, run `python -m database.rollups migrate` and then `backfill`"
+
+UPSERT_SQL = sql.SQL("""
+    INSERT INTO {table} AS r (day, risk_level, bucket, predictions, probability_sum) VALUES %s
+    ON CONFLICT (day, risk_level, bucket) DO UPDATE
+    SET predictions = r.predictions + EXCLUDED.predictions,
+        probability_sum = r.probability_sum + EXCLUDED.probability_sum
+""").format(table=sql.Identifier(*ROLLUP_TABLE))
+
+SUMMARY_SQL = sql.SQL("""
+    SELECT day, risk_level, bucket, predictions, probability_sum
+    FROM {}
+    WHERE day >= %s
+    ORDER BY day
+""").format(sql.Identifier(*ROLLUP_TABLE))
+
+# Same bucketing as bucket_of(), in SQL
+BACKFILL_SQL = sql.SQL("""
+    INSERT INTO {rollup} (day, risk_level, bucket, predictions, probability_sum)
+    SELECT timestamp::date, risk_level,
+           GREATEST(LEAST(FLOOR(probability * %(buckets)s)::int, %(buckets)s - 1), 0),
+           COUNT(*), SUM(probability)
+    FROM {source}
+    WHERE timestamp IS NOT NULL AND risk_level IS NOT NULL AND probability IS NOT NULL
+    GROUP BY 1, 2, 3
+""").format(rollup=sql.Identifier(*ROLLUP_TABLE), source=sql.Identifier(*SOURCE_TABLE))
+
+
+def bucket_of(probability, buckets=ROLLUP_BUCKETS):
+    return min(max(int(probability * buckets), 0), buckets - 1)
+
+def _as_day(timestamp):
+    # Rows replayed from the write-behind spill file carry their timestamp as text
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    return timestamp.date() if isinstance(timestamp, datetime) else timestamp
+
+def aggregate_rows(rows, columns, buckets=ROLLUP_BUCKETS):
+    # risk_prediction rows in buffer column order -> {(day, risk_level, bucket): [count, probability_sum]}
+    probability_at = columns.index('probability')
+    risk_level_at = columns.index('risk_level')
+    timestamp_at = columns.index('timestamp')
+    totals = defaultdict(lambda: [0, 0.0])
+    for row in rows:
+        probability, risk_level, timestamp = row[probability_at], row[risk_level_at], row[timestamp_at]
+        if probability is None or risk_level is None or timestamp is None:
+            continue
+        entry = totals[(_as_day(timestamp), risk_level, bucket_of(probability, buckets))]
+        entry[0] += 1
+        entry[1] += probability
+    return totals
+
+
+class PredictionRollup:
+    # Daily counts per risk level and probability bucket of what the service
+    # stores in risk_prediction. apply() runs inside each write-behind flush,
+    # so the counts commit or roll back together with the rows they count.
+    def __init__(self, buckets=ROLLUP_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._schema = ColumnCheck(ROLLUP_TABLE, ROLLUP_COLUMNS, MIGRATION_HINT)
+        self._counters = {'applied_rows': 0, 'upserted_cells': 0, 'skipped_rows': 0, 'failures': 0}
+
+    def apply(self, cursor, columns, rows):
+        totals = aggregate_rows(rows, columns, self.buckets)
+        if not totals:
+            return
+        try:
+            self._schema.require()
+        except MissingColumnsError:
+            # The backfill counts these once the table exists
+            self._count('skipped_rows', len(rows))
+            return
+        except (psycopg2.Error, pool.PoolError):
+            # The check uses its own connection; never fail the insert over it
+            self._count('failures')
+            return
+        # A savepoint keeps a rollup failure from losing the predictions
+        # themselves; the backfill brings the counts back in line
+        cursor.execute("SAVEPOINT prediction_rollup")
+        try:
+            execute_values(cursor, UPSERT_SQL, [key + tuple(value) for key, value in sorted(totals.items())],
+                           page_size=len(totals))
+        except psycopg2.Error as error:
+            cursor.execute("ROLLBACK TO SAVEPOINT prediction_rollup")
+            logger.error("Updating the prediction rollup failed, run the backfill to repair it: %s", error)
+            self._count('failures')
+            return
+        cursor.execute("RELEASE SAVEPOINT prediction_rollup")
+        self._count('applied_rows', len(rows))
+        self._count('upserted_cells', len(totals))
+
+    def summary(self, days=ROLLUP_DEFAULT_DAYS):
+        # Raises MissingColumnsError until the migration has run
+        self._schema.require()
+        since = date.today() - timedelta(days=days - 1)
+        with mimic_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(SUMMARY_SQL, (since,))
+                rows = cursor.fetchall()
+        return summarize(rows, since, self.buckets)
+
+    def backfill(self):
+        # Rebuilds the rollup from every stored prediction. SHARE mode on
+        # risk_prediction holds off write-behind flushes until the commit, so
+        # no row is counted twice or missed.
+        run_migration(ROLLUP_MIGRATION)
+        with mimic_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(sql.SQL("LOCK TABLE {} IN SHARE MODE").format(sql.Identifier(*SOURCE_TABLE)))
+                cursor.execute(sql.SQL("TRUNCATE {}").format(sql.Identifier(*ROLLUP_TABLE)))
+                cursor.execute(BACKFILL_SQL, {'buckets': self.buckets})
+                cells = cursor.rowcount
+                cursor.execute(sql.SQL("SELECT COALESCE(SUM(predictions), 0) FROM {}").format(sql.Identifier(*ROLLUP_TABLE)))
+                predictions = cursor.fetchone()[0]
+        return {'cells': cells, 'predictions': int(predictions)}
+
+    def metrics(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+
+def summarize(rows, since, buckets=ROLLUP_BUCKETS):
+    # Rollup rows -> the /cohort/summary response
+    by_risk_level = defaultdict(lambda: {'predictions': 0, 'probability_sum': 0.0})
+    daily = defaultdict(lambda: defaultdict(int))
+    histogram = [0] * buckets
+    total = 0
+    probability_sum = 0.0
+    for day, risk_level, bucket, predictions, bucket_probability_sum in rows:
+        by_risk_level[risk_level]['predictions'] += predictions
+        by_risk_level[risk_level]['probability_sum'] += bucket_probability_sum
+        daily[day][risk_level] += predictions
+        if 0 <= bucket < buckets:
+            histogram[bucket] += predictions
+        total += predictions
+        probability_sum += bucket_probability_sum
+
+    return {
+        'since': since.isoformat(),
+        'predictions': total,
+        'mean_probability': probability_sum / total if total else None,
+        'by_risk_level': {
+            risk_level: {
+                'predictions': entry['predictions'],
+                'mean_probability': entry['probability_sum'] / entry['predictions'] if entry['predictions'] else None,
+            }
+            for risk_level, entry in sorted(by_risk_level.items())
+        },
+        'daily': [
+            {'day': day.isoformat(), 'predictions': sum(levels.values()), 'by_risk_level': dict(levels)}
+            for day, levels in sorted(daily.items())
+        ],
+        'histogram': [
+            {'lower': i / buckets, 'upper': (i + 1) / buckets, 'predictions': count}
+            for i, count in enumerate(histogram)
+        ],
+    }
+
+
+if __name__ == "__main__":
+    # Run from backend/flask once after deploying, or whenever the rollup
+    # needs repairing. backfill runs the migration first.
+    #   python -m database.rollups migrate
+    #   python -m database.rollups backfill
+    parser = argparse.ArgumentParser(description="Daily risk_prediction rollups for /cohort/summary")
+    parser.add_argument('command', choices=['migrate', 'backfill', 'summary'])
+    parser.add_argument('--days', type=int, default=ROLLUP_DEFAULT_DAYS)
+    args = parser.parse_args()
+
+    rollup = PredictionRollup()
+    if args.command == 'migrate':
+        run_migration(ROLLUP_MIGRATION)
+        present = columns_present(ROLLUP_TABLE, ROLLUP_COLUMNS)
+        print("risk_prediction_daily is", "in place" if present else "missing")
+    else:
+        print(json.dumps(rollup.backfill() if args.command == 'backfill' else rollup.summary(args.days), indent=2))
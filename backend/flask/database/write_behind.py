@@ -0,0 +1,351 @@
+import atexit
+import fcntl
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+import psycopg2
+from psycopg2 import pool
+from psycopg2.extras import execute_values
+from database.connection import mimic_connection
+from metrics import WRITE_BEHIND_FLUSH_SECONDS, WRITE_BEHIND_ROWS
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', '500'))
+WRITE_BEHIND_MAX_AGE = float(os.getenv('WRITE_BEHIND_MAX_AGE', '1.0'))
+WRITE_BEHIND_MAX_QUEUE = int(os.getenv('WRITE_BEHIND_MAX_QUEUE', '50000'))
+# Spilled rows replayed per flush, in batches of WRITE_BEHIND_BATCH_SIZE
+WRITE_BEHIND_REPLAY_BATCHES = int(os.getenv('WRITE_BEHIND_REPLAY_BATCHES', '20'))
+WRITE_BEHIND_SPILL_DIR = os.getenv('WRITE_BEHIND_SPILL_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'spill'))
+
+# The database can't be reached: the rows are fine and replay from the spill
+# file later. Any other error is blamed on the rows themselves.
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, pool.PoolError)
+
+
+class WriteBehindBuffer:
+    def __init__(self, table, columns, connection_factory=mimic_connection, batch_size=WRITE_BEHIND_BATCH_SIZE,
+                 max_age=WRITE_BEHIND_MAX_AGE, max_queue=WRITE_BEHIND_MAX_QUEUE, spill_dir=WRITE_BEHIND_SPILL_DIR,
+                 on_write=None, replay_batches=WRITE_BEHIND_REPLAY_BATCHES):
+        self.table = table
+        self.columns = list(columns)
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.max_queue = max_queue
+        self.replay_batches = replay_batches
+        self.spill_path = os.path.join(spill_dir, f"{table}.jsonl")
+        # Rows the database refused, with the error, kept for someone to look at
+        self.reject_path = os.path.join(spill_dir, f"{table}.rejected.jsonl")
+        self._connection_factory = connection_factory
+        # Called as on_write(cursor, columns, rows) in the insert's transaction
+        self._on_write = on_write
+        self._insert_sql = f"INSERT INTO {table} ({', '.join(self.columns)}) VALUES %s"
+        self._reset_after_fork()
+        self._enqueued = 0
+        self._flushed_rows = 0
+        self._flushes = 0
+        self._flush_failures = 0
+        self._spilled_rows = 0
+        self._replayed_rows = 0
+        self._rejected_rows = 0
+        self._dropped_rows = 0
+        self._flush_seconds_total = 0.0
+        self._flush_seconds_last = 0.0
+        self._flush_seconds_max = 0.0
+
+    def _reset_after_fork(self):
+        # Threads and locks don't survive fork(), so every process gets its own
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._queue = deque()
+        self._oldest = None
+        self._stopping = False
+        self._thread = None
+
+    def enqueue(self, row):
+        self.enqueue_many([row])
+
+    def enqueue_many(self, rows):
+        rows = [tuple(row) for row in rows]
+        if not rows:
+            return
+        if self._pid != os.getpid():
+            self._reset_after_fork()
+        overflow = []
+        with self._cond:
+            self._ensure_thread()
+            was_empty = not self._queue
+            room = max(self.max_queue - len(self._queue), 0)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self._queue.extend(rows[:room])
+            overflow = rows[room:]
+            self._enqueued += len(rows)
+            # Wake the flusher so it can start the age timer or flush a full batch
+            if was_empty or len(self._queue) >= self.batch_size:
+                self._cond.notify()
+        if overflow:
+            # Queue is full, most likely because the database is down
+            try:
+                self._spill(overflow)
+            except Exception:
+                # Never fail the request that stored them
+                logger.exception("Spilling %d %s rows failed, dropping them", len(overflow), self.table)
+                self._dropped_rows += len(overflow)
+
+    def flush(self):
+        # Synchronously drain everything queued so far, e.g. at shutdown
+        while True:
+            batch = self._take_batch()
+            if not batch or not self._write(batch):
+                return
+
+    def close(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout=self.max_age + 5)
+        self.flush()
+
+    def metrics(self):
+        with self._cond:
+            queue_depth = len(self._queue)
+            oldest_age = time.monotonic() - self._oldest if self._oldest is not None else 0.0
+        return {
+            'queue_depth': queue_depth,
+            'oldest_row_age_seconds': oldest_age,
+            'enqueued_rows': self._enqueued,
+            'flushed_rows': self._flushed_rows,
+            'flushes': self._flushes,
+            'flush_failures': self._flush_failures,
+            'spilled_rows': self._spilled_rows,
+            'replayed_rows': self._replayed_rows,
+            'rejected_rows': self._rejected_rows,
+            'dropped_rows': self._dropped_rows,
+            'flush_seconds_total': self._flush_seconds_total,
+            'flush_seconds_last': self._flush_seconds_last,
+            'flush_seconds_max': self._flush_seconds_max,
+        }
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name=f"write-behind-{self.table}", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopping and not self._due():
+                    timeout = None
+                    if self._oldest is not None:
+                        timeout = max(self.max_age - (time.monotonic() - self._oldest), 0)
+                    self._cond.wait(timeout)
+                if self._stopping:
+                    return
+            batch = self._take_batch()
+            if batch and not self._write(batch):
+                # The batch is back on the queue; give the database or the
+                # disk a moment before trying it again
+                with self._cond:
+                    if not self._stopping:
+                        self._cond.wait(self.max_age)
+
+    def _due(self):
+        if not self._queue:
+            return False
+        return len(self._queue) >= self.batch_size or time.monotonic() - self._oldest >= self.max_age
+
+    def _take_batch(self):
+        with self._cond:
+            batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+            self._oldest = time.monotonic() if self._queue else None
+        return batch
+
+    def _write(self, batch):
+        # Returns False when the batch could be neither written nor spilled
+        # and went back on the queue. Never raises, so the flusher thread
+        # keeps draining whatever goes wrong.
+        with self._flush_lock:
+            start = time.monotonic()
+            try:
+                written, rejected = self._insert(batch)
+            except Exception as error:
+                # Rolled back, so nothing of the batch has been written
+                WRITE_BEHIND_FLUSH_SECONDS.observe(time.monotonic() - start, self.table, 'error')
+                self._flush_failures += 1
+                if isinstance(error, TRANSIENT_ERRORS):
+                    logger.warning("Write-behind flush to %s failed, spilling %d rows: %s", self.table, len(batch), error)
+                else:
+                    # Not the database refusing rows (an on_write hook, say),
+                    # so the rows are kept for replay
+                    logger.exception("Write-behind flush to %s failed, spilling %d rows", self.table, len(batch))
+                return self._spill_or_requeue(batch)
+            elapsed = time.monotonic() - start
+            WRITE_BEHIND_FLUSH_SECONDS.observe(elapsed, self.table, 'ok')
+            WRITE_BEHIND_ROWS.inc(self.table, amount=written)
+            self._flushes += 1
+            self._flushed_rows += written
+            self._flush_seconds_last = elapsed
+            self._flush_seconds_total += elapsed
+            self._flush_seconds_max = max(self._flush_seconds_max, elapsed)
+            try:
+                self._reject(rejected)
+                # The database is reachable again, so retry anything spilled earlier
+                self._replay_spill()
+            except Exception:
+                logger.exception("Write-behind bookkeeping for %s failed after a committed flush", self.table)
+            return True
+
+    def _spill_or_requeue(self, batch):
+        try:
+            self._spill(batch)
+            return True
+        except Exception:
+            logger.exception("Spilling %d %s rows failed, keeping them queued", len(batch), self.table)
+        with self._cond:
+            self._queue.extendleft(reversed(batch))
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+        return False
+
+    def _insert(self, rows):
+        # Returns (rows inserted, [(row, error)] refused). Raises
+        # TRANSIENT_ERRORS with nothing committed.
+        try:
+            with self._connection_factory() as conn:
+                with conn.cursor() as cursor:
+                    execute_values(cursor, self._insert_sql, rows, page_size=len(rows))
+                    if self._on_write is not None:
+                        self._on_write(cursor, self.columns, rows)
+            return len(rows), []
+        except TRANSIENT_ERRORS:
+            raise
+        except psycopg2.Error as error:
+            logger.warning("Write-behind insert into %s failed, retrying %d rows one at a time: %s", self.table, len(rows), error)
+        return self._insert_rows(rows)
+
+    def _insert_rows(self, rows):
+        # One savepoint per row, so a bad row is rolled back on its own and
+        # the rest still commit together
+        accepted, rejected = [], []
+        with self._connection_factory() as conn:
+            with conn.cursor() as cursor:
+                for row in rows:
+                    cursor.execute("SAVEPOINT write_behind_row")
+                    try:
+                        execute_values(cursor, self._insert_sql, [row])
+                    except TRANSIENT_ERRORS:
+                        raise
+                    except psycopg2.Error as error:
+                        cursor.execute("ROLLBACK TO SAVEPOINT write_behind_row")
+                        rejected.append((row, error))
+                        continue
+                    cursor.execute("RELEASE SAVEPOINT write_behind_row")
+                    accepted.append(row)
+                if accepted and self._on_write is not None:
+                    self._on_write(cursor, self.columns, accepted)
+        return len(accepted), rejected
+
+    def _spill(self, rows):
+        self._append(self.spill_path, [json.dumps(row, default=str) for row in rows])
+        self._spilled_rows += len(rows)
+
+    def _reject(self, rejected):
+        if not rejected:
+            return
+        logger.error("%d rows refused by %s, kept in %s", len(rejected), self.table, self.reject_path)
+        self._append(self.reject_path, [json.dumps({'row': row, 'error': str(error).strip()}, default=str)
+                                        for row, error in rejected])
+        self._rejected_rows += len(rejected)
+
+    def _append(self, path, lines):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a') as append_file:
+            fcntl.flock(append_file, fcntl.LOCK_EX)
+            try:
+                for line in lines:
+                    append_file.write(line + '\n')
+                append_file.flush()
+                os.fsync(append_file.fileno())
+            finally:
+                fcntl.flock(append_file, fcntl.LOCK_UN)
+
+    def _replay_spill(self):
+        if not os.path.exists(self.spill_path) or os.path.getsize(self.spill_path) == 0:
+            return
+        # The spill file is shared by every worker on this host, so hold the
+        # lock while replaying. At most replay_batches batches per flush, read
+        # from the head of the file one batch at a time, and each is dropped
+        # from the file as soon as it has committed.
+        with open(self.spill_path, 'r+b') as spill_file:
+            fcntl.flock(spill_file, fcntl.LOCK_EX)
+            try:
+                for _ in range(self.replay_batches):
+                    spill_file.seek(0)
+                    chunk = list(itertools.islice(spill_file, self.batch_size))
+                    if not chunk:
+                        break
+                    rows, unreadable = [], []
+                    for line in chunk:
+                        if not line.strip():
+                            continue
+                        try:
+                            rows.append(tuple(json.loads(line)))
+                        except ValueError as error:
+                            unreadable.append((line.decode(errors='replace').rstrip('\n'), error))
+                    try:
+                        replayed, rejected = self._insert(rows) if rows else (0, [])
+                    except TRANSIENT_ERRORS as error:
+                        logger.warning("Replaying spilled %s rows failed: %s", self.table, error)
+                        break
+                    except Exception:
+                        logger.exception("Replaying spilled %s rows failed, leaving them in %s", self.table, self.spill_path)
+                        break
+                    self._reject(unreadable + rejected)
+                    self._replayed_rows += replayed
+                    drop_head(spill_file, sum(len(line) for line in chunk))
+            finally:
+                fcntl.flock(spill_file, fcntl.LOCK_UN)
+
+
+def drop_head(spill_file, size, block_size=1 << 20):
+    # Moves everything after the first `size` bytes to the front of the file,
+    # a block at a time, so replay never holds the whole file in memory
+    read_at, write_at = size, 0
+    while True:
+        spill_file.seek(read_at)
+        block = spill_file.read(block_size)
+        if not block:
+            break
+        spill_file.seek(write_at)
+        spill_file.write(block)
+        read_at += len(block)
+        write_at += len(block)
+    spill_file.truncate(write_at)
+    spill_file.flush()
+    os.fsync(spill_file.fileno())
+
+_buffers = {}
+
+def register_buffer(table, columns, **kwargs):
+    buffer = WriteBehindBuffer(table, columns, **kwargs)
+    _buffers[table] = buffer
+    return buffer
+
+def flush_all_buffers():
+    for buffer in list(_buffers.values()):
+        try:
+            buffer.close()
+        except Exception:
+            logger.exception("Flushing the write-behind buffer for %s failed", buffer.table)
+
+def buffer_metrics():
+    return {table: buffer.metrics() for table, buffer in _buffers.items()}
+
+atexit.register(flush_all_buffers)
@@ -0,0 +1,34 @@
+# gunicorn -c gunicorn.conf.py backend:app   (run from backend/flask)
+import os
+import time
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.getenv('GUNICORN_WORKERS', '2'))
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+# LLM analyses and their SSE streams run for minutes, not seconds
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '300'))
+# With preload the app is imported once in the master and workers fork from it
+preload_app = os.getenv('GUNICORN_PRELOAD', '0') == '1'
+
+# Safe to build before fork and then share copy-on-write: plain numpy/sklearn
+# objects, no threads, sockets or gRPC channels
+PRELOAD_COMPONENTS = [name.strip() for name in os.getenv('PRELOAD_COMPONENTS', 'model').split(',') if name.strip()]
+
+
+def when_ready(server):
+    if preload_app and PRELOAD_COMPONENTS:
+        from lazy_init import warmup
+        report = warmup(PRELOAD_COMPONENTS)
+        server.log.info("Preloaded before fork: %s", report['components'])
+
+
+def post_fork(server, worker):
+    worker.boot_started = time.perf_counter()
+
+
+def post_worker_init(worker):
+    # Runs in the worker once the app is imported; warms up WARMUP_COMPONENTS
+    from lazy_init import record_phase, warmup
+    record_phase('app_import', time.perf_counter() - worker.boot_started)
+    report = warmup()
+    worker.log.info("Worker %s startup: phases=%s components=%s", worker.pid, report['phases'], report['components'])
@@ -0,0 +1,237 @@
+import argparse
+import logging
+import os
+import numpy as np
+from tree_ensemble import FlatTreeEnsemble
+
+logger = logging.getLogger(__name__)
+
+# 'compiled' runs the numpy fast path below, 'sklearn' the fitted objects as-is
+INFERENCE_ENGINE = os.getenv('INFERENCE_ENGINE', 'compiled')
+
+
+class NumericBlock:
+    # SimpleImputer followed by StandardScaler, as two vectors per column.
+    # Same float64 operations in the same order as sklearn, so same bits.
+    def __init__(self, positions, fill, mean, scale):
+        self.positions = positions
+        self.fill = fill
+        self.mean = mean
+        self.scale = scale
+        self.width = len(positions)
+
+    def transform(self, X):
+        # X: this block's columns, float64, a copy that may be modified
+        if np.isinf(X).any():
+            raise ValueError("Input contains infinity")
+        if self.fill is not None:
+            X = np.where(np.isnan(X), self.fill, X)
+        if self.mean is not None:
+            X -= self.mean
+        if self.scale is not None:
+            X /= self.scale
+        return X
+
+
+class OneHotBlock:
+    # Constant-imputed categorical columns expanded through a precomputed
+    # {category: output column} table per input column
+    def __init__(self, positions, fill_value, lookups, handle_unknown):
+        self.positions = positions
+        self.fill_value = fill_value
+        self.lookups = lookups
+        self.handle_unknown = handle_unknown
+        self.width = sum(len(lookup) for lookup in lookups)
+
+    def transform(self, raw):
+        # raw: this block's columns as an object array
+        out = np.zeros((raw.shape[0], self.width))
+        offset = 0
+        for column_values, lookup in zip(raw.T, self.lookups):
+            for row, value in enumerate(column_values):
+                if value is None or (isinstance(value, float) and np.isnan(value)):
+                    value = self.fill_value
+                column = lookup.get(value)
+                if column is None:
+                    if self.handle_unknown == 'error':
+                        raise ValueError(f"Found unknown category {value!r} during transform")
+                    continue
+                out[row, offset + column] = 1.0
+            offset += len(lookup)
+        return out
+
+
+def _compile_numeric(steps, positions):
+    fill = mean = scale = None
+    for step in steps:
+        kind = type(step).__name__
+        if kind == 'SimpleImputer' and fill is None and mean is None and scale is None:
+            if step.add_indicator or not (isinstance(step.missing_values, float) and np.isnan(step.missing_values)):
+                raise NotImplementedError("only SimpleImputer(missing_values=nan) without indicators is supported")
+            statistics = np.asarray(step.statistics_, dtype=np.float64)
+            if np.isnan(statistics).any() and not step.keep_empty_features:
+                raise NotImplementedError("SimpleImputer that drops all-missing columns is not supported")
+            fill = statistics
+        elif kind == 'StandardScaler' and mean is None and scale is None:
+            mean = np.asarray(step.mean_, dtype=np.float64) if step.with_mean else None
+            scale = np.asarray(step.scale_, dtype=np.float64) if step.with_std else None
+        else:
+            raise NotImplementedError(f"{kind} is not supported in a numeric pipeline")
+    return NumericBlock(positions, fill, mean, scale)
+
+def _compile_categorical(steps, positions):
+    fill_value = None
+    for step in steps[:-1]:
+        if type(step).__name__ != 'SimpleImputer' or step.strategy != 'constant':
+            raise NotImplementedError(f"{type(step).__name__} is not supported before OneHotEncoder")
+        fill_value = step.fill_value
+    encoder = steps[-1]
+    if type(encoder).__name__ != 'OneHotEncoder':
+        raise NotImplementedError("categorical columns must end in a OneHotEncoder")
+    if encoder.drop is not None or getattr(encoder, '_infrequent_enabled', False):
+        raise NotImplementedError("OneHotEncoder with drop or infrequent categories is not supported")
+    lookups = [{category: i for i, category in enumerate(categories)} for categories in encoder.categories_]
+    return OneHotBlock(positions, fill_value, lookups, encoder.handle_unknown)
+
+def _pipeline_steps(transformer):
+    steps = getattr(transformer, 'steps', None)
+    return [step for _, step in steps] if steps is not None else [transformer]
+
+
+class CompiledPipeline:
+    # The fitted ColumnTransformer + GradientBoostingClassifier reduced to
+    # numpy: input columns resolved to fixed positions once, imputation and
+    # scaling as per-column vectors, one-hot encoding as lookup tables, and
+    # the trees evaluated as flat arrays over the whole batch.
+    def __init__(self, input_columns, blocks, classifier):
+        self.input_columns = input_columns
+        self.blocks = blocks
+        self.classifier = classifier
+        self.n_outputs = sum(block.width for block in blocks)
+        self._numeric_only = all(isinstance(block, NumericBlock) for block in blocks)
+
+    @classmethod
+    def from_bundle(cls, bundle):
+        preprocessor = bundle.preprocessor
+        if type(preprocessor).__name__ != 'ColumnTransformer' or preprocessor.sparse_output_:
+            raise NotImplementedError("only a dense ColumnTransformer preprocessor is supported")
+        input_columns = list(preprocessor.feature_names_in_)
+        index = {column: i for i, column in enumerate(input_columns)}
+        blocks = []
+        for name, transformer, columns in preprocessor.transformers_:
+            if transformer == 'drop' or len(columns) == 0:
+                continue
+            if transformer == 'passthrough':
+                raise NotImplementedError("passthrough columns are not supported")
+            positions = np.array([index[column] for column in columns], dtype=np.intp)
+            steps = _pipeline_steps(transformer)
+            if type(steps[-1]).__name__ == 'OneHotEncoder':
+                blocks.append(_compile_categorical(steps, positions))
+            else:
+                blocks.append(_compile_numeric(steps, positions))
+
+        classifier = bundle.classifier
+        if getattr(classifier, 'ensemble', None) is None:
+            from model_artifact import FlatGradientBoostingClassifier
+            classifier = FlatGradientBoostingClassifier(
+                FlatTreeEnsemble.from_gradient_boosting(classifier),
+                np.asarray(classifier.classes_),
+                np.asarray(classifier.feature_importances_)
+            )
+        return cls(input_columns, blocks, classifier)
+
+    def transform(self, frame):
+        # Same matrix as preprocessor.transform(frame). Extra columns are
+        # ignored and order doesn't matter, as with the ColumnTransformer.
+        positions = frame.columns.get_indexer(self.input_columns)
+        if (positions < 0).any():
+            missing = [column for column, position in zip(self.input_columns, positions) if position < 0]
+            raise ValueError(f"columns are missing: {missing}")
+        selected = frame.iloc[:, positions]
+        if self._numeric_only:
+            return self.transform_array(selected.to_numpy(dtype=np.float64, na_value=np.nan))
+        return self._transform_blocks(selected.to_numpy(dtype=object), object_input=True)
+
+    def transform_array(self, values):
+        # values: array with columns in input_columns order, float or, when
+        # there are categorical columns, object (see SchemaAligner)
+        values = np.asarray(values)
+        if values.dtype == object:
+            return self._transform_blocks(values, object_input=True)
+        return self._transform_blocks(values.astype(np.float64, copy=False), object_input=False)
+
+    def _transform_blocks(self, values, object_input):
+        parts = []
+        for block in self.blocks:
+            # Fancy indexing copies, so blocks are free to work in place
+            columns = values[:, block.positions]
+            if isinstance(block, NumericBlock) and object_input:
+                columns = columns.astype(np.float64)
+            parts.append(block.transform(columns))
+        if len(parts) == 1:
+            return parts[0]
+        return np.hstack(parts) if parts else np.empty((values.shape[0], 0))
+
+    def predict_proba(self, features):
+        return self.classifier.predict_proba(features)
+
+    @property
+    def classes(self):
+        return self.classifier.classes_
+
+
+def compile_pipeline(bundle):
+    # Returns None when the engine is switched off or the pipeline uses a
+    # step the compiler doesn't know, so callers fall back to sklearn
+    if INFERENCE_ENGINE != 'compiled':
+        return None
+    try:
+        return CompiledPipeline.from_bundle(bundle)
+    except NotImplementedError as e:
+        logger.warning("Compiled inference disabled, using the sklearn pipeline: %s", e)
+        return None
+
+def verify_parity(bundle, n_rows=5000, seed=0, pipeline=None):
+    # predict_proba of the compiled path against the sklearn pipeline, on
+    # sampled rows with missing values, shuffled and extra columns, and a
+    # fully missing row. Returns True only if every value is bit-identical.
+    # The reference is loaded from the joblib file: a bundle from the
+    # artifact holds the flattened classifier, not sklearn's.
+    from model_artifact import sample_inputs
+    from model_bundle import load_pipeline
+    from schema_alignment import SchemaAligner
+    if pipeline is None:
+        pipeline = load_pipeline()
+    compiled = CompiledPipeline.from_bundle(bundle)
+    aligner = SchemaAligner.from_preprocessor(bundle.preprocessor)
+    frame = sample_inputs(bundle.preprocessor, n_rows, seed)
+    frame.iloc[0] = np.nan
+    rng = np.random.default_rng(seed)
+    frame = frame[list(rng.permutation(frame.columns))]
+    frame['subject_id'] = np.arange(len(frame))
+
+    expected_features = pipeline.named_steps['preprocessor'].transform(frame)
+    expected = pipeline.named_steps['classifier'].predict_proba(expected_features)
+    features = compiled.transform(frame)
+    actual = compiled.predict_proba(features)
+    aligned = compiled.transform_array(aligner.align(frame)[0])
+    one_by_one = np.vstack([compiled.predict_proba(compiled.transform(frame.iloc[[i]])) for i in range(min(200, len(frame)))])
+
+    identical = (
+        np.array_equal(expected_features, features)
+        and np.array_equal(expected_features, aligned)
+        and np.array_equal(expected, actual)
+        and np.array_equal(expected[:len(one_by_one)], one_by_one)
+    )
+    print(f"compiled vs sklearn on {len(frame)} rows: {'bit-identical' if identical else 'MISMATCH'} "
+          f"(max abs diff features {np.abs(expected_features - features).max():.3g}, "
+          f"probabilities {np.abs(expected - actual).max():.3g})")
+    return identical
+
+if __name__ == "__main__":
+    from model_bundle import load_model
+    parser = argparse.ArgumentParser(description="Check the compiled inference path against the sklearn pipeline")
+    parser.add_argument('--rows', type=int, default=5000)
+    args = parser.parse_args()
+    if not verify_parity(load_model(), args.rows):
+        raise SystemExit(1)
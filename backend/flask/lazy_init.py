@@ -0,0 +1,80 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Comma separated component names to build in warmup(), e.g. "model,attributor"
+WARMUP_COMPONENTS = os.getenv('WARMUP_COMPONENTS', 'model,compiled_pipeline,schema_aligner,schema')
+
+_components = {}
+_phases = {}
+
+
+class LazyComponent:
+    # A heavy object built on first get(), once per process. Concurrent first
+    # callers wait for the one build instead of each starting their own.
+    def __init__(self, name, factory):
+        self.name = name
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value = None
+        self._loaded = False
+        self.seconds = None
+        self.error = None
+        _components[name] = self
+
+    def get(self):
+        if self._loaded:
+            return self._value
+        with self._lock:
+            if not self._loaded:
+                start = time.perf_counter()
+                try:
+                    self._value = self._factory()
+                except Exception as e:
+                    # Not cached: the next caller retries the build
+                    self.error = str(e)
+                    raise
+                self.seconds = time.perf_counter() - start
+                self.error = None
+                self._loaded = True
+                logger.info("Loaded %s in %.2fs (pid %d)", self.name, self.seconds, os.getpid())
+        return self._value
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def status(self):
+        return {'loaded': self._loaded, 'seconds': self.seconds, 'error': self.error}
+
+
+def record_phase(name, seconds):
+    # Startup steps that aren't lazy components, such as importing the app
+    _phases[name] = seconds
+
+def warmup(names=None):
+    # Builds the named components now rather than on the first request.
+    # Meant for gunicorn's post_fork/post_worker_init, after the fork, since
+    # some clients (gRPC for Gemini) don't survive one.
+    if names is None:
+        names = [name.strip() for name in WARMUP_COMPONENTS.split(',') if name.strip()]
+    for name in names:
+        component = _components.get(name)
+        if component is None:
+            logger.warning("Unknown warmup component %r, known: %s", name, sorted(_components))
+            continue
+        try:
+            component.get()
+        except Exception as e:
+            logger.exception("Warmup of %s failed", name)
+    return startup_report()
+
+def startup_report():
+    return {
+        'pid': os.getpid(),
+        'phases': dict(_phases),
+        'components': {name: component.status() for name, component in _components.items()}
+    }
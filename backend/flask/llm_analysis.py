@@ -1,246 +1,405 @@
 import os
-import time
 import asyncio
+import hashlib
+import logging
+import math
+import random
+import threading
+import time
+from collections import OrderedDict
 from dotenv import load_dotenv
-from functools import lru_cache
-from langchain.prompts import PromptTemplate
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain.memory import ConversationBufferMemory
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.vectorstores import FAISS
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.chains import ConversationChain
-from database.connection import get_mimic_hosp_connection, get_mimic_icu_connection, close_connection
-import google.generativeai as genai
-from cachetools import TTLCache
+from database.patient_context import load_patient_context, context_from_json
+from clinical_summary import CLINICAL_SUMMARY_MODE, format_summary
+from database.note_embeddings import similar_notes
+from patient_cache import create_patient_cache
+from llm_executor import BackgroundLoop, AsyncRateLimiter
+from lazy_init import LazyComponent
+from metrics import STAGE_SECONDS, LLM_ATTEMPT_SECONDS, LLM_CALL_SECONDS, LLM_RETRIES
+from response_parser import ResponseParser
+from patient_retrieval import create_cached_embeddings, build_vector_store, patient_chunks, PatientRetriever
 
 # Load environment variables
 load_dotenv()
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
-if not GEMINI_API_KEY:
-    raise ValueError("GEMINI_API_KEY not found in environment variables")
-genai.configure(api_key=GEMINI_API_KEY)
-
-# Initialize LangChain components
-llm = ChatGoogleGenerativeAI(model="gemini-pro", temperature=0, google_api_key=GEMINI_API_KEY)
-embeddings = HuggingFaceEmbeddings()
-memory = ConversationBufferMemory()
-
-# Create a conversation chain
-conversation = ConversationChain(
-    llm=llm,
-    memory=memory,
-    verbose=True
-)
-
-# Create a cache for patient analysis results
-patient_analysis_cache = TTLCache(maxsize=100, ttl=3600)  # Cache for 1 hour
-
-# Create a global event loop
-loop = asyncio.new_event_loop()
-asyncio.set_event_loop(loop)
-
-@lru_cache(maxsize=100)
-def get_patient_data(subject_id):
-    hosp_conn = get_mimic_hosp_connection()
-    icu_conn = get_mimic_icu_connection()
-    
-    if not hosp_conn or not icu_conn:
-        raise ConnectionError("Could not connect to one or both databases")
-    
-    try:
-        with hosp_conn.cursor() as hosp_cur, icu_conn.cursor() as icu_cur:
-            # Fetch admission data
-            hosp_cur.execute("""
-                SELECT admittime, dischtime, admission_type, admission_location, discharge_location, insurance, language, marital_status, race
-                FROM admissions
-                WHERE subject_id = %s
-                ORDER BY admittime DESC
-                LIMIT 1
-            """, (subject_id,))
-            admission_data = hosp_cur.fetchone()
-
-            # Fetch diagnosis data
-            hosp_cur.execute("""
-                SELECT d.icd_code, di.long_title
-                FROM diagnoses_icd d
-                JOIN d_icd_diagnoses di ON d.icd_code = di.icd_code
-                WHERE d.subject_id = %s
-            """, (subject_id,))
-            diagnoses = hosp_cur.fetchall()
-
-            # Fetch lab events
-            hosp_cur.execute("""
-                SELECT l.charttime, di.label, l.value, l.valuenum, l.valueuom, l.flag
-                FROM labevents l
-                JOIN d_labitems di ON l.itemid = di.itemid
-                WHERE l.subject_id = %s
-                ORDER BY l.charttime DESC
-                LIMIT 50
-            """, (subject_id,))
-            lab_events = hosp_cur.fetchall()
-
-            # Fetch medication data
-            hosp_cur.execute("""
-                SELECT starttime, stoptime, drug, dose_val_rx, dose_unit_rx, route
-                FROM prescriptions
-                WHERE subject_id = %s
-                ORDER BY starttime DESC
-                LIMIT 20
-            """, (subject_id,))
-            medications = hosp_cur.fetchall()
-
-            # Fetch ICU stay data
-            icu_cur.execute("""
-                SELECT intime, outtime, los
-                FROM icustays
-                WHERE subject_id = %s
-                ORDER BY intime DESC
-                LIMIT 1
-            """, (subject_id,))
-            icu_stay = icu_cur.fetchone()
-
-            # Fetch vital signs from ICU
-            icu_cur.execute("""
-                SELECT charttime, valuenum, valueuom
-                FROM chartevents
-                WHERE subject_id = %s
-                AND itemid IN (
-                    220045, -- Heart Rate
-                    220050, -- Arterial Blood Pressure systolic
-                    220051, -- Arterial Blood Pressure diastolic
-                    220052, -- Arterial Blood Pressure mean
-                    220179, -- Temperature
-                    220210  -- Respiratory Rate
+LLM_MODEL_NAME = "gemini-pro"
+
+def create_llm():
+    # The Gemini and LangChain imports alone take seconds, so they wait for
+    # the first LLM request; /predict-only workers never pay for them
+    if not GEMINI_API_KEY:
+        raise ValueError("GEMINI_API_KEY not found in environment variables")
+    import google.generativeai as genai
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    genai.configure(api_key=GEMINI_API_KEY)
+    return ChatGoogleGenerativeAI(model=LLM_MODEL_NAME, temperature=0, google_api_key=GEMINI_API_KEY)
+
+llm = LazyComponent('llm', create_llm)
+embeddings = LazyComponent('embeddings', create_cached_embeddings)
+
+logger = logging.getLogger(__name__)
+
+# 'stateless' sends only the current prompt. 'per_subject' keeps a short,
+# bounded conversation per patient so context never crosses patients.
+LLM_CONVERSATION_MODE = os.getenv('LLM_CONVERSATION_MODE', 'stateless')
+LLM_MEMORY_MAX_SUBJECTS = int(os.getenv('LLM_MEMORY_MAX_SUBJECTS', '100'))
+LLM_MEMORY_WINDOW = int(os.getenv('LLM_MEMORY_WINDOW', '3'))
+
+
+class SubjectConversations:
+    def __init__(self, max_subjects=LLM_MEMORY_MAX_SUBJECTS, window=LLM_MEMORY_WINDOW):
+        self.max_subjects = max_subjects
+        self.window = window
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, subject_id):
+        key = str(subject_id)
+        with self._lock:
+            conversation = self._conversations.get(key)
+            if conversation is None:
+                from langchain.chains import ConversationChain
+                from langchain.memory import ConversationBufferWindowMemory
+                conversation = ConversationChain(
+                    llm=llm.get(),
+                    memory=ConversationBufferWindowMemory(k=self.window),
+                    verbose=False
                 )
-                ORDER BY charttime DESC
-                LIMIT 100
-            """, (subject_id,))
-            icu_vitals = icu_cur.fetchall()
-
-        return {
-            'admission': admission_data,
-            'diagnoses': diagnoses,
-            'lab_events': lab_events,
-            'medications': medications,
-            'icu_stay': icu_stay,
-            'icu_vitals': icu_vitals
-        }
-    finally:
-        close_connection(hosp_conn)
-        close_connection(icu_conn)
+                self._conversations[key] = conversation
+                if len(self._conversations) > self.max_subjects:
+                    self._conversations.popitem(last=False)
+                    self.evictions += 1
+            else:
+                self._conversations.move_to_end(key)
+            return conversation
+
+    def forget(self, subject_id):
+        with self._lock:
+            self._conversations.pop(str(subject_id), None)
+
+
+subject_conversations = SubjectConversations()
+
+# Running totals so the prompt-size saving is visible without log scraping
+prompt_token_stats = {'calls': 0, 'prompt_tokens': 0, 'response_tokens': 0}
+
+def estimate_tokens(text):
+    # Gemini's tokenizer needs an API round trip; ~4 characters per token is
+    # close enough to track prompt growth
+    return math.ceil(len(text) / 4)
+
+# LLM calls from every request run on one shared event loop thread, so the
+# limiter below applies across all concurrent requests in this process
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '6'))
+LLM_RATE_PER_SECOND = float(os.getenv('LLM_RATE_PER_SECOND', '1'))
+LLM_RATE_BURST = float(os.getenv('LLM_RATE_BURST', '6'))
+LLM_CALL_TIMEOUT = float(os.getenv('LLM_CALL_TIMEOUT', '60'))
+LLM_ANALYSIS_TIMEOUT = float(os.getenv('LLM_ANALYSIS_TIMEOUT', '300'))
+LLM_STREAM_IDLE_TIMEOUT = float(os.getenv('LLM_STREAM_IDLE_TIMEOUT', '30'))
+LLM_STREAM_QUEUE_SIZE = int(os.getenv('LLM_STREAM_QUEUE_SIZE', '256'))
+LLM_MAX_RETRIES = 5
+LLM_BASE_DELAY = 2
+
+background_loop = BackgroundLoop()
+llm_limiter = AsyncRateLimiter(LLM_RATE_PER_SECOND, LLM_RATE_BURST, LLM_MAX_CONCURRENCY)
+
+# TTL- and size-bounded, invalidatable, optionally shared between workers
+patient_context_cache = create_patient_cache(decoder=context_from_json)
+
+def get_patient_data(subject_id):
+    # One round trip on one pooled connection for all six context slices
+    with STAGE_SECONDS.time('patient_context'):
+        return patient_context_cache.get_or_load(subject_id, timed_load_patient_context)
+
+def timed_load_patient_context(subject_id):
+    # Only runs on a cache miss, so this is the query time on its own
+    with STAGE_SECONDS.time('patient_context_query'):
+        return load_patient_context(subject_id)
+
+def invalidate_patient(subject_id):
+    # Call when new admissions, labs or vitals land for this patient
+    # Stored analyses need no invalidation: new data changes the content hash
+    patient_context_cache.invalidate(subject_id)
 
 def create_vector_store(patient_data):
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
-    texts = []
-    metadatas = []
-
-    # Process admission data
-    admission_text = f"Admission: {patient_data['admission']}"
-    chunks = text_splitter.split_text(admission_text)
-    texts.extend(chunks)
-    metadatas.extend([{"source": "admission"}] * len(chunks))
-
-    # Process diagnoses
-    diagnoses_text = "Diagnoses: " + "; ".join([f"{code}: {title}" for code, title in patient_data['diagnoses']])
-    chunks = text_splitter.split_text(diagnoses_text)
-    texts.extend(chunks)
-    metadatas.extend([{"source": "diagnoses"}] * len(chunks))
-
-    # Process lab events
-    lab_text = "Lab Events: " + "; ".join([f"{label}: {value} {valueuom} ({flag})" for _, label, value, _, valueuom, flag in patient_data['lab_events']])
-    chunks = text_splitter.split_text(lab_text)
-    texts.extend(chunks)
-    metadatas.extend([{"source": "lab_events"}] * len(chunks))
-
-    # Process medications
-    med_text = "Medications: " + "; ".join([f"{drug} {dose_val_rx} {dose_unit_rx} {route}" for _, _, drug, dose_val_rx, dose_unit_rx, route in patient_data['medications']])
-    chunks = text_splitter.split_text(med_text)
-    texts.extend(chunks)
-    metadatas.extend([{"source": "medications"}] * len(chunks))
-
-    # Process ICU stay
-    if patient_data['icu_stay']:
-        icu_text = f"ICU Stay: Intime: {patient_data['icu_stay'][0]}, Outtime: {patient_data['icu_stay'][1]}, LOS: {patient_data['icu_stay'][2]}"
-        chunks = text_splitter.split_text(icu_text)
-        texts.extend(chunks)
-        metadatas.extend([{"source": "icu_stay"}] * len(chunks))
-
-    # Process ICU vitals
-    icu_vitals_text = "ICU Vitals: " + "; ".join([f"{charttime}: {valuenum} {valueuom}" for charttime, valuenum, valueuom in patient_data['icu_vitals']])
-    chunks = text_splitter.split_text(icu_vitals_text)
-    texts.extend(chunks)
-    metadatas.extend([{"source": "icu_vitals"}] * len(chunks))
-
-    return FAISS.from_texts(texts, embeddings, metadatas=metadatas)
-
-def format_patient_data(patient_data):
+    # One document per context row, ids are the row hashes
+    return build_vector_store(patient_chunks(patient_data).values(), embeddings.get())
+
+# Raw lab and vital rows only reach the prompt in the 'raw' summary mode,
+# kept as the benchmark baseline, and then only the latest few
+LLM_RAW_ROWS_MAX = int(os.getenv('LLM_RAW_ROWS_MAX', '5'))
+RAW_SLICES = ('lab_events', 'icu_vitals')
+
+def format_patient_data(patient_data, mode=CLINICAL_SUMMARY_MODE):
     formatted = []
     for key, value in patient_data.items():
+        if value is None:
+            # No admission or ICU stay on record
+            continue
+        if key in RAW_SLICES:
+            if mode != 'raw':
+                continue
+            value = value[:LLM_RAW_ROWS_MAX]
         if key == 'admission':
             formatted.append(f"Admission: {', '.join(map(str, value))}")
         elif key == 'diagnoses':
             formatted.append("Diagnoses: " + "; ".join([f"{code}: {title}" for code, title in value]))
         elif key == 'lab_events':
-            formatted.append("Lab Events: " + "; ".join([f"{label}: {value} {valueuom} ({flag})" for _, label, value, _, valueuom, flag in value[:5]]))  # Limit to 5 for brevity
+            formatted.append("Lab Events: " + "; ".join([f"{label}: {value} {valueuom} ({flag})" for _, label, value, _, valueuom, flag in value]))
+        elif key == 'lab_summary':
+            formatted.append(format_summary("Lab Trends", value))
         elif key == 'medications':
             formatted.append("Medications: " + "; ".join([f"{drug} {dose_val_rx} {dose_unit_rx} {route}" for _, _, drug, dose_val_rx, dose_unit_rx, route in value[:5]]))  # Limit to 5 for brevity
         elif key == 'icu_stay':
             formatted.append(f"ICU Stay: Intime: {value[0]}, Outtime: {value[1]}, LOS: {value[2]}")
         elif key == 'icu_vitals':
-            formatted.append("ICU Vitals: " + "; ".join([f"{charttime}: {valuenum} {valueuom}" for charttime, valuenum, valueuom in value[:5]]))  # Limit to 5 for brevity
+            formatted.append("ICU Vitals: " + "; ".join([f"{charttime}: {valuenum} {valueuom}" for charttime, valuenum, valueuom in value]))
+        elif key == 'vital_summary':
+            formatted.append(format_summary("ICU Vital Trends", value))
     return "\n".join(formatted)
 
-def rate_limited_predict(prompt_input):
-    max_retries = 5
-    base_delay = 2
-    for attempt in range(max_retries):
+# 'truncated' shows every prompt the first rows of each slice. 'retrieval'
+# shows each prompt the rows most relevant to it, within RAG_TOKEN_BUDGET.
+LLM_CONTEXT_MODE = os.getenv('LLM_CONTEXT_MODE', 'truncated')
+patient_retriever = LazyComponent('patient_retriever', lambda: PatientRetriever(embeddings.get()))
+# Number of similar discharge/radiology notes from other patients to add, 0 for none
+LLM_SIMILAR_NOTES = int(os.getenv('LLM_SIMILAR_NOTES', '0'))
+
+def format_similar_notes(subject_id):
+    try:
+        notes = similar_notes(subject_id, LLM_SIMILAR_NOTES)
+    except Exception as e:
+        logger.warning("Similar note lookup failed for subject %s: %s", subject_id, e)
+        return ""
+    if not notes:
+        return ""
+    return "Similar Patient Notes: " + "; ".join(f"{note['note_type']} ({note['charttime']}): {note['excerpt']}" for note in notes)
+
+def format_patient_context(subject_id, patient_data):
+    # Returns one string shared by all prompts, or {prompt name: string}
+    formatted = None
+    if LLM_CONTEXT_MODE == 'retrieval':
         try:
-            return conversation.predict(input=prompt_input)
+            formatted = patient_retriever.get().prompt_contexts(subject_id, patient_data, estimate_tokens)
         except Exception as e:
-            if attempt == max_retries - 1:
+            logger.warning("Retrieval failed for subject %s, using truncated context: %s", subject_id, e)
+    if formatted is None:
+        formatted = format_patient_data(patient_data)
+
+    notes = format_similar_notes(subject_id) if LLM_SIMILAR_NOTES > 0 else ""
+    if notes:
+        if isinstance(formatted, str):
+            formatted = f"{formatted}\n{notes}"
+        else:
+            formatted = {name: f"{context}\n{notes}" for name, context in formatted.items()}
+    return formatted
+
+async def predict_once(prompt_input, subject_id=None):
+    if LLM_CONVERSATION_MODE == 'per_subject' and subject_id is not None:
+        conversation = subject_conversations.get(subject_id)
+        return await conversation.apredict(input=prompt_input)
+    response = await llm.get().ainvoke(prompt_input)
+    return response.content
+
+async def rate_limited_predict(prompt_input, subject_id=None, prompt_name=None):
+    with LLM_CALL_SECONDS.time(prompt_name, 'invoke'):
+        return await _rate_limited_predict(prompt_input, subject_id, prompt_name)
+
+async def _rate_limited_predict(prompt_input, subject_id, prompt_name):
+    prompt_tokens = estimate_tokens(prompt_input)
+    for attempt in range(LLM_MAX_RETRIES):
+        try:
+            async with llm_limiter:
+                started = time.perf_counter()
+                try:
+                    result = await asyncio.wait_for(predict_once(prompt_input, subject_id), timeout=LLM_CALL_TIMEOUT)
+                except Exception:
+                    LLM_ATTEMPT_SECONDS.observe(time.perf_counter() - started, prompt_name, 'invoke', 'error')
+                    raise
+                LLM_ATTEMPT_SECONDS.observe(time.perf_counter() - started, prompt_name, 'invoke', 'ok')
+            response_tokens = estimate_tokens(result)
+            prompt_token_stats['calls'] += 1
+            prompt_token_stats['prompt_tokens'] += prompt_tokens
+            prompt_token_stats['response_tokens'] += response_tokens
+            logger.info("LLM call subject=%s prompt=%s mode=%s prompt_tokens~%d response_tokens~%d",
+                        subject_id, prompt_name, LLM_CONVERSATION_MODE, prompt_tokens, response_tokens)
+            return result
+        except Exception as e:
+            if attempt == LLM_MAX_RETRIES - 1:
                 raise
-            delay = base_delay * (2 ** attempt)
-            print(f"API call failed. Retrying in {delay} seconds... Error: {str(e)}")
-            time.sleep(delay)
+            LLM_RETRIES.inc(prompt_name, 'invoke')
+            # Jitter keeps concurrent retries from hitting the API in lockstep
+            delay = LLM_BASE_DELAY * (2 ** attempt) * random.uniform(0.8, 1.2)
+            logger.warning("%s call failed, retrying in %.1f s: %s", prompt_name, delay, e)
+            await asyncio.sleep(delay)
 
-def analyze_patient_data(subject_id):
-    if subject_id in patient_analysis_cache:
-        print(f"Returning cached result for patient {subject_id}")
-        return patient_analysis_cache[subject_id]
+async def gather_or_cancel(coroutines):
+    # gather(), except that the first failure cancels the calls still
+    # running instead of leaving them to use up the rate limit unread
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
 
-    patient_data = get_patient_data(subject_id)
-    if not patient_data:
-        return None, None, None
-    
-    formatted_patient_data = format_patient_data(patient_data)
+async def run_prompts(prompts, subject_id=None):
+    # Issue every prompt at once; wall time approaches the slowest single call
+    results = await gather_or_cancel(
+        rate_limited_predict(prompt, subject_id, name) for name, prompt in prompts.items()
+    )
+    return dict(zip(prompts.keys(), results))
+
+async def stream_prompt(prompt_input, subject_id=None, prompt_name=None):
+    # Yields text chunks as Gemini produces them. Failures are retried only
+    # until the first chunk arrives; after that they propagate to the caller.
+    prompt_tokens = estimate_tokens(prompt_input)
+    call_started = time.perf_counter()
+    for attempt in range(LLM_MAX_RETRIES):
+        started = False
+        response_chars = 0
+        # Includes the time the consumer spends between chunks
+        attempt_started = time.perf_counter()
+        try:
+            async with llm_limiter:
+                chunks = llm.get().astream(prompt_input).__aiter__()
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), timeout=LLM_STREAM_IDLE_TIMEOUT)
+                    except StopAsyncIteration:
+                        break
+                    started = True
+                    response_chars += len(chunk.content)
+                    yield chunk.content
+                LLM_ATTEMPT_SECONDS.observe(time.perf_counter() - attempt_started, prompt_name, 'stream', 'ok')
+                LLM_CALL_SECONDS.observe(time.perf_counter() - call_started, prompt_name, 'stream')
+            prompt_token_stats['calls'] += 1
+            prompt_token_stats['prompt_tokens'] += prompt_tokens
+            prompt_token_stats['response_tokens'] += math.ceil(response_chars / 4)
+            logger.info("LLM stream subject=%s prompt=%s prompt_tokens~%d response_tokens~%d",
+                        subject_id, prompt_name, prompt_tokens, math.ceil(response_chars / 4))
+            return
+        except Exception as e:
+            LLM_ATTEMPT_SECONDS.observe(time.perf_counter() - attempt_started, prompt_name, 'stream', 'error')
+            if started or attempt == LLM_MAX_RETRIES - 1:
+                raise
+            LLM_RETRIES.inc(prompt_name, 'stream')
+            delay = LLM_BASE_DELAY * (2 ** attempt) * random.uniform(0.8, 1.2)
+            logger.warning("%s stream failed, retrying in %.1f s: %s", prompt_name, delay, e)
+            await asyncio.sleep(delay)
+
+async def stream_prompts(prompts, subject_id, queue, include_tokens=False):
+    async def stream_one(name, prompt):
+        parser = ResponseParser()
+        async for text in stream_prompt(prompt, subject_id, name):
+            if include_tokens:
+                await queue.put(('token', {'prompt': name, 'text': text}))
+            for section, content in parser.feed(text):
+                await queue.put(('section', {'prompt': name, 'section': section, 'content': content}))
+        for section, content in parser.close():
+            await queue.put(('section', {'prompt': name, 'section': section, 'content': content}))
+        await queue.put(('prompt_done', {'prompt': name, 'result': parser.result}))
+
+    try:
+        await gather_or_cancel(stream_one(name, prompt) for name, prompt in prompts.items())
+    except Exception as e:
+        await queue.put(('error', {'error': str(e)}))
+    finally:
+        await queue.put(None)
+
+async def _new_stream_queue():
+    # asyncio queues belong to the loop they are used on
+    return asyncio.Queue(maxsize=LLM_STREAM_QUEUE_SIZE)
+
+def stream_analysis(subject_id, formatted_patient_data, include_tokens=False):
+    # Sync generator of (event, payload) pairs for the three prompts, run
+    # concurrently on the shared loop. The bounded queue applies backpressure,
+    # and a stream that goes quiet for LLM_STREAM_IDLE_TIMEOUT is cancelled.
+    queue = background_loop.run(_new_stream_queue())
+    producer = background_loop.submit(
+        stream_prompts(build_prompts(formatted_patient_data), subject_id, queue, include_tokens)
+    )
+    try:
+        while True:
+            try:
+                item = background_loop.run(queue.get(), timeout=LLM_STREAM_IDLE_TIMEOUT)
+            except TimeoutError:
+                yield 'error', {'error': 'LLM stream stalled'}
+                return
+            if item is None:
+                return
+            yield item
+    finally:
+        # Also runs when the client disconnects and the generator is closed
+        producer.cancel()
+
+# Bump whenever the prompt wording changes so stored analyses are regenerated
+PROMPT_VERSION = '2'
+
+PROMPT_NAMES = ("summary", "care_plan", "additional_fields")
 
-    prompts = {
+def prompt_contexts(formatted_patient_data):
+    if isinstance(formatted_patient_data, str):
+        return dict.fromkeys(PROMPT_NAMES, formatted_patient_data)
+    return formatted_patient_data
+
+def build_prompts(formatted_patient_data):
+    contexts = prompt_contexts(formatted_patient_data)
+    return {
         "summary": f"""Based on the patient data provided, generate a detailed summary and analysis.
         The patient data includes:
-        {formatted_patient_data}
+        {contexts["summary"]}
         
         Provide an overview of the patient's medical history, including key risk factors and any relevant insights.""",
         
         "care_plan": f"""Based on the provided patient data, generate a personalized care plan.
         Patient Data:
-        {formatted_patient_data}
+        {contexts["care_plan"]}
         
         Provide specific recommendations for care, including potential interventions, follow-ups, and monitoring.""",
         
         "additional_fields": f"""Given the following patient data, identify additional fields or factors that should be considered for a comprehensive risk analysis:
         Patient Data:
-        {formatted_patient_data}
+        {contexts["additional_fields"]}
         
         Provide a list of additional fields or factors along with their potential impact on the patient's risk analysis."""
     }
 
-    results = {}
-    for key, prompt in prompts.items():
-        results[key] = rate_limited_predict(prompt)
+def analysis_content_hash(formatted_patient_data):
+    # Identifies an analysis by exactly what the LLM would be shown
+    digest = hashlib.sha256()
+    if isinstance(formatted_patient_data, str):
+        contexts = [formatted_patient_data]
+    else:
+        contexts = [formatted_patient_data[name] for name in PROMPT_NAMES]
+    for part in (PROMPT_VERSION, LLM_MODEL_NAME, *contexts):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def has_patient_data(patient_data):
+    # The context query returns every key for any subject id, so an unknown
+    # patient shows up as a context without an admission
+    return bool(patient_data) and bool(patient_data.get('admission'))
+
+def prepare_patient_analysis(subject_id):
+    # Returns (formatted_patient_data, content_hash), or (None, None) without data
+    patient_data = get_patient_data(subject_id)
+    if not has_patient_data(patient_data):
+        return None, None
+    formatted_patient_data = format_patient_context(subject_id, patient_data)
+    return formatted_patient_data, analysis_content_hash(formatted_patient_data)
 
-    patient_analysis_cache[subject_id] = (results["summary"], results["care_plan"], results["additional_fields"])
+def generate_analysis(subject_id, formatted_patient_data):
+    prompts = build_prompts(formatted_patient_data)
+    results = background_loop.run(run_prompts(prompts, subject_id), timeout=LLM_ANALYSIS_TIMEOUT)
     return results["summary"], results["care_plan"], results["additional_fields"]
 
+def analyze_patient_data(subject_id):
+    formatted_patient_data, _ = prepare_patient_analysis(subject_id)
+    if formatted_patient_data is None:
+        return None, None, None
+    return generate_analysis(subject_id, formatted_patient_data)
+
 def process_patient(subject_id):
     return analyze_patient_data(subject_id)
\ No newline at end of file
@@ -0,0 +1,82 @@
+import asyncio
+import os
+import threading
+import time
+
+
+class BackgroundLoop:
+    # One asyncio loop on a daemon thread, shared by every request thread in
+    # the process. Sync Flask handlers submit coroutines and wait on the result.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self.loop = None
+        self._thread = None
+
+    def _ensure_running(self):
+        # A loop thread inherited through fork() is dead, so start a new one
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return self.loop
+        with self._lock:
+            if self._pid != os.getpid() or self._thread is None or not self._thread.is_alive():
+                self.loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self.loop.run_forever, name="llm-event-loop", daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+        return self.loop
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_running())
+
+    def run(self, coro, timeout=None):
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+
+class AsyncRateLimiter:
+    # Token bucket plus a concurrency cap. Instances must only be used from
+    # one event loop, which is the case for the shared BackgroundLoop.
+    def __init__(self, rate, burst, max_concurrency):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_concurrency = int(max_concurrency)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._bucket_lock = None
+        self._semaphore = None
+        self.in_flight = 0
+        self.waited_seconds = 0.0
+
+    async def __aenter__(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._bucket_lock = asyncio.Lock()
+        start = time.monotonic()
+        await self._semaphore.acquire()
+        try:
+            await self._take_token()
+        except BaseException:
+            self._semaphore.release()
+            raise
+        self.waited_seconds += time.monotonic() - start
+        self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    async def _take_token(self):
+        async with self._bucket_lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
@@ -0,0 +1,178 @@
+import bisect
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Set to 0 to turn every observation into a no-op and /metrics into a 404
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds, from a cached feature lookup up to a slow Gemini call
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_metrics = []
+_collectors = []
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Timer:
+    __slots__ = ('_histogram', '_labels', '_start')
+
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._start, *self._labels)
+        return False
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+
+class Histogram:
+    # Cumulative buckets are only built at render time, so an observation is
+    # one bisect and three additions under the lock
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}
+        _metrics.append(self)
+
+    def observe(self, value, *labelvalues):
+        if not METRICS_ENABLED:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *labelvalues):
+        # with STAGE_SECONDS.time('align'): ...
+        if not METRICS_ENABLED:
+            return _NULL_TIMER
+        return _Timer(self, labelvalues)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._series.items()]
+        for labels, counts, total, count in sorted(series):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(self.labelnames + ('le',), labels + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        _metrics.append(self)
+
+    def inc(self, *labelvalues, amount=1):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+def register_collector(name, kind, documentation, labelnames, collect):
+    # For numbers another component already keeps, such as cache hit
+    # counters: collect() returns [(labelvalues, value)] and only runs on a scrape
+    _collectors.append((name, kind, documentation, tuple(labelnames), collect))
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for name, kind, documentation, labelnames, collect in _collectors:
+        try:
+            samples = collect()
+        except Exception as e:
+            logger.exception("Metrics collector %s failed", name)
+            continue
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{_format_labels(labelnames, labels)} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics are per process: with several gunicorn workers each scrape sees
+# the worker that answered it, identified by the pid label on the app info.
+HTTP_REQUEST_SECONDS = Histogram(
+    'readmission_http_request_seconds', 'Time to produce a response, by route',
+    ('route', 'method', 'status'))
+STAGE_SECONDS = Histogram(
+    'readmission_stage_seconds', 'Time spent in each stage of /predict and /llm_analysis',
+    ('stage',))
+LLM_ATTEMPT_SECONDS = Histogram(
+    'readmission_llm_attempt_seconds', 'Single Gemini request, successful or not',
+    ('prompt', 'mode', 'outcome'))
+LLM_CALL_SECONDS = Histogram(
+    'readmission_llm_call_seconds', 'Gemini call including rate limiting, retries and backoff',
+    ('prompt', 'mode'))
+LLM_RETRIES = Counter(
+    'readmission_llm_retries_total', 'Gemini requests that failed and were retried',
+    ('prompt', 'mode'))
+WRITE_BEHIND_FLUSH_SECONDS = Histogram(
+    'readmission_write_behind_flush_seconds', 'Multi-row insert of one write-behind batch',
+    ('table', 'outcome'))
+WRITE_BEHIND_ROWS = Counter(
+    'readmission_write_behind_rows_total', 'Rows written by write-behind flushes',
+    ('table',))
+register_collector(
+    'readmission_process_info', 'gauge', 'Worker process answering this scrape',
+    ('pid',), lambda: [((os.getpid(),), 1)])
@@ -0,0 +1,188 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import numpy as np
+import joblib
+from scipy.special import expit
+from model_bundle import MODEL_PATH, MODEL_ARTIFACT_PATH, ModelBundle, file_sha256, load_pipeline
+from tree_ensemble import FlatTreeEnsemble
+
+logger = logging.getLogger(__name__)
+
+# A model artifact is a directory:
+#   manifest.json         versions, scalars, array shapes and dtypes
+#   preprocessor.joblib   the fitted ColumnTransformer, uncompressed
+#   <name>.npy            one file per tree/classifier array
+# np.load(mmap_mode='r') maps the .npy files read-only, so every forked
+# worker shares the same page-cache pages instead of unpickling a copy.
+ARTIFACT_FORMAT = 1
+ENSEMBLE_ARRAYS = ('left', 'right', 'feature', 'threshold', 'value', 'node_mean', 'roots')
+
+
+class FlatGradientBoostingClassifier:
+    # Stands in for the fitted binary GradientBoostingClassifier, computing
+    # predict_proba exactly the way sklearn does from the flattened trees
+    def __init__(self, ensemble, classes, feature_importances):
+        self.ensemble = ensemble
+        self.classes_ = classes
+        self.feature_importances_ = feature_importances
+        self.n_features_in_ = ensemble.n_features
+
+    def decision_function(self, X):
+        return self.ensemble.predict_raw(X)
+
+    def predict_proba(self, X):
+        # Same operations as sklearn's HalfBinomialLoss.predict_proba
+        raw = self.decision_function(X)
+        proba = np.empty((raw.shape[0], 2), dtype=raw.dtype)
+        proba[:, 1] = expit(raw)
+        proba[:, 0] = 1 - proba[:, 1]
+        return proba
+
+    def predict(self, X):
+        return self.classes_.take(np.argmax(self.predict_proba(X), axis=1))
+
+
+def save_artifact(pipeline, directory, source_sha256):
+    preprocessor = pipeline.named_steps['preprocessor']
+    classifier = pipeline.named_steps['classifier']
+    ensemble = FlatTreeEnsemble.from_gradient_boosting(classifier)
+    arrays = {name: getattr(ensemble, name) for name in ENSEMBLE_ARRAYS}
+    arrays['classes'] = np.asarray(classifier.classes_)
+    arrays['feature_importances'] = np.asarray(classifier.feature_importances_, dtype=np.float64)
+
+    # Built next to the target and swapped in at the end, so a worker never
+    # sees a half-written artifact
+    staging = directory.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    for name, array in arrays.items():
+        np.save(os.path.join(staging, f"{name}.npy"), np.ascontiguousarray(array))
+    joblib.dump(preprocessor, os.path.join(staging, 'preprocessor.joblib'))
+    manifest = {
+        'format': ARTIFACT_FORMAT,
+        'version': source_sha256[:12],
+        'source_sha256': source_sha256,
+        'classifier': type(classifier).__name__,
+        'max_depth': ensemble.max_depth,
+        'learning_rate': ensemble.learning_rate,
+        'init_raw': ensemble.init_raw.hex(),
+        'n_features': ensemble.n_features,
+        'arrays': {name: {'dtype': str(array.dtype), 'shape': list(array.shape)} for name, array in arrays.items()},
+    }
+    with open(os.path.join(staging, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    if os.path.isdir(directory):
+        previous = directory.rstrip(os.sep) + '.old'
+        shutil.rmtree(previous, ignore_errors=True)
+        os.rename(directory, previous)
+        os.rename(staging, directory)
+        shutil.rmtree(previous)
+    else:
+        os.rename(staging, directory)
+    return manifest
+
+def load_artifact(directory, expected_source_sha256=None):
+    # Returns a ModelBundle, or None when the artifact is unusable or was
+    # converted from a different model file than the one deployed
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if manifest.get('format') != ARTIFACT_FORMAT:
+        logger.warning("Ignoring model artifact %s: format %s is not %s", directory, manifest.get('format'), ARTIFACT_FORMAT)
+        return None
+    if expected_source_sha256 and manifest['source_sha256'] != expected_source_sha256:
+        logger.warning("Ignoring stale model artifact %s: it was converted from a different model file", directory)
+        return None
+
+    arrays = {}
+    for name, spec in manifest['arrays'].items():
+        array = np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r')
+        if str(array.dtype) != spec['dtype'] or list(array.shape) != spec['shape']:
+            logger.warning("Ignoring model artifact %s: %s.npy does not match the manifest", directory, name)
+            return None
+        # A plain ndarray view of the mapping: no copy, no memmap subclass overhead
+        arrays[name] = np.asarray(array)
+
+    ensemble = FlatTreeEnsemble(
+        max_depth=manifest['max_depth'],
+        learning_rate=manifest['learning_rate'],
+        init_raw=float.fromhex(manifest['init_raw']),
+        n_features=manifest['n_features'],
+        **{name: arrays[name] for name in ENSEMBLE_ARRAYS}
+    )
+    # classes are tiny and used with .take(), keep them as a normal array
+    classifier = FlatGradientBoostingClassifier(ensemble, np.array(arrays['classes']), arrays['feature_importances'])
+    preprocessor = joblib.load(os.path.join(directory, 'preprocessor.joblib'), mmap_mode='r')
+    return ModelBundle(preprocessor, classifier, version=manifest['version'])
+
+
+def sample_inputs(preprocessor, n_rows=2000, seed=0):
+    # Raw rows spread around the training distribution, with missing values,
+    # in the DataFrame shape the preprocessor expects
+    import pandas as pd
+    columns = list(preprocessor.feature_names_in_)
+    rng = np.random.default_rng(seed)
+    numeric = preprocessor.named_transformers_['num']
+    center = numeric.named_steps['scaler'].mean_
+    spread = numeric.named_steps['scaler'].scale_
+    numeric_columns = list(preprocessor.transformers_[0][2])
+    values = center + spread * rng.standard_normal((n_rows, len(numeric_columns))) * 2
+    values[rng.random(values.shape) < 0.1] = np.nan
+    frame = pd.DataFrame(values, columns=numeric_columns)
+    return frame.reindex(columns=columns)
+
+def boundary_inputs(ensemble, n_rows=2000, seed=0):
+    # Preprocessed rows that sit exactly on split thresholds, where float32
+    # vs float64 comparisons would show up first
+    rng = np.random.default_rng(seed)
+    X = rng.standard_normal((n_rows, ensemble.n_features)).astype(np.float32)
+    internal = np.flatnonzero(np.isfinite(ensemble.threshold))
+    for row in range(n_rows):
+        for node in rng.choice(internal, size=min(10, len(internal)), replace=False):
+            X[row, ensemble.feature[node]] = ensemble.threshold[node]
+    return X
+
+def verify_artifact(pipeline, directory, n_rows=2000):
+    # Bit-for-bit comparison of predict_proba between the sklearn pipeline
+    # and the artifact, end to end and on threshold-boundary features
+    bundle = load_artifact(directory)
+    if bundle is None:
+        return False
+    preprocessor = pipeline.named_steps['preprocessor']
+    classifier = pipeline.named_steps['classifier']
+    X = sample_inputs(preprocessor, n_rows)
+    expected = classifier.predict_proba(preprocessor.transform(X))
+    actual = bundle.classifier.predict_proba(bundle.preprocessor.transform(X))
+    boundary = boundary_inputs(bundle.classifier.ensemble, n_rows)
+    boundary_expected = classifier.predict_proba(boundary)
+    boundary_actual = bundle.classifier.predict_proba(boundary)
+    identical = np.array_equal(expected, actual) and np.array_equal(boundary_expected, boundary_actual)
+    print(f"predict_proba on {len(X)} sampled rows and {len(boundary)} boundary rows: "
+          f"{'bit-identical' if identical else 'MISMATCH'} "
+          f"(max abs diff {max(np.abs(expected - actual).max(), np.abs(boundary_expected - boundary_actual).max()):.3g})")
+    return identical
+
+def convert(model_path=MODEL_PATH, artifact_path=MODEL_ARTIFACT_PATH, n_rows=2000):
+    pipeline = load_pipeline(model_path)
+    manifest = save_artifact(pipeline, artifact_path, file_sha256(model_path))
+    print(f"Wrote {artifact_path} (version {manifest['version']})")
+    if not verify_artifact(pipeline, artifact_path, n_rows):
+        # Never leave behind an artifact load_model would prefer but that disagrees
+        shutil.rmtree(artifact_path)
+        raise SystemExit("Artifact predictions differ from the joblib model; artifact removed")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the joblib model into a memory-mappable artifact directory")
+    parser.add_argument('command', choices=['convert', 'verify'])
+    parser.add_argument('--model', default=MODEL_PATH)
+    parser.add_argument('--artifact', default=MODEL_ARTIFACT_PATH)
+    parser.add_argument('--rows', type=int, default=2000, help="rows compared in the parity check")
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        convert(args.model, args.artifact, args.rows)
+    elif not verify_artifact(load_pipeline(args.model), args.artifact, args.rows):
+        raise SystemExit(1)
@@ -0,0 +1,96 @@
+import hashlib
+import os
+import numpy as np
+import joblib
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.utils import check_random_state
+
+MODEL_PATH = os.getenv('MODEL_PATH', 'best_readmission_risk_model_fin.joblib')
+# Written by `python -m model_artifact convert`; preferred over MODEL_PATH when present
+MODEL_ARTIFACT_PATH = os.getenv('MODEL_ARTIFACT_PATH', os.path.splitext(MODEL_PATH)[0] + '.artifact')
+DEFAULT_TOP_K = 5
+
+# Classes for model prediction
+class FixRandomState(BaseEstimator, TransformerMixin):
+    def __init__(self, random_state=None):
+        self.random_state = random_state
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X):
+        return X
+
+
+class ModelBundle:
+    # Everything about the fitted pipeline that doesn't depend on the patient,
+    # computed once at load time instead of on every request. The sklearn
+    # pipeline is only kept when the model was loaded from the joblib file.
+    def __init__(self, preprocessor, classifier, version=None, top_k=DEFAULT_TOP_K, pipeline=None):
+        self.pipeline = pipeline
+        self.version = version
+        self.preprocessor = preprocessor
+        self.classifier = classifier
+        self.classes = self.classifier.classes_
+        self.expected_features = list(self.preprocessor.feature_names_in_)
+        self.feature_names = list(self.preprocessor.get_feature_names_out())
+        self.feature_importances = np.asarray(self.classifier.feature_importances_)
+        # Sort feature importances in descending order
+        self.importance_order = np.argsort(self.feature_importances)[::-1]
+        self.ranked_features = [
+            {'Feature': self.feature_names[i], 'Importance': float(self.feature_importances[i])}
+            for i in self.importance_order
+        ]
+        self.default_top_k = top_k
+        self.default_top_features = self.top_features(top_k)
+
+    def top_features(self, k=None):
+        if k is None:
+            return self.default_top_features
+        return self.ranked_features[:k]
+
+    def info(self, k=None):
+        return {
+            'version': self.version,
+            'source': 'artifact' if self.pipeline is None else 'joblib',
+            'classifier': type(self.classifier).__name__,
+            'classes': [int(c) for c in self.classes],
+            'expected_features': self.expected_features,
+            'feature_names': self.feature_names,
+            'top_features': self.top_features(k),
+        }
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_pipeline(path=MODEL_PATH):
+    try:
+        model = joblib.load(path)
+    except TypeError as e:
+        if "__randomstate_ctor()" in str(e):
+            model = joblib.load(path, mmap_mode='r')
+            for step in model.steps:
+                if hasattr(step[1], 'random_state'):
+                    step[1].random_state = check_random_state(step[1].random_state)
+            model.steps.append(('fix_random_state', FixRandomState()))
+        else:
+            raise
+    return model
+
+def load_model(path=MODEL_PATH, artifact_path=MODEL_ARTIFACT_PATH):
+    source_sha256 = file_sha256(path) if os.path.exists(path) else None
+    if artifact_path and os.path.isdir(artifact_path):
+        from model_artifact import load_artifact
+        bundle = load_artifact(artifact_path, expected_source_sha256=source_sha256)
+        if bundle is not None:
+            return bundle
+    model = load_pipeline(path)
+    return ModelBundle(
+        model.named_steps['preprocessor'], model.named_steps['classifier'],
+        version=source_sha256[:12], pipeline=model
+    )
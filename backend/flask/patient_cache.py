@@ -0,0 +1,302 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from patient_retrieval import check_private, private_dir
+
+logger = logging.getLogger(__name__)
+
+PATIENT_CACHE_BACKEND = os.getenv('PATIENT_CACHE_BACKEND', 'memory')
+PATIENT_CACHE_TTL = float(os.getenv('PATIENT_CACHE_TTL', '300'))
+PATIENT_CACHE_MAX_BYTES = int(os.getenv('PATIENT_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+# Patient context is PHI, so the sqlite file lives in a 0700 directory of the
+# service user and is created 0600, never in a shared one like /tmp
+PATIENT_CACHE_DIR = os.getenv('PATIENT_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'readmission_patient_cache'))
+PATIENT_CACHE_SQLITE_PATH = os.getenv('PATIENT_CACHE_SQLITE_PATH', os.path.join(PATIENT_CACHE_DIR, 'patient_context.sqlite3'))
+PATIENT_CACHE_REDIS_URL = os.getenv('PATIENT_CACHE_REDIS_URL', 'redis://localhost:6379/0')
+
+def normalize_subject_id(subject_id):
+    # "123", " 123" and 123 all refer to the same patient
+    text = str(subject_id).strip()
+    return str(int(text)) if text.lstrip('-').isdigit() else text
+
+
+class MemoryBackend:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, False
+            expires_at, payload = entry
+            if expires_at <= time.time():
+                self._remove(key)
+                return None, True
+            self._entries.move_to_end(key)
+            return payload, False
+
+    def set(self, key, payload, ttl):
+        evicted = 0
+        with self._lock:
+            self._remove(key)
+            if len(payload) > self.max_bytes:
+                return 0
+            self._entries[key] = (time.time() + ttl, payload)
+            self._size += len(payload)
+            while self._size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                evicted += 1
+        return evicted
+
+    def delete(self, key):
+        with self._lock:
+            return self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._size}
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._size -= len(entry[1])
+        return True
+
+
+class SQLiteBackend:
+    # A file on local disk shared by every worker process on the host
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        # Hits only note the access time here; set() writes them in its own
+        # transaction, before it picks eviction victims, so reads never wait
+        # for the write lock. Eviction sees other workers' hits as of their
+        # last set().
+        self._touched = {}
+        self._touched_lock = threading.Lock()
+        create_private_file(path)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS patient_context (
+                    key TEXT PRIMARY KEY,
+                    expires_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    payload TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS patient_context_last_access_idx ON patient_context (last_access)")
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        row = conn.execute("SELECT expires_at, payload FROM patient_context WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None, False
+        now = time.time()
+        if row[0] <= now:
+            conn.execute("DELETE FROM patient_context WHERE key = ?", (key,))
+            return None, True
+        with self._touched_lock:
+            self._touched[key] = now
+        return row[1], False
+
+    def set(self, key, payload, ttl):
+        if len(payload) > self.max_bytes:
+            return 0
+        conn = self._connect()
+        now = time.time()
+        with self._touched_lock:
+            touched, self._touched = self._touched, {}
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if touched:
+                conn.executemany(
+                    "UPDATE patient_context SET last_access = max(last_access, ?) WHERE key = ?",
+                    [(at, touched_key) for touched_key, at in touched.items()]
+                )
+            conn.execute(
+                "INSERT OR REPLACE INTO patient_context (key, expires_at, last_access, size, payload) VALUES (?, ?, ?, ?, ?)",
+                (key, now + ttl, now, len(payload), payload)
+            )
+            conn.execute("DELETE FROM patient_context WHERE expires_at <= ?", (now,))
+            evicted = 0
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM patient_context").fetchone()[0]
+            if total > self.max_bytes:
+                # Drop least recently used entries until back under the bound
+                victims = []
+                for victim_key, size in conn.execute("SELECT key, size FROM patient_context ORDER BY last_access"):
+                    if total <= self.max_bytes:
+                        break
+                    victims.append((victim_key,))
+                    total -= size
+                conn.executemany("DELETE FROM patient_context WHERE key = ?", victims)
+                evicted = len(victims)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return evicted
+
+    def delete(self, key):
+        return self._connect().execute("DELETE FROM patient_context WHERE key = ?", (key,)).rowcount > 0
+
+    def clear(self):
+        self._connect().execute("DELETE FROM patient_context")
+
+    def stats(self):
+        entries, size = self._connect().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM patient_context").fetchone()
+        return {'entries': entries, 'bytes': size}
+
+
+def create_private_file(path):
+    # sqlite gives its -wal and -shm files the database file's mode
+    private_dir(os.path.dirname(os.path.abspath(path)))
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+    os.close(fd)
+    check_private(path)
+    os.chmod(path, 0o600)
+
+
+class RedisBackend:
+    # Any Redis-compatible server. The memory bound is Redis' own maxmemory
+    # with an LRU eviction policy, which this client can't observe directly.
+    def __init__(self, url, prefix='patient_context:'):
+        import redis
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        payload = self._client.get(self.prefix + key)
+        return (payload.decode() if payload is not None else None), False
+
+    def set(self, key, payload, ttl):
+        self._client.set(self.prefix + key, payload, px=int(ttl * 1000))
+        return 0
+
+    def delete(self, key):
+        return self._client.delete(self.prefix + key) > 0
+
+    def clear(self):
+        for key in self._client.scan_iter(match=self.prefix + '*'):
+            self._client.delete(key)
+
+    def stats(self):
+        return {'entries': None, 'bytes': None}
+
+
+class PatientContextCache:
+    def __init__(self, backend, ttl=PATIENT_CACHE_TTL, decoder=None):
+        self.backend = backend
+        self.ttl = ttl
+        self._decoder = decoder
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'expirations': 0, 'evictions': 0, 'invalidations': 0, 'backend_errors': 0}
+
+    def get_or_load(self, subject_id, loader):
+        key = normalize_subject_id(subject_id)
+        cached = self._read(key)
+        if cached is not None:
+            return cached
+        value = loader(key)
+        self._write(key, value)
+        return value
+
+    async def aget_or_load(self, subject_id, loader):
+        # For the ASGI app: loader is a coroutine function. The memory backend
+        # never blocks; sqlite and redis calls are short and stay inline.
+        key = normalize_subject_id(subject_id)
+        cached = self._read(key)
+        if cached is not None:
+            return cached
+        value = await loader(key)
+        self._write(key, value)
+        return value
+
+    def invalidate(self, subject_id):
+        removed = self.backend.delete(normalize_subject_id(subject_id))
+        self._count('invalidations')
+        return removed
+
+    def clear(self):
+        self.backend.clear()
+
+    def metrics(self):
+        with self._lock:
+            counters = dict(self._counters)
+        try:
+            counters.update(self.backend.stats())
+        except Exception:
+            pass
+        counters['backend'] = type(self.backend).__name__
+        return counters
+
+    def _read(self, key):
+        try:
+            payload, expired = self.backend.get(key)
+        except Exception as e:
+            # A broken shared cache must never take the endpoint down with it
+            logger.warning("Patient context cache read failed: %s", e)
+            self._count('backend_errors')
+            payload, expired = None, False
+        if expired:
+            self._count('expirations')
+        if payload is not None:
+            self._count('hits')
+            return self._decode(payload)
+        self._count('misses')
+        return None
+
+    def _write(self, key, value):
+        try:
+            evicted = self.backend.set(key, json.dumps(value, default=str), self.ttl)
+            if evicted:
+                self._count('evictions', evicted)
+        except Exception as e:
+            logger.warning("Patient context cache write failed: %s", e)
+            self._count('backend_errors')
+
+    def _decode(self, payload):
+        value = json.loads(payload)
+        return self._decoder(value) if self._decoder else value
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+
+def create_patient_cache(decoder=None):
+    if PATIENT_CACHE_BACKEND == 'sqlite':
+        backend = SQLiteBackend(PATIENT_CACHE_SQLITE_PATH, PATIENT_CACHE_MAX_BYTES)
+    elif PATIENT_CACHE_BACKEND == 'redis':
+        backend = RedisBackend(PATIENT_CACHE_REDIS_URL)
+    elif PATIENT_CACHE_BACKEND == 'memory':
+        backend = MemoryBackend(PATIENT_CACHE_MAX_BYTES)
+    else:
+        raise ValueError(f"Unknown PATIENT_CACHE_BACKEND: {PATIENT_CACHE_BACKEND}")
+    return PatientContextCache(backend, decoder=decoder)
@@ -0,0 +1,267 @@
+import fcntl
+import hashlib
+import os
+import stat
+import threading
+from collections import OrderedDict
+from clinical_summary import format_summary_row
+
+# Small sentence-transformers model, run locally on the CPU
+RAG_EMBEDDING_MODEL = os.getenv('RAG_EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+RAG_EMBEDDING_BATCH_SIZE = int(os.getenv('RAG_EMBEDDING_BATCH_SIZE', '64'))
+# Indexes are partly pickled, so they live in a directory only the service
+# user can write to, never a shared one like /tmp
+RAG_DATA_DIR = os.getenv('RAG_DATA_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'readmission_rag'))
+RAG_EMBEDDING_CACHE_DIR = os.getenv('RAG_EMBEDDING_CACHE_DIR', os.path.join(RAG_DATA_DIR, 'embeddings'))
+RAG_INDEX_DIR = os.getenv('RAG_INDEX_DIR', os.path.join(RAG_DATA_DIR, 'indexes'))
+RAG_MAX_LOADED_INDEXES = int(os.getenv('RAG_MAX_LOADED_INDEXES', '50'))
+RAG_TOKEN_BUDGET = int(os.getenv('RAG_TOKEN_BUDGET', '1500'))
+RAG_TOP_K = int(os.getenv('RAG_TOP_K', '60'))
+
+# Rendered in this order, one line per source, like format_patient_data
+SOURCES = [
+    ('admission', 'Admission'),
+    ('icu_stay', 'ICU Stay'),
+    ('diagnoses', 'Diagnoses'),
+    ('lab_events', 'Lab Events'),
+    ('lab_summary', 'Lab Trends'),
+    ('medications', 'Medications'),
+    ('icu_vitals', 'ICU Vitals'),
+    ('vital_summary', 'ICU Vital Trends'),
+]
+
+# Short and always relevant, so never left to retrieval
+PINNED_SOURCES = {'admission', 'icu_stay'}
+
+# What each prompt needs to see from the rest of the context
+RETRIEVAL_QUERIES = {
+    'summary': "medical history, chronic diagnoses, key risk factors and abnormal results",
+    'care_plan': "current medications, doses and routes, abnormal labs and vital signs that need monitoring or follow-up",
+    'additional_fields': "risk factors for readmission: comorbidities, abnormal trends, length of ICU stay, polypharmacy",
+}
+
+
+def private_dir(path):
+    # Creates path (and missing parents) as 0700 and refuses one that someone
+    # else owns or could write to, or that is a symlink
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    check_private(path)
+    return path
+
+def check_private(path):
+    info = os.lstat(path)
+    if stat.S_ISLNK(info.st_mode):
+        raise PermissionError(f"{path} is a symlink")
+    if info.st_uid != os.getuid():
+        raise PermissionError(f"{path} is owned by uid {info.st_uid}, not this process's {os.getuid()}")
+    if info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(f"{path} is writable by other users (mode {stat.S_IMODE(info.st_mode):o})")
+
+def create_cached_embeddings(model_name=RAG_EMBEDDING_MODEL, cache_dir=RAG_EMBEDDING_CACHE_DIR):
+    # Vectors are stored on disk under a hash of the chunk text, so a row
+    # that was embedded once is never embedded again, in any worker.
+    # LangChain is imported here so importing this module stays cheap.
+    from langchain.embeddings import HuggingFaceEmbeddings, CacheBackedEmbeddings
+    from langchain.storage import LocalFileStore
+    underlying = HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs={'device': 'cpu'},
+        encode_kwargs={'normalize_embeddings': True, 'batch_size': RAG_EMBEDDING_BATCH_SIZE}
+    )
+    store = LocalFileStore(private_dir(cache_dir))
+    return CacheBackedEmbeddings.from_bytes_store(underlying, store, namespace=model_name)
+
+def chunk_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def _row_texts(patient_data):
+    admission = patient_data.get('admission')
+    if admission:
+        yield 'admission', ', '.join(map(str, admission))
+    icu_stay = patient_data.get('icu_stay')
+    if icu_stay:
+        yield 'icu_stay', f"Intime: {icu_stay[0]}, Outtime: {icu_stay[1]}, LOS: {icu_stay[2]}"
+    for code, title in patient_data.get('diagnoses') or []:
+        yield 'diagnoses', f"{code}: {title}"
+    for charttime, label, value, _, valueuom, flag in patient_data.get('lab_events') or []:
+        yield 'lab_events', f"{charttime} {label}: {value} {valueuom} ({flag})"
+    for row in patient_data.get('lab_summary') or []:
+        yield 'lab_summary', format_summary_row(row)
+    for starttime, _, drug, dose_val_rx, dose_unit_rx, route in patient_data.get('medications') or []:
+        yield 'medications', f"{starttime} {drug} {dose_val_rx} {dose_unit_rx} {route}"
+    for charttime, valuenum, valueuom in patient_data.get('icu_vitals') or []:
+        yield 'icu_vitals', f"{charttime}: {valuenum} {valueuom}"
+    for row in patient_data.get('vital_summary') or []:
+        yield 'vital_summary', format_summary_row(row)
+
+def patient_chunks(patient_data):
+    # One chunk per row, identified by the hash of its text: new rows become
+    # new chunks and unchanged rows keep their id (and cached embedding)
+    labels = dict(SOURCES)
+    chunks = OrderedDict()
+    for order, (source, text) in enumerate(_row_texts(patient_data)):
+        content = f"{labels[source]}: {text}"
+        chunk_id = chunk_hash(content)
+        if chunk_id not in chunks:
+            chunks[chunk_id] = {'id': chunk_id, 'source': source, 'order': order, 'text': text, 'content': content}
+    return chunks
+
+def build_vector_store(chunks, embeddings):
+    from langchain.vectorstores import FAISS
+    chunks = list(chunks)
+    return FAISS.from_texts(
+        [chunk['content'] for chunk in chunks],
+        embeddings,
+        metadatas=[{'source': chunk['source'], 'chunk_id': chunk['id']} for chunk in chunks],
+        ids=[chunk['id'] for chunk in chunks]
+    )
+
+
+class PatientIndexStore:
+    # One FAISS index per subject, saved under root/<subject_id>. Each sync
+    # embeds only the rows that are new since the last save and drops the
+    # ones that fell out of the patient context.
+    def __init__(self, embeddings, root=RAG_INDEX_DIR, max_loaded=RAG_MAX_LOADED_INDEXES):
+        self.embeddings = embeddings
+        self.root = private_dir(root)
+        self.max_loaded = max_loaded
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+        self._subject_locks = {}
+        self._counters = {'builds': 0, 'loads': 0, 'chunks_added': 0, 'chunks_removed': 0}
+
+    def sync(self, subject_id, chunks):
+        key = str(subject_id)
+        with self._subject_lock(key):
+            path = private_dir(os.path.join(self.root, key))
+            # Other workers may update the same subject's index
+            with open(os.path.join(path, '.lock'), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    store = self._load(key, path)
+                    if store is None:
+                        store = build_vector_store(chunks.values(), self.embeddings)
+                        self._count('builds')
+                        self._count('chunks_added', len(chunks))
+                        changed = True
+                    else:
+                        changed = self._update(store, chunks)
+                    if changed:
+                        store.save_local(path)
+                    self._remember(key, path, store)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return store
+
+    def _update(self, store, chunks):
+        indexed = set(store.index_to_docstore_id.values())
+        added = [chunk for chunk_id, chunk in chunks.items() if chunk_id not in indexed]
+        removed = [chunk_id for chunk_id in indexed if chunk_id not in chunks]
+        if removed:
+            store.delete(removed)
+        if added:
+            store.add_texts(
+                [chunk['content'] for chunk in added],
+                metadatas=[{'source': chunk['source'], 'chunk_id': chunk['id']} for chunk in added],
+                ids=[chunk['id'] for chunk in added]
+            )
+        self._count('chunks_added', len(added))
+        self._count('chunks_removed', len(removed))
+        return bool(added or removed)
+
+    def _load(self, key, path):
+        index_file = os.path.join(path, 'index.faiss')
+        if not os.path.exists(index_file):
+            return None
+        mtime = os.path.getmtime(index_file)
+        with self._lock:
+            loaded = self._loaded.get(key)
+        if loaded is not None and loaded[0] == mtime:
+            return loaded[1]
+        from langchain.vectorstores import FAISS
+        # The pickle half of the index is only ever written by this module,
+        # so only load files nobody else could have put there
+        for checked in (path, index_file, os.path.join(path, 'index.pkl')):
+            check_private(checked)
+        try:
+            store = FAISS.load_local(path, self.embeddings, allow_dangerous_deserialization=True)
+        except TypeError:
+            # Older langchain releases don't take the flag
+            store = FAISS.load_local(path, self.embeddings)
+        self._count('loads')
+        return store
+
+    def _remember(self, key, path, store):
+        mtime = os.path.getmtime(os.path.join(path, 'index.faiss'))
+        with self._lock:
+            self._loaded[key] = (mtime, store)
+            self._loaded.move_to_end(key)
+            while len(self._loaded) > self.max_loaded:
+                self._loaded.popitem(last=False)
+
+    def metrics(self):
+        with self._lock:
+            counters = dict(self._counters)
+            counters['loaded_indexes'] = len(self._loaded)
+        return counters
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def _subject_lock(self, key):
+        with self._lock:
+            return self._subject_locks.setdefault(key, threading.Lock())
+
+
+class PatientRetriever:
+    def __init__(self, embeddings, index_store=None, token_budget=RAG_TOKEN_BUDGET, top_k=RAG_TOP_K):
+        self.embeddings = embeddings
+        self.index_store = index_store or PatientIndexStore(embeddings)
+        self.token_budget = token_budget
+        self.top_k = top_k
+        self._query_vectors = {}
+
+    def prompt_contexts(self, subject_id, patient_data, count_tokens, queries=RETRIEVAL_QUERIES):
+        # Returns {prompt name: formatted context} with each context kept
+        # within token_budget, most relevant rows first
+        chunks = patient_chunks(patient_data)
+        store = self.index_store.sync(subject_id, chunks)
+        return {
+            name: self._select(store, chunks, query, count_tokens)
+            for name, query in queries.items()
+        }
+
+    def _select(self, store, chunks, query, count_tokens):
+        selected = [chunk for chunk in chunks.values() if chunk['source'] in PINNED_SOURCES]
+        used = sum(count_tokens(chunk['content']) for chunk in selected)
+        candidates = store.similarity_search_by_vector(self._query_vector(query), k=min(self.top_k, len(chunks)))
+        for document in candidates:
+            chunk = chunks.get(document.metadata.get('chunk_id'))
+            if chunk is None or chunk['source'] in PINNED_SOURCES:
+                continue
+            cost = count_tokens(chunk['text']) + 1
+            if used + cost > self.token_budget:
+                continue
+            selected.append(chunk)
+            used += cost
+        return render_chunks(selected)
+
+    def _query_vector(self, query):
+        # The queries are fixed, so each is embedded once per process
+        vector = self._query_vectors.get(query)
+        if vector is None:
+            vector = self._query_vectors[query] = self.embeddings.embed_query(query)
+        return vector
+
+
+def render_chunks(chunks):
+    # Back into the "Source: row; row" lines the prompts already use, rows
+    # in their original (newest first) order
+    by_source = {}
+    for chunk in sorted(chunks, key=lambda chunk: chunk['order']):
+        by_source.setdefault(chunk['source'], []).append(chunk['text'])
+    return "\n".join(
+        f"{label}: {'; '.join(by_source[source])}"
+        for source, label in SOURCES if source in by_source
+    )
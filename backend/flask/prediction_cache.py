@@ -0,0 +1,177 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+import numpy as np
+import psycopg2
+from psycopg2 import pool
+from cachetools import TTLCache
+from database.connection import mimic_connection
+from database.migrations import ColumnCheck, run_migration, columns_present
+
+logger = logging.getLogger(__name__)
+
+PREDICTION_CACHE_TTL = float(os.getenv('PREDICTION_CACHE_TTL', '3600'))
+PREDICTION_CACHE_MAXSIZE = int(os.getenv('PREDICTION_CACHE_MAXSIZE', '10000'))
+
+# A stored prediction is reused while the patient's latest row has the same
+# feature hash and model version. Applied once per deploy, never from a
+# request, since the ALTERs take an exclusive lock on risk_prediction:
+#   python prediction_cache.py migrate
+PREDICTION_TABLE = ('patient_analysis', 'risk_prediction')
+PREDICTION_CACHE_COLUMNS = ['feature_hash', 'model_version']
+PREDICTION_CACHE_MIGRATION = [
+    # Give up rather than queue every reader behind a long-running transaction
+    "SET lock_timeout = '5s'",
+    "ALTER TABLE patient_analysis.risk_prediction ADD COLUMN IF NOT EXISTS feature_hash TEXT",
+    "ALTER TABLE patient_analysis.risk_prediction ADD COLUMN IF NOT EXISTS model_version TEXT",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS risk_prediction_subject_timestamp_idx ON patient_analysis.risk_prediction (subject_id, timestamp DESC)",
+]
+MIGRATION_HINT = "risk_prediction lacks the feature_hash/model_version columns, run `python prediction_cache.py migrate`"
+
+LATEST_PREDICTION_COLUMNS = ['prediction', 'probability', 'risk_level', 'recommendation', 'top_features',
+                             'feature_hash', 'model_version', 'timestamp']
+LATEST_PREDICTION_QUERY = f"""
+    SELECT {', '.join(LATEST_PREDICTION_COLUMNS)}
+    FROM patient_analysis.risk_prediction
+    WHERE subject_id = %s
+    ORDER BY timestamp DESC
+    LIMIT 1
+"""
+LATEST_PREDICTION_QUERY_ASYNC = LATEST_PREDICTION_QUERY.replace('%s', '$1')
+
+
+def feature_hash(row, model_version):
+    # One aligned feature row, as the model sees it. Float rows hash their
+    # bytes; object rows (string categoricals) their JSON.
+    digest = hashlib.sha256(str(model_version or '').encode())
+    digest.update(b'\0')
+    if row.dtype == object:
+        digest.update(json.dumps(row.tolist(), default=str).encode())
+    else:
+        digest.update(np.ascontiguousarray(row, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def lookup_latest_prediction(subject_id):
+    with mimic_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(LATEST_PREDICTION_QUERY, (str(subject_id),))
+            row = cursor.fetchone()
+    return dict(zip(LATEST_PREDICTION_COLUMNS, row)) if row else None
+
+async def lookup_latest_prediction_async(subject_id):
+    from database.async_connection import async_pool
+    row = await async_pool().fetchrow(LATEST_PREDICTION_QUERY_ASYNC, str(subject_id))
+    return dict(zip(LATEST_PREDICTION_COLUMNS, row.values())) if row else None
+
+def stored_result(stored):
+    # The /predict response fields of a risk_prediction row
+    top_features = stored['top_features']
+    if isinstance(top_features, str):
+        top_features = json.loads(top_features)
+    return {
+        'prediction': int(stored['prediction']),
+        'probability': float(stored['probability']),
+        'risk_level': stored['risk_level'],
+        'recommendation': stored['recommendation'],
+        'top_features': top_features,
+    }
+
+
+class PredictionCache:
+    # Memoizes /predict on (subject, feature hash, top_k): an in-process TTL
+    # layer, then the patient's latest risk_prediction row. Stored rows only
+    # answer default top_k requests, since the row doesn't record its top_k.
+    def __init__(self, ttl=PREDICTION_CACHE_TTL, maxsize=PREDICTION_CACHE_MAXSIZE):
+        self._local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._schema = ColumnCheck(PREDICTION_TABLE, PREDICTION_CACHE_COLUMNS, MIGRATION_HINT)
+        self._counters = {'local_hits': 0, 'stored_hits': 0, 'misses': 0, 'lookup_errors': 0}
+
+    def get(self, subject_id, features_hash, model_version, top_k=None):
+        self.require_schema()
+        cached = self._get_local(subject_id, features_hash, top_k)
+        if cached is not None or top_k is not None:
+            return self._counted(cached)
+        try:
+            stored = lookup_latest_prediction(subject_id)
+        except (psycopg2.Error, pool.PoolError) as error:
+            # Re-scoring is slower but still correct
+            logger.warning("Stored prediction lookup for subject %s failed: %s", subject_id, error)
+            self._count('lookup_errors')
+            stored = None
+        return self._from_stored(subject_id, features_hash, model_version, stored)
+
+    async def aget(self, subject_id, features_hash, model_version, top_k=None):
+        # The ASGI app's variant, with the stored lookup through asyncpg
+        await self.arequire_schema()
+        cached = self._get_local(subject_id, features_hash, top_k)
+        if cached is not None or top_k is not None:
+            return self._counted(cached)
+        try:
+            stored = await lookup_latest_prediction_async(subject_id)
+        except Exception as error:
+            logger.warning("Stored prediction lookup for subject %s failed: %s", subject_id, error)
+            self._count('lookup_errors')
+            stored = None
+        return self._from_stored(subject_id, features_hash, model_version, stored)
+
+    def put(self, subject_id, features_hash, top_k, result):
+        with self._lock:
+            self._local[(str(subject_id), features_hash, top_k)] = result
+
+    def require_schema(self):
+        # Read-only check for the migrated columns, which every stored
+        # prediction and the write-behind insert need. Without them requests
+        # fail fast rather than spilling rows that can never be inserted.
+        self._schema.require()
+
+    async def arequire_schema(self):
+        await self._schema.arequire()
+
+    def metrics(self):
+        with self._lock:
+            counters = dict(self._counters)
+            counters['local_entries'] = len(self._local)
+        return counters
+
+    def _get_local(self, subject_id, features_hash, top_k):
+        with self._lock:
+            cached = self._local.get((str(subject_id), features_hash, top_k))
+        if cached is not None:
+            self._count('local_hits')
+        return cached
+
+    def _counted(self, cached):
+        if cached is None:
+            self._count('misses')
+        return cached
+
+    def _from_stored(self, subject_id, features_hash, model_version, stored):
+        if stored is None or stored['feature_hash'] != features_hash or stored['model_version'] != model_version:
+            self._count('misses')
+            return None
+        self._count('stored_hits')
+        result = stored_result(stored)
+        self.put(subject_id, features_hash, None, result)
+        return result
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+
+if __name__ == "__main__":
+    # Run from backend/flask before deploying a version that memoizes /predict:
+    #   python prediction_cache.py migrate
+    parser = argparse.ArgumentParser(description="Schema behind the /predict memoization")
+    parser.add_argument('command', choices=['migrate', 'check'])
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        run_migration(PREDICTION_CACHE_MIGRATION)
+    present = columns_present(PREDICTION_TABLE, PREDICTION_CACHE_COLUMNS)
+    print("risk_prediction memoization columns are", "in place" if present else "missing")
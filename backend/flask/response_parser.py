@@ -0,0 +1,128 @@
+import logging
+import re
+from typing import Dict, Any, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# "1. item" and "2) item" are list items just like "* item"
+NUMBERED_ITEM = re.compile(r'(\d+)[.)](?:\s+|$)')
+DASH_ITEM = re.compile(r'[-+](?:\s+|$)')
+
+
+def _list_item(line):
+    # Returns the item text if the stripped line starts a list item, else None
+    if line.startswith('*'):
+        return line[1:].strip()
+    if line[0].isdigit():
+        match = NUMBERED_ITEM.match(line)
+        if match:
+            return line[match.end():].strip()
+    elif line[0] in '-+':
+        match = DASH_ITEM.match(line)
+        if match:
+            return line[match.end():].strip()
+    return None
+
+
+class ResponseParser:
+    # Single pass over the LLM output. Text can be fed in arbitrary chunks;
+    # each line is looked at once and every section is handed back as soon as
+    # the next header (or close) shows it is complete.
+    #
+    # A section whose lines contain any list item becomes {item: text}, with
+    # the lines following an item (and items nested under it by indentation)
+    # joined into its text. Other sections become their lines joined by spaces.
+    def __init__(self):
+        self.result = {}
+        self._partial = []
+        self._section = None
+        self._reset_section()
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        completed = []
+        if '\n' not in chunk:
+            self._partial.append(chunk)
+            return completed
+        lines = chunk.split('\n')
+        if self._partial:
+            self._partial.append(lines[0])
+            lines[0] = ''.join(self._partial)
+            self._partial = []
+        tail = lines.pop()
+        if tail:
+            self._partial.append(tail)
+        for line in lines:
+            self._consume(line, completed)
+        return completed
+
+    def close(self) -> List[Tuple[str, Any]]:
+        completed = []
+        if self._partial:
+            self._consume(''.join(self._partial), completed)
+            self._partial = []
+        self._finish_section(completed)
+        return completed
+
+    def _reset_section(self):
+        self._lines = []
+        self._items = None
+        self._item = None
+        self._item_indent = 0
+        self._item_lines = []
+
+    def _consume(self, raw, completed):
+        line = raw.strip()
+        if not line:
+            return
+        if line.startswith('**') and line.endswith('**'):
+            self._finish_section(completed)
+            self._section = line.strip('*').strip()
+            return
+        if not self._section:
+            # Nothing before the first header is kept
+            return
+
+        self._lines.append(line)
+        item = _list_item(line)
+        if item is None:
+            if self._item:
+                self._item_lines.append(line)
+            return
+
+        indent = len(raw) - len(raw.lstrip())
+        if self._item and indent > self._item_indent:
+            # Nested item: part of its parent's text
+            self._item_lines.append(item)
+            return
+        if self._items is None:
+            self._items = {}
+        self._finish_item()
+        self._item = item
+        self._item_indent = indent
+
+    def _finish_item(self):
+        if self._item:
+            self._items[self._item] = ' '.join(self._item_lines)
+        self._item = None
+        self._item_lines = []
+
+    def _finish_section(self, completed):
+        if self._section:
+            if self._items is not None:
+                self._finish_item()
+                content = self._items
+            else:
+                content = ' '.join(self._lines)
+            self.result[self._section] = content
+            completed.append((self._section, content))
+            logger.debug("Parsed section %r: %r", self._section, content)
+        self._section = None
+        self._reset_section()
+
+
+def parse_llm_response(llm_result: str) -> Dict[str, Any]:
+    logger.debug("Parsing LLM result (%d chars)", len(llm_result))
+    parser = ResponseParser()
+    parser.feed(llm_result)
+    parser.close()
+    return parser.result
@@ -0,0 +1,94 @@
+import logging
+import threading
+from collections import Counter
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class SchemaAligner:
+    # Maps incoming rows onto the model's training columns, in training order,
+    # in one preallocated array. A column the input doesn't have gets its
+    # default, which is NaN unless overridden so the fitted imputer fills it
+    # exactly as it fills any other missing value. Values that are present,
+    # including missing ones, are passed through untouched.
+    def __init__(self, columns, defaults=None, dtype=np.float64):
+        self.columns = list(columns)
+        self.dtype = np.dtype(dtype)
+        self.defaults = np.full(len(self.columns), np.nan, dtype=self.dtype)
+        for column, value in (defaults or {}).items():
+            self.defaults[self.columns.index(column)] = value
+        self._index = pd.Index(self.columns)
+        self._lock = threading.Lock()
+        self._missing_counts = Counter()
+        self._rows = 0
+
+    @classmethod
+    def from_preprocessor(cls, preprocessor, defaults=None):
+        # Object rows when any input column feeds a OneHotEncoder, so
+        # categories survive alignment; plain float64 otherwise
+        dtype = np.float64
+        for _, transformer, columns in getattr(preprocessor, 'transformers_', []):
+            steps = getattr(transformer, 'steps', None)
+            last = steps[-1][1] if steps else transformer
+            if len(columns) and type(last).__name__ == 'OneHotEncoder':
+                dtype = object
+        return cls(preprocessor.feature_names_in_, defaults, dtype)
+
+    def align(self, frame):
+        # Returns (values, missing): values has one row per frame row and one
+        # column per training column, missing names the columns defaulted
+        positions = frame.columns.get_indexer(self.columns)
+        present = np.flatnonzero(positions >= 0)
+        absent = np.flatnonzero(positions < 0)
+
+        values = np.empty((len(frame), len(self.columns)), dtype=self.dtype)
+        if len(present) == len(self.columns):
+            values[:] = self._block(frame.iloc[:, positions])
+        elif len(present):
+            values[:, present] = self._block(frame.iloc[:, positions[present]])
+        if len(absent):
+            values[:, absent] = self.defaults[absent]
+
+        missing = [self.columns[i] for i in absent]
+        self._record(len(frame), missing)
+        return values, missing
+
+    def align_record(self, record):
+        # One row given as a {column: value} mapping
+        values = self.defaults.copy()
+        missing = []
+        for i, column in enumerate(self.columns):
+            if column in record:
+                value = record[column]
+                values[i] = np.nan if value is None and self.dtype != object else value
+            else:
+                missing.append(column)
+        self._record(1, missing)
+        return values.reshape(1, -1), missing
+
+    def to_frame(self, values):
+        # For the sklearn ColumnTransformer, which selects columns by name
+        return pd.DataFrame(values, columns=self._index, copy=False)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'rows': self._rows,
+                'columns': len(self.columns),
+                'missing_columns': dict(self._missing_counts.most_common(20)),
+            }
+
+    def _block(self, selected):
+        if self.dtype == object:
+            return selected.to_numpy(dtype=object)
+        return selected.to_numpy(dtype=self.dtype, na_value=np.nan)
+
+    def _record(self, rows, missing):
+        with self._lock:
+            self._rows += rows
+            new = [column for column in missing if column not in self._missing_counts]
+            self._missing_counts.update({column: rows for column in missing})
+        if new:
+            logger.warning("Input is missing %d model columns, using defaults: %s", len(new), new[:10])
@@ -0,0 +1,55 @@
+import os
+import numpy as np
+import pytest
+from attribution import FeatureAttributor
+from inference import CompiledPipeline, verify_parity
+from model_artifact import sample_inputs
+from model_bundle import ModelBundle, load_model, load_pipeline
+
+# The serving bundle (artifact when present) against the sklearn pipeline in
+# the joblib file it was converted from
+MODEL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL_PATH = os.path.join(MODEL_DIR, 'best_readmission_risk_model_fin.joblib')
+ARTIFACT_PATH = os.path.join(MODEL_DIR, 'best_readmission_risk_model_fin.artifact')
+TOP_K = 5
+
+pytestmark = pytest.mark.skipif(not os.path.exists(MODEL_PATH), reason="model file not checked out")
+
+
+@pytest.fixture(scope='module')
+def pipeline():
+    return load_pipeline(MODEL_PATH)
+
+@pytest.fixture(scope='module')
+def bundle():
+    return load_model(MODEL_PATH, ARTIFACT_PATH)
+
+@pytest.fixture(scope='module')
+def rows(bundle):
+    frame = sample_inputs(bundle.preprocessor, 500, seed=3)
+    frame.iloc[0] = np.nan
+    return frame
+
+
+def test_compiled_probabilities_match_sklearn(bundle, pipeline, rows):
+    compiled = CompiledPipeline.from_bundle(bundle)
+    expected = pipeline.named_steps['classifier'].predict_proba(pipeline.named_steps['preprocessor'].transform(rows))
+    assert np.array_equal(compiled.predict_proba(compiled.transform(rows)), expected)
+
+def test_verify_parity_uses_the_sklearn_pipeline(bundle, pipeline):
+    assert verify_parity(bundle, 500, pipeline=pipeline)
+
+def test_top_features_match_sklearn(bundle, pipeline, rows):
+    compiled = CompiledPipeline.from_bundle(bundle)
+    reference = FeatureAttributor(ModelBundle(pipeline.named_steps['preprocessor'], pipeline.named_steps['classifier']),
+                                  cache_size=0)
+    serving = FeatureAttributor(bundle, cache_size=0)
+    expected_features = pipeline.named_steps['preprocessor'].transform(rows)
+    assert serving.explain(compiled.transform(rows), TOP_K) == reference.explain(expected_features, TOP_K)
+
+def test_attributions_add_up_to_sklearn_log_odds(pipeline, rows):
+    classifier = pipeline.named_steps['classifier']
+    features = pipeline.named_steps['preprocessor'].transform(rows)
+    attributor = FeatureAttributor(ModelBundle(pipeline.named_steps['preprocessor'], classifier), cache_size=0)
+    contributions, bias = attributor.ensemble.contributions(np.asarray(features, dtype=np.float32))
+    np.testing.assert_allclose(bias + contributions.sum(axis=1), classifier.decision_function(features), rtol=1e-9, atol=1e-9)
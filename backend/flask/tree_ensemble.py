@@ -0,0 +1,131 @@
+import numpy as np
+
+TREE_LEAF = -1
+
+
+class FlatTreeEnsemble:
+    # A fitted binary GradientBoostingClassifier flattened into one set of node
+    # arrays. Every tree is walked for every row at once, one depth level per
+    # step, so the cost grows with max_depth rather than with rows x trees.
+    def __init__(self, left, right, feature, threshold, value, node_mean, roots,
+                 max_depth, learning_rate, init_raw, n_features):
+        self.left = left
+        self.right = right
+        self.feature = feature
+        self.threshold = threshold
+        self.value = value
+        self.node_mean = node_mean
+        self.roots = roots
+        self.max_depth = int(max_depth)
+        self.learning_rate = float(learning_rate)
+        self.init_raw = float(init_raw)
+        self.n_features = int(n_features)
+        # [left, right] per node, so one gather picks the next node
+        self.children = np.stack([left, right], axis=1).ravel()
+
+    @classmethod
+    def from_gradient_boosting(cls, classifier):
+        if getattr(classifier, 'n_trees_per_iteration_', None) != 1:
+            raise ValueError("Only binary GradientBoostingClassifier models can be flattened")
+
+        trees = [estimator.tree_ for estimator in classifier.estimators_[:, 0]]
+        sizes = np.array([tree.node_count for tree in trees])
+        offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        left, right, feature, threshold, value, node_mean = [], [], [], [], [], []
+
+        for tree, offset in zip(trees, offsets):
+            node_ids = np.arange(tree.node_count)
+            is_leaf = tree.children_left == TREE_LEAF
+            # Leaves point back at themselves so a fixed number of steps is
+            # enough for every row to settle, whatever its path length
+            left.append(np.where(is_leaf, node_ids, tree.children_left) + offset)
+            right.append(np.where(is_leaf, node_ids, tree.children_right) + offset)
+            feature.append(np.where(is_leaf, 0, tree.feature))
+            threshold.append(np.where(is_leaf, np.inf, tree.threshold))
+            value.append(tree.value[:, 0, 0])
+            node_mean.append(_node_expectations(tree))
+
+        n_features = classifier.n_features_in_
+        # The init estimator's raw score doesn't depend on X for the prior strategy
+        init_raw = classifier._raw_predict_init(np.zeros((1, n_features), dtype=np.float32))[0, 0]
+        return cls(
+            left=np.concatenate(left).astype(np.intp),
+            right=np.concatenate(right).astype(np.intp),
+            feature=np.concatenate(feature).astype(np.intp),
+            threshold=np.concatenate(threshold).astype(np.float64),
+            value=np.concatenate(value).astype(np.float64),
+            node_mean=np.concatenate(node_mean).astype(np.float64),
+            roots=offsets.astype(np.intp),
+            max_depth=max(tree.max_depth for tree in trees),
+            learning_rate=classifier.learning_rate,
+            init_raw=init_raw,
+            n_features=n_features,
+        )
+
+    def _prepare(self, X):
+        # sklearn evaluates trees on float32 input, so do the same for parity
+        return np.ascontiguousarray(X, dtype=np.float32)
+
+    def _start(self, X):
+        # Flat gathers (np.take on raveled arrays) are much cheaper than
+        # 2-D fancy indexing for the (rows, trees) node matrix
+        X = self._prepare(X)
+        row_offsets = (np.arange(X.shape[0]) * self.n_features)[:, None]
+        nodes = np.broadcast_to(self.roots, (X.shape[0], len(self.roots)))
+        return X.ravel(), row_offsets, nodes
+
+    def _step(self, flat_X, row_offsets, nodes):
+        # Written as not (x <= threshold) so NaN goes right, like sklearn
+        go_right = ~(np.take(flat_X, row_offsets + np.take(self.feature, nodes)) <= np.take(self.threshold, nodes))
+        return np.take(self.children, 2 * nodes + go_right)
+
+    def apply(self, X):
+        flat_X, row_offsets, nodes = self._start(X)
+        for _ in range(self.max_depth):
+            nodes = self._step(flat_X, row_offsets, nodes)
+        return nodes
+
+    def predict_raw(self, X):
+        leaf_values = self.value[self.apply(X)]
+        raw = np.full(leaf_values.shape[0], self.init_raw)
+        # Accumulate stage by stage, in the same order as sklearn
+        for stage in range(leaf_values.shape[1]):
+            raw += self.learning_rate * leaf_values[:, stage]
+        return raw
+
+    def contributions(self, X):
+        # Decision-path attribution: each split on a row's path credits its
+        # feature with the change in expected tree output it causes. Per row,
+        # bias + contributions.sum() equals the raw (log-odds) score.
+        flat_X, row_offsets, nodes = self._start(X)
+        n_rows = nodes.shape[0]
+        flat_contributions = np.zeros(n_rows * self.n_features)
+        for _ in range(self.max_depth):
+            split_feature = self.feature[nodes]
+            children = self._step(flat_X, row_offsets, nodes)
+            delta = self.node_mean[children] - self.node_mean[nodes]
+            flat_contributions += np.bincount(
+                (row_offsets + split_feature).ravel(),
+                weights=delta.ravel(),
+                minlength=n_rows * self.n_features,
+            )
+            nodes = children
+        contributions = flat_contributions.reshape(n_rows, self.n_features) * self.learning_rate
+        return contributions, self.bias
+
+    @property
+    def bias(self):
+        return self.init_raw + self.learning_rate * self.node_mean[self.roots].sum()
+
+
+def _node_expectations(tree):
+    # Internal node values in a boosted tree are residual means, not the mean
+    # of the (line-searched) leaf values below them, so rebuild them bottom-up
+    weights = tree.weighted_n_node_samples
+    expectations = tree.value[:, 0, 0].astype(np.float64).copy()
+    # Children always have larger ids than their parent in sklearn trees
+    for node in range(tree.node_count - 1, -1, -1):
+        left, right = tree.children_left[node], tree.children_right[node]
+        if left != TREE_LEAF:
+            expectations[node] = (weights[left] * expectations[left] + weights[right] * expectations[right]) / weights[node]
+    return expectations